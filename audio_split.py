@@ -0,0 +1,103 @@
+import io
+import re
+import logging
+from config import STT_SEGMENT_SECONDS, STT_SEGMENT_OVERLAP
+
+log = logging.getLogger(__name__)
+
+# pydub + ffmpeg — опциональны: без них длинные голосовые уходят в Whisper одним запросом
+try:
+    from pydub import AudioSegment
+    from pydub.silence import detect_silence
+except ImportError:
+    AudioSegment = None
+
+SILENCE_SEARCH_MS = 10_000  # искать паузу в пределах ±10с от целевой точки разреза
+MIN_SILENCE_MS = 300
+MAX_OVERLAP_WORDS = 12
+
+def available() -> bool:
+    return AudioSegment is not None
+
+def _cut_points(audio, target_ms: int) -> list[int]:
+    """Точки разреза около каждых target_ms, сдвинутые в середину ближайшей паузы."""
+    points = []
+    silence_thresh = audio.dBFS - 16
+    position = target_ms
+    while position < len(audio) - target_ms // 2:
+        start = max(position - SILENCE_SEARCH_MS, (points[-1] if points else 0) + 1000)
+        window = audio[start:position + SILENCE_SEARCH_MS]
+        silences = detect_silence(window, min_silence_len=MIN_SILENCE_MS, silence_thresh=silence_thresh)
+        cut = position
+        if silences:
+            middles = [start + (s + e) // 2 for s, e in silences]
+            cut = min(middles, key=lambda m: abs(m - position))
+        points.append(cut)
+        position = cut + target_ms
+    return points
+
+def split_audio(data: bytes, fmt: str = "ogg") -> list[bytes]:
+    """Режет длинное аудио на куски ~STT_SEGMENT_SECONDS по паузам с перекрытием STT_SEGMENT_OVERLAP.
+    Короткое аудио (или без pydub/ffmpeg) возвращается одним куском. Синхронная: вызывать в потоке.
+    """
+    if not available():
+        return [data]
+    target_ms = int(STT_SEGMENT_SECONDS * 1000)
+    overlap_ms = int(STT_SEGMENT_OVERLAP * 1000)
+    try:
+        audio = AudioSegment.from_file(io.BytesIO(data), format=fmt)
+    except Exception as e:
+        log.warning(f"⚠️ Не удалось декодировать аудио для нарезки: {e}")
+        return [data]
+    if len(audio) <= target_ms * 1.5:
+        return [data]
+
+    bounds = [0, *_cut_points(audio, target_ms), len(audio)]
+    segments = []
+    for start, end in zip(bounds, bounds[1:]):
+        buf = io.BytesIO()
+        audio[max(start - overlap_ms, 0):end].export(buf, format="ogg", codec="libopus")
+        segments.append(buf.getvalue())
+    log.info(f"✂️ Аудио {len(audio) / 1000:.0f}с нарезано на {len(segments)} кусков")
+    return segments
+
+def _words(text: str) -> list[str]:
+    return [re.sub(r'[^\w]', '', w.lower()) for w in text.split()]
+
+def _same_word(tail_word: str, head_word: str) -> bool:
+    """Слова совпадают, или конец предыдущего куска обрезал слово посередине."""
+    return tail_word == head_word or (len(tail_word) >= 2 and head_word.startswith(tail_word))
+
+def _overlap(prev: list[str], head: list[str]) -> tuple[int, int]:
+    """Самое длинное (от 2 слов) совпадение конца prev с началом head.
+    Допускает одно обрезанное или лишнее слово на каждой границе. Возвращает (сколько слов убрать
+    с конца prev, сколько — с начала head) или None.
+    """
+    for k in range(min(MAX_OVERLAP_WORDS, len(prev), len(head)), 1, -1):
+        for skip_prev in (0, 1):
+            for skip_head in (0, 1):
+                tail = prev[len(prev) - skip_prev - k:len(prev) - skip_prev]
+                head_part = head[skip_head:skip_head + k]
+                if len(tail) < k or len(head_part) < k or tail[:-1] != head_part[:-1]:
+                    continue
+                if tail[-1] == head_part[-1]:
+                    return skip_prev, skip_head + k
+                if _same_word(tail[-1], head_part[-1]):
+                    # Последнее слово предыдущего куска обрезано — полное берем из следующего
+                    return skip_prev + 1, skip_head + k - 1
+    return None
+
+def merge_transcripts(parts: list[str]) -> str:
+    """Склеивает расшифровки соседних кусков, убирая слова, повторенные в перекрытии."""
+    merged = []
+    for part in parts:
+        words = part.split()
+        if merged and words:
+            overlap = _overlap(_words(" ".join(merged[-MAX_OVERLAP_WORDS - 1:])), _words(" ".join(words[:MAX_OVERLAP_WORDS + 1])))
+            if overlap:
+                drop_prev, drop_head = overlap
+                if drop_prev:
+                    del merged[-drop_prev:]
+                words = words[drop_head:]
+        merged.extend(words)
+    return " ".join(merged)
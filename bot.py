@@ -2,6 +2,7 @@ import asyncio
 import logging
 import sys
 import os
+import tempfile
 from aiogram import Bot, Dispatcher, Router, F, BaseMiddleware
 from aiogram.client.default import DefaultBotProperties
 from aiogram.enums import ParseMode
@@ -12,18 +13,30 @@ from aiogram.types import (
     BufferedInputFile, InputFile
 )
 from aiogram.utils.keyboard import InlineKeyboardBuilder
+from aiogram.exceptions import TelegramAPIError, TelegramBadRequest, TelegramRetryAfter
 import io
+import time
 from aiohttp import web
 from typing import Callable, Any, Awaitable
 
 from voice_service import voice_service
 from reminder_service import reminder_manager
-from config import BOT_TOKEN, ADMIN_ID, DEFAULT_MODEL
+from config import (
+    BOT_TOKEN, ADMIN_ID, DEFAULT_MODEL, STREAM_RESPONSES, STREAM_EDIT_INTERVAL, TTS_SEND_FIRST_SEGMENT,
+    VOICE_SPOOL_MAX_BYTES, DOC_MAX_BYTES
+)
 from groq_service import ai
-from image_service import image_gen
+from image_queue import image_queue, image_error_text
+from image_service import image_gen, IMAGE_MODELS
+from image_warmth import warmth
+from memory_service import memory_service
 from doc_service import doc_tool
 from calendar_service import calendar_service
 import database as db
+from session_cache import session_cache
+from model_scheduler import scheduler
+from http_clients import http_clients
+from search_service import search_tool
 
 # Логирование
 logging.basicConfig(level=logging.INFO, stream=sys.stdout)
@@ -91,11 +104,8 @@ def models_keyboard():
 
 def image_models_keyboard():
     buttons = [
-        [InlineKeyboardButton(text="🎨 FLUX.1 [schnell] (Best)", callback_data="set_img_black-forest-labs/FLUX.1-schnell")],
-        [InlineKeyboardButton(text="📸 Stable Diffusion 3.5", callback_data="set_img_stabilityai/stable-diffusion-3.5-large")],
-        [InlineKeyboardButton(text="🏮 Kolors (Ultra Phoreal)", callback_data="set_img_Kwai-Kolors/Kolors")],
-        [InlineKeyboardButton(text="⚡ SDXL Turbo (Instant)", callback_data="set_img_stabilityai/sdxl-turbo")],
-        [InlineKeyboardButton(text="🌸 Animagine (Anime Style)", callback_data="set_img_cagliostrolab/animagine-xl-3.1")]
+        [InlineKeyboardButton(text=label, callback_data=f"set_img_{model_id}")]
+        for model_id, label in IMAGE_MODELS
     ]
     return InlineKeyboardMarkup(inline_keyboard=buttons)
 
@@ -192,11 +202,28 @@ async def show_stats(message: Message):
     admin_info = ""
     if str(message.from_user.id) == str(ADMIN_ID):
         total_stats = await db.get_stats()
+        cache_stats = session_cache.stats()
+        sched_stats = scheduler.stats()
+        search_stats = search_tool.stats()
+        image_cache_stats = image_queue.cache.stats()
         admin_info = (
             f"\n\n👑 <b>Global Stats (Admin Only):</b>\n"
             f"👥 Users: <code>{total_stats.get('users', 0)}</code>\n"
             f"🎞 Total Tokens: <code>{total_stats.get('tokens', 0):,}</code>\n"
-            f"💰 Total Cost: <code>${total_stats.get('cost', 0):.4f}</code>"
+            f"💰 Total Cost: <code>${total_stats.get('cost', 0):.4f}</code>\n"
+            f"🗄 Session cache: <code>{cache_stats['users']}</code> users, "
+            f"hit rate <code>{cache_stats['hit_rate']:.0%}</code> ({cache_stats['hits']}/{cache_stats['hits'] + cache_stats['misses']})\n"
+            f"🚦 Groq queue: <code>{sched_stats['queue_depth']}</code> now, "
+            f"queued <code>{sched_stats['queued']}</code>, rerouted <code>{sched_stats['rerouted']}</code>, "
+            f"429s <code>{sched_stats['rate_limited']}</code>\n"
+            f"🏁 Hedges: fired <code>{ai.hedge_stats['fired']}</code>, "
+            f"won <code>{ai.hedge_stats['won']}</code>, lost <code>{ai.hedge_stats['lost']}</code>\n"
+            f"🔍 Search cache: hit rate <code>{search_stats['hit_rate']:.0%}</code> "
+            f"(cached <code>{search_stats['hits']}</code>, coalesced <code>{search_stats['coalesced']}</code>, "
+            f"upstream <code>{search_stats['misses']}</code>)\n"
+            f"🖼 Image cache: <code>{image_cache_stats['files']}</code> files, "
+            f"<code>{image_cache_stats['bytes'] // (1024 * 1024)}</code> MB, "
+            f"served <code>{image_queue.stats['cached']}</code> of <code>{image_queue.stats['submitted']}</code>"
         )
 
     await message.answer(
@@ -255,11 +282,7 @@ async def process_speak_last(callback: CallbackQuery):
         return
 
     try:
-        audio_bytes = await voice_service.text_to_speech(last_ai_msg)
-        await callback.message.answer_voice(
-            voice=BufferedInputFile(audio_bytes, filename="voice.mp3"),
-            caption="🔊 <b>Озвучка сообщения</b>"
-        )
+        await send_voice_answer(callback.message, last_ai_msg, caption="🔊 <b>Озвучка сообщения</b>")
     except Exception as e:
         log.error(f"TTS Callback Error: {e}")
         await callback.message.answer(f"⚠️ Ошибка озвучки: {str(e)}")
@@ -276,6 +299,8 @@ async def process_model_selection(callback: CallbackQuery):
 async def process_image_model_selection(callback: CallbackQuery):
     img_model = callback.data.replace("set_img_", "")
     await db.save_user_data(callback.from_user.id, image_model=img_model)
+    # Модель выбрали — прогреваем ее заранее, до первого /img
+    warmth.note_selected(img_model)
     
     short_name = img_model.split('/')[-1]
     await callback.answer(f"✅ Фото: {short_name}")
@@ -309,56 +334,42 @@ async def cmd_img(message: Message):
     await message.bot.send_chat_action(chat_id=message.chat.id, action="upload_photo")
     
     try:
-        # 1. Улучшаем промпт через Groq (если он доступен)
-        english_prompt = prompt # По умолчанию используем оригинал
-        try:
-            enhanced_prompt_query = f"Translate and enhance this image description for an AI generator. Be descriptive but keep it under 30 words. Prompt: {prompt}"
-            ai_prompt = await ai.client.chat.completions.create(
-                messages=[{"role": "user", "content": enhanced_prompt_query}],
-                model="llama-3.1-8b-instant",
-                temperature=0.7,
-            )
-            english_prompt = ai_prompt.choices[0].message.content.strip()
-            log.info(f"✨ Enhanced prompt: {english_prompt}")
-        except Exception as groq_err:
-            log.warning(f"⚠️ Не удалось улучшить промпт через Groq (вероятно, блок): {groq_err}")
-            # Продолжаем с оригинальным промптом
-
-        # 2. Генерируем картинку через Hugging Face
         # Получаем выбранную модель пользователя
-        _, _, user_img_model = await db.get_user_data(message.from_user.id)
-        
-        image_bytes, used_model = await image_gen.generate_image(english_prompt, model_id=user_img_model)
-        
-        model_display = used_model.split('/')[-1]
-        await message.answer_photo(
-            photo=BufferedInputFile(image_bytes, filename="art.png"),
-            caption=f"🎨 <b>Ваш запрос:</b> {prompt}\n✨ <i>Модель: {model_display}</i>"
+        _, _, user_img_model, _ = await db.get_user_data(message.from_user.id)
+
+        # 1. Улучшаем промпт через Groq (если он доступен и картинки еще нет в кэше)
+        english_prompt = prompt # По умолчанию используем оригинал
+        if not image_queue.is_cached(user_img_model, prompt):
+            try:
+                english_prompt = await ai.enhance_image_prompt(prompt)
+                log.info(f"✨ Enhanced prompt: {english_prompt}")
+            except Exception as groq_err:
+                log.warning(f"⚠️ Не удалось улучшить промпт через Groq (вероятно, блок): {groq_err}")
+                # Продолжаем с оригинальным промптом
+
+        # 2. Ставим генерацию через Hugging Face в фоновую очередь (или отправку из кэша)
+        queued = image_queue.submit(
+            chat_id=message.chat.id,
+            user_id=message.from_user.id,
+            prompt=english_prompt,
+            model_id=user_img_model,
+            caption=lambda used_model: f"🎨 <b>Ваш запрос:</b> {prompt}\n✨ <i>Модель: {used_model.split('/')[-1]}</i>",
+            source_prompt=prompt
         )
+        if queued:
+            eta = 0 if image_queue.is_cached(user_img_model, prompt) else warmth.eta(image_gen.pick_model(user_img_model))
+            if eta:
+                await message.answer(f"🎨 <b>Рисую...</b> Модель загружается, это займет ~{int(eta)} сек. Пришлю картинку, как только она будет готова.")
+            else:
+                await message.answer("🎨 <b>Рисую...</b> Пришлю картинку, как только она будет готова.")
+        else:
+            await message.answer(f"⏳ <b>У вас уже {image_queue.pending(message.from_user.id)} картинки в работе.</b>\nДождитесь их, пожалуйста.")
     except Exception as e:
         log.error(f"Image Gen Error: {e}", exc_info=True)
-        error_msg = str(e)
-        if "HF_TOKEN" in error_msg:
-            await message.answer("❌ <b>Ошибка: Отсутствует токен Hugging Face.</b>\nПожалуйста, добавьте <code>HF_TOKEN</code> в настройки бота.")
-        elif "wait" in error_msg.lower():
-            await message.answer("⏳ <b>Модель прогревается.</b>\nПожалуйста, попробуйте еще раз через несколько секунд.")
-        else:
-            await message.answer(f"⚠️ <b>Произошла ошибка:</b>\n<code>{error_msg}</code>")
-
-async def send_ai_response(message: Message, ai_data: tuple[str, list]):
-    """Отправляет текстовый ответ и медиа-файлы от ИИ."""
-    response_text, media_list = ai_data
-    
-    # 1. Отправляем медиа (картинки), если они есть
-    for media in media_list:
-        if media["type"] == "photo":
-            from aiogram.types import BufferedInputFile
-            await message.answer_photo(
-                photo=BufferedInputFile(media["data"], filename="ai_art.jpg"),
-                caption=media.get("caption", "")
-            )
+        await message.answer(image_error_text(e))
 
-    # 2. Отправляем текст
+async def send_ai_response(message: Message, response_text: str):
+    """Отправляет текстовый ответ ИИ (картинки приходят отдельно из image_queue)."""
     if not response_text:
         return
 
@@ -369,28 +380,139 @@ async def send_ai_response(message: Message, ai_data: tuple[str, list]):
     else:
         await message.answer(response_text, reply_markup=speak_keyboard())
 
+async def send_ai_stream(message: Message, stream) -> str:
+    """Отправляет ответ ИИ по мере генерации.
+    Первый кусок текста уходит сразу, дальше сообщение редактируется не чаще STREAM_EDIT_INTERVAL,
+    после 4000 символов продолжение идет новыми сообщениями. Возвращает итоговый текст.
+    Ошибки Telegram не прерывают чтение потока: генератор дочитывается до конца, и ход сохраняется в истории.
+    """
+    text = ""
+    sent = []   # отправленные сообщения (по одному на каждые 4000 символов)
+    shown = []  # текст, который сейчас виден в каждом из них
+    last_flush = 0.0
+    retry_at = 0.0  # до этого момента Telegram просил не слать правки (flood control)
+
+    async def deliver(i: int, part: str, markup, parse_mode):
+        if i >= len(sent):
+            sent.append(await message.answer(part, reply_markup=markup, parse_mode=parse_mode))
+            shown.append(part)
+        else:
+            await sent[i].edit_text(part, reply_markup=markup, parse_mode=parse_mode)
+            shown[i] = part
+
+    async def deliver_final(i: int, part: str, markup):
+        parse_mode = ParseMode.HTML
+        for _ in range(3):
+            try:
+                await deliver(i, part, markup, parse_mode)
+                return
+            except TelegramRetryAfter as e:
+                log.warning(f"Stream final flush: flood control, retry in {e.retry_after}s")
+                await asyncio.sleep(e.retry_after)
+            except TelegramBadRequest as e:
+                if "not modified" in str(e):
+                    return
+                if parse_mode is None:
+                    log.error(f"Stream final flush failed: {e}")
+                    return
+                # Итоговый кусок с битой HTML-разметкой (например, разрезан посреди тега) — отдаем как есть
+                log.warning(f"Stream HTML rejected, sending plain text: {e}")
+                parse_mode = None
+            except TelegramAPIError as e:
+                log.error(f"Stream final flush failed: {e}")
+                return
+        log.error("Stream final flush failed: flood control did not lift")
+
+    async def flush():
+        nonlocal retry_at
+        visible = ai._clean_response(text)
+        parts = [visible[i:i+4000] for i in range(0, len(visible), 4000)]
+        for i, part in enumerate(parts):
+            if i < len(sent) and part == shown[i]:
+                continue
+            try:
+                # Промежуточные куски — простым текстом: HTML-тег в них может быть еще не закрыт
+                await deliver(i, part, None, None)
+            except TelegramRetryAfter as e:
+                # Правки пропускаем, пока Telegram не разрешит, а поток продолжаем читать
+                log.warning(f"Stream flush: flood control, pausing edits for {e.retry_after}s")
+                retry_at = time.monotonic() + e.retry_after
+                return
+            except TelegramAPIError as e:
+                # Не отправилось — повторим на следующем сбросе
+                if "not modified" not in str(e):
+                    log.warning(f"Stream flush failed: {e}")
+
+    try:
+        async for item in stream:
+            text += item
+            # Первый кусок отправляем сразу, дальше — с ограничением частоты правок
+            now = time.monotonic()
+            if now >= retry_at and (not sent or now - last_flush >= STREAM_EDIT_INTERVAL):
+                await flush()
+                last_flush = time.monotonic()
+    finally:
+        # Если чтение прервали (отмена хендлера), закрываем генератор явно, а не оставляем сборщику мусора
+        await stream.aclose()
+
+    visible = ai._clean_response(text)
+    parts = [visible[i:i+4000] for i in range(0, len(visible), 4000)]
+    for i, part in enumerate(parts):
+        await deliver_final(i, part, speak_keyboard() if i == 0 else None)
+    return visible
+
+async def send_voice_answer(message: Message, text: str, caption: str):
+    """Озвучивает текст и отправляет голосовым.
+    Уже озвученный текст уходит по Telegram file_id или из дискового кэша без запросов к TTS.
+    С TTS_SEND_FIRST_SEGMENT первый кусок новой озвучки уходит сразу, как только готов, остальное — вторым сообщением.
+    """
+    file_id = voice_service.cached_file_id(text)
+    if file_id:
+        try:
+            await message.answer_voice(voice=file_id, caption=caption)
+            return
+        except TelegramBadRequest as e:
+            log.warning(f"⚠️ file_id озвучки больше не действителен: {e}")
+            await voice_service.remember_file_id(text, None)
+
+    if not TTS_SEND_FIRST_SEGMENT:
+        audio_bytes = await voice_service.text_to_speech(text)
+        sent = await message.answer_voice(voice=BufferedInputFile(audio_bytes, filename="answer.mp3"), caption=caption)
+        await remember_voice(text, sent)
+        return
+
+    first, rest = None, []
+    async for segment in voice_service.stream_speech(text):
+        if first is None:
+            first = await message.answer_voice(voice=BufferedInputFile(segment, filename="answer.mp3"), caption=caption)
+        else:
+            rest.append(segment)
+    if rest:
+        await message.answer_voice(voice=BufferedInputFile(b"".join(rest), filename="answer_2.mp3"))
+    elif first:
+        await remember_voice(text, first)
+
+async def remember_voice(text: str, sent: Message):
+    """Озвучка ушла одним сообщением — следующий раз отправим ее по file_id."""
+    media = sent.voice or sent.audio
+    if media:
+        await voice_service.remember_file_id(text, media.file_id)
+
 @router.message(F.voice)
 async def handle_voice(message: Message):
     """Обработка голосовых сообщений (STT)."""
     await message.bot.send_chat_action(chat_id=message.chat.id, action="typing")
     
     try:
-        # 1. Скачиваем файл
+        # 1. Скачиваем файл в память (на диск — только если голосовое больше VOICE_SPOOL_MAX_BYTES)
         file = await message.bot.get_file(message.voice.file_id)
-        file_name = f"voice_{message.from_user.id}_{message.message_id}.ogg"
-        file_path = os.path.join("tmp", file_name)
-        
-        if not os.path.exists("tmp"):
-            os.makedirs("tmp")
+        with tempfile.SpooledTemporaryFile(max_size=VOICE_SPOOL_MAX_BYTES) as audio:
+            await message.bot.download_file(file.file_path, destination=audio)
 
-        await message.bot.download_file(file.file_path, file_path)
-        
-        # 2. Транскрибируем
-        transcription = await ai.transcribe_audio(file_path)
-        
-        # Удаляем временный файл
-        if os.path.exists(file_path):
-            os.remove(file_path)
+            # 2. Транскрибируем
+            transcription = await ai.transcribe_audio(
+                audio, filename=f"voice_{message.message_id}.ogg", duration=message.voice.duration
+            )
 
         if transcription.startswith("❌"):
             await message.answer(transcription)
@@ -398,23 +520,20 @@ async def handle_voice(message: Message):
 
         # 4. Обрабатываем как обычный текст
         # Мы не отправляем транскрипцию в чат, чтобы взаимодействие было более бесшовным («Голос в Голос»)
-        response_data = await ai.get_response(message.from_user.id, transcription)
-        
-        # 5. Отправляем ответ (текст + возможно картинка)
-        await send_ai_response(message, response_data)
+        # 5. Отправляем ответ (картинки, если агент их заказал, придут отдельно из очереди)
+        if STREAM_RESPONSES:
+            response_text = await send_ai_stream(message, ai.stream_response(message.from_user.id, transcription))
+        else:
+            response_text = await ai.get_response(message.from_user.id, transcription)
+            await send_ai_response(message, response_text)
         
         # 6. Авто-озвучка ответа (Голос в Голос) - берем только текст
-        response_text = response_data[0]
         # Проверяем, если ИИ только что отправил картинку и мало текста, возможно озвучка не так важна, 
         # но мы оставим её для полноты ассистента.
         
         await message.bot.send_chat_action(chat_id=message.chat.id, action="record_voice")
         try:
-            audio_bytes = await voice_service.text_to_speech(response_text)
-            await message.answer_voice(
-                voice=BufferedInputFile(audio_bytes, filename="answer.mp3"),
-                caption="🔊 <b>Голосовой ответ</b>"
-            )
+            await send_voice_answer(message, response_text, caption="🔊 <b>Голосовой ответ</b>")
         except Exception as tts_err:
             log.warning(f"Auto-TTS Error: {tts_err}")
 
@@ -434,13 +553,13 @@ async def handle_photo(message: Message):
         image_bytes = await message.bot.download_file(file.file_path)
         
         # Передаем в ИИ-зрение
-        response_data = await ai.get_vision_response(
+        response_text = await ai.get_vision_response(
             user_id=message.from_user.id,
             image_bytes=image_bytes.read(),
             caption=message.caption
         )
         
-        await send_ai_response(message, response_data)
+        await send_ai_response(message, response_text)
     except Exception as e:
         log.error(f"Vision Handler Error: {e}", exc_info=True)
         await message.answer(f"⚠️ Ошибка при обработке фото: {str(e)}")
@@ -452,31 +571,51 @@ async def handle_document(message: Message):
     if not (file_name.lower().endswith('.pdf') or file_name.lower().endswith('.txt')):
         await message.answer("❌ Я пока умею читать только <b>PDF</b> и <b>TXT</b> файлы.")
         return
+    if (message.document.file_size or 0) > DOC_MAX_BYTES:
+        await message.answer(f"❌ Файл слишком большой (больше {DOC_MAX_BYTES // (1024 * 1024)} МБ).")
+        return
 
     wait_msg = await message.answer(f"⏳ Читаю документ <code>{file_name}</code>...")
     await message.bot.send_chat_action(chat_id=message.chat.id, action="typing")
     
     try:
-        # Скачиваем файл
-        file = await message.bot.get_file(message.document.file_id)
-        file_bytes = await message.bot.download_file(file.file_path)
-        
-        # Извлекаем текст
-        doc_text = await doc_tool.get_document_content(file_bytes.read(), file_name)
+        # Тот же файл уже читали (повторная отправка, пересылка) — берем текст из кэша без скачивания
+        doc_text = await doc_tool.cached_text(message.document.file_unique_id)
+        if doc_text is None:
+            # Скачиваем файл
+            file = await message.bot.get_file(message.document.file_id)
+            file_bytes = await message.bot.download_file(file.file_path)
+
+            # Извлекаем текст
+            doc_text = await doc_tool.get_document_content(file_bytes.read(), file_name, message.document.file_unique_id)
         
         if doc_text.startswith("⚠️") or doc_text.startswith("❌"):
             await wait_msg.edit_text(doc_text)
             return
 
+        # Большие документы конспектируются по частям — показываем прогресс (не чаще STREAM_EDIT_INTERVAL)
+        last_update = 0.0
+        async def progress(done: int, total: int):
+            nonlocal last_update
+            if done < total and time.monotonic() - last_update < STREAM_EDIT_INTERVAL:
+                return
+            last_update = time.monotonic()
+            try:
+                await wait_msg.edit_text(f"⏳ Читаю документ <code>{file_name}</code>... {done}/{total} частей")
+            except TelegramBadRequest as e:
+                log.debug(f"Doc progress edit skipped: {e}")
+
         # Отправляем в ИИ для анализа
-        response_data = await ai.get_doc_response(
+        response_text = await ai.get_doc_response(
             user_id=message.from_user.id,
             doc_text=doc_text,
-            file_name=file_name
+            file_name=file_name,
+            caption=message.caption,
+            progress=progress
         )
         
         await wait_msg.delete() # Удаляем "секунду, читаю..."
-        await send_ai_response(message, response_data)
+        await send_ai_response(message, response_text)
     except Exception as e:
         log.error(f"Doc Handler Error: {e}", exc_info=True)
         await wait_msg.edit_text(f"⚠️ Ошибка при чтении файла: {str(e)}")
@@ -499,16 +638,28 @@ async def chat_handler(message: Message):
     await message.bot.send_chat_action(chat_id=message.chat.id, action="typing")
     
     # Получаем ответ от AI
-    response_data = await ai.get_response(message.from_user.id, message.text)
-    await send_ai_response(message, response_data)
+    if STREAM_RESPONSES:
+        await send_ai_stream(message, ai.stream_response(message.from_user.id, message.text))
+        return
+
+    response_text = await ai.get_response(message.from_user.id, message.text)
+    await send_ai_response(message, response_text)
 
 async def main():
-    # Инициализация БД
+    # Инициализация БД и общих HTTP-пулов
     await db.init_db()
+    await http_clients.start()
     
     # Настройка напоминаний
     reminder_manager.set_bot(bot)
     reminder_manager.start()
+
+    # Доставка картинок из фоновой очереди
+    image_queue.set_bot(bot)
+    image_gen.start_warmup()
+
+    # Фоновое слияние дублей в вечной памяти
+    memory_service.start_consolidation()
     
     # Запуск веб-сервера
     asyncio.create_task(start_web_server())
@@ -521,7 +672,10 @@ async def main():
     try:
         await dp.start_polling(bot)
     finally:
+        image_gen.stop_warmup()
+        memory_service.stop_consolidation()
         await db.close_db()
+        await http_clients.close()
         await bot.session.close()
 
 if __name__ == "__main__":
@@ -14,6 +14,10 @@ DEFAULT_MODEL = os.getenv("DEFAULT_MODEL", "llama-3.3-70b-versatile")
 # Database (Supabase)
 DATABASE_URL = os.getenv("DATABASE_URL", "")
 
+# Кэш сессий пользователей (история, модели, память) перед БД
+SESSION_CACHE_SIZE = int(os.getenv("SESSION_CACHE_SIZE", "500")) # пользователей
+SESSION_CACHE_MAX_BYTES = int(os.getenv("SESSION_CACHE_MAX_BYTES", str(32 * 1024 * 1024)))
+
 # Hugging Face (Image Gen)
 HF_TOKEN = os.getenv("HF_TOKEN", "")
 DEFAULT_IMAGE_MODEL = os.getenv("DEFAULT_IMAGE_MODEL", "black-forest-labs/FLUX.1-schnell")
@@ -25,3 +29,82 @@ TAVILY_API_KEY = os.getenv("TAVILY_API_KEY", "")
 GOOGLE_CLIENT_ID = os.getenv("GOOGLE_CLIENT_ID", "")
 GOOGLE_CLIENT_SECRET = os.getenv("GOOGLE_CLIENT_SECRET", "")
 GOOGLE_REDIRECT_URI = os.getenv("GOOGLE_REDIRECT_URI", "") # e.g. https://your-app.com/callback
+
+# Streaming ответов (постепенное редактирование сообщения в Telegram)
+STREAM_RESPONSES = os.getenv("STREAM_RESPONSES", "true").lower() == "true"
+STREAM_EDIT_INTERVAL = float(os.getenv("STREAM_EDIT_INTERVAL", "1.0")) # секунды между правками сообщения
+
+# Планировщик запросов к Groq с учетом лимитов
+SCHEDULER_MAX_WAIT = float(os.getenv("SCHEDULER_MAX_WAIT", "20"))           # макс. ожидание в очереди, сек
+SCHEDULER_REROUTE_AFTER = float(os.getenv("SCHEDULER_REROUTE_AFTER", "3"))  # если ждать дольше — на запасную модель
+
+# Hedged-запросы к Groq: запасной запрос, если основной не ответил к дедлайну
+HEDGE_PATHS = {p.strip() for p in os.getenv("HEDGE_PATHS", "chat").split(",") if p.strip()}  # chat, vision, doc
+HEDGE_PERCENTILE = float(os.getenv("HEDGE_PERCENTILE", "0.95"))  # дедлайн = этот перцентиль задержек модели
+HEDGE_MIN_DELAY = float(os.getenv("HEDGE_MIN_DELAY", "1.0"))
+HEDGE_DEFAULT_DELAY = float(os.getenv("HEDGE_DEFAULT_DELAY", "5.0"))  # пока не набралось статистики
+HEDGE_MIN_SAMPLES = int(os.getenv("HEDGE_MIN_SAMPLES", "20"))
+HEDGE_BACKUP_MODEL = os.getenv("HEDGE_BACKUP_MODEL", "same")  # same | fallback
+
+# Общие HTTP-пулы (keep-alive) для Groq, Tavily, Hugging Face и веб-страниц
+HTTP_POOL_LIMIT = int(os.getenv("HTTP_POOL_LIMIT", "20"))        # соединений на клиент
+HTTP_KEEPALIVE = float(os.getenv("HTTP_KEEPALIVE", "60"))         # секунд держать простаивающее соединение
+HTTP2_ENABLED = os.getenv("HTTP2_ENABLED", "false").lower() == "true"  # нужен пакет h2
+
+# Кэш результатов веб-поиска (Tavily)
+SEARCH_CACHE_TTL = int(os.getenv("SEARCH_CACHE_TTL", "600"))    # секунд
+SEARCH_CACHE_SIZE = int(os.getenv("SEARCH_CACHE_SIZE", "256"))  # запросов
+
+# Очередь генерации картинок (Hugging Face)
+IMAGE_MODEL_CONCURRENCY = int(os.getenv("IMAGE_MODEL_CONCURRENCY", "2"))  # одновременных генераций на модель
+IMAGE_USER_JOBS = int(os.getenv("IMAGE_USER_JOBS", "3"))                  # задач в работе на пользователя
+
+# Прогрев HF-моделей
+IMAGE_WARM_TTL = int(os.getenv("IMAGE_WARM_TTL", "600"))                # секунд считать модель теплой после ответа
+IMAGE_WARMUP_WINDOW = int(os.getenv("IMAGE_WARMUP_WINDOW", "1800"))     # греть модели, выбранные за это время
+IMAGE_WARMUP_INTERVAL = int(os.getenv("IMAGE_WARMUP_INTERVAL", "120"))  # секунд между проходами прогрева
+IMAGE_REROUTE_ETA = float(os.getenv("IMAGE_REROUTE_ETA", "20"))         # дольше — отправляем на теплую модель
+IMAGE_MAX_COLD_WAIT = float(os.getenv("IMAGE_MAX_COLD_WAIT", "60"))     # максимум ожидания загрузки за попытку
+
+# Дисковый кэш (картинки, озвучка, документы)
+CACHE_DIR = os.getenv("CACHE_DIR", "cache")
+IMAGE_CACHE_MAX_BYTES = int(os.getenv("IMAGE_CACHE_MAX_BYTES", str(200 * 1024 * 1024)))  # 200 МБ
+
+# Озвучка (gTTS)
+TTS_CHUNK_CHARS = int(os.getenv("TTS_CHUNK_CHARS", "300"))  # символов в куске, синтезируемом параллельно
+TTS_WORKERS = int(os.getenv("TTS_WORKERS", "4"))            # потоков для синтеза
+TTS_SEND_FIRST_SEGMENT = os.getenv("TTS_SEND_FIRST_SEGMENT", "false").lower() == "true"  # опция: первый кусок голосового ответа — сразу, отдельным сообщением
+TTS_CACHE_MAX_BYTES = int(os.getenv("TTS_CACHE_MAX_BYTES", str(100 * 1024 * 1024)))  # 100 МБ озвучки на диске
+
+# Распознавание голосовых (Whisper)
+VOICE_SPOOL_MAX_BYTES = int(os.getenv("VOICE_SPOOL_MAX_BYTES", str(8 * 1024 * 1024)))  # больше — буфер уходит на диск
+STT_SEGMENT_SECONDS = float(os.getenv("STT_SEGMENT_SECONDS", "60"))   # длина куска длинного голосового
+STT_SEGMENT_OVERLAP = float(os.getenv("STT_SEGMENT_OVERLAP", "1.5"))  # перекрытие соседних кусков, сек
+STT_MAX_PARALLEL = int(os.getenv("STT_MAX_PARALLEL", "4"))            # одновременных запросов к Whisper на голосовое
+
+# Чтение документов (PDF/TXT)
+DOC_WORKERS = int(os.getenv("DOC_WORKERS", "2"))                 # процессов для разбора PDF одновременно
+DOC_PAGES_PER_TASK = int(os.getenv("DOC_PAGES_PER_TASK", "25"))  # минимум страниц на процесс (меньше — не делим)
+DOC_WORKER_TIMEOUT = float(os.getenv("DOC_WORKER_TIMEOUT", "120"))  # процесс разбора дольше — убиваем, сек
+DOC_MAX_PAGES = int(os.getenv("DOC_MAX_PAGES", "1000"))          # дальше страницы не читаем
+DOC_MAX_BYTES = int(os.getenv("DOC_MAX_BYTES", str(20 * 1024 * 1024)))  # 20 МБ — лимит скачивания Bot API
+DOC_CHUNK_TOKENS = int(os.getenv("DOC_CHUNK_TOKENS", "400"))     # размер фрагмента в индексе документа
+DOC_TOP_K = int(os.getenv("DOC_TOP_K", "4"))                     # фрагментов в ответ analyze_doc
+DOC_INLINE_TOKENS = int(os.getenv("DOC_INLINE_TOKENS", "3000"))  # документы меньше — целиком в промпт
+DOC_STORE_PER_USER = int(os.getenv("DOC_STORE_PER_USER", "5"))   # документов в памяти на пользователя
+DOC_STORE_USERS = int(os.getenv("DOC_STORE_USERS", "200"))       # пользователей с документами в памяти
+DOC_MAP_REDUCE = os.getenv("DOC_MAP_REDUCE", "true").lower() == "true"   # большие документы — конспектом по частям
+DOC_MAP_CHUNK_TOKENS = int(os.getenv("DOC_MAP_CHUNK_TOKENS", "2500"))   # размер части для конспекта
+DOC_MAP_MAX_TOKENS = int(os.getenv("DOC_MAP_MAX_TOKENS", "400"))        # длина конспекта одной части
+DOC_MAP_CONCURRENCY = int(os.getenv("DOC_MAP_CONCURRENCY", "4"))        # частей конспектируется одновременно
+DOC_MAP_MAX_CHUNKS = int(os.getenv("DOC_MAP_MAX_CHUNKS", "60"))         # больше — берем равномерную выборку частей
+DOC_MAP_MAX_WAIT = float(os.getenv("DOC_MAP_MAX_WAIT", "180"))          # ожидание лимита для одной части, сек (дольше SCHEDULER_MAX_WAIT)
+DOC_MAP_MIN_COVERAGE = float(os.getenv("DOC_MAP_MIN_COVERAGE", "0.8"))  # меньшая доля законспектированных частей — ошибка
+DOC_CACHE_MAX_BYTES = int(os.getenv("DOC_CACHE_MAX_BYTES", str(200 * 1024 * 1024)))  # 200 МБ текста и нарезки на диске
+
+# Вечная память в промпте
+MEMORY_TOP_K = int(os.getenv("MEMORY_TOP_K", "8"))                # релевантных сообщению фактов
+MEMORY_RECENT = int(os.getenv("MEMORY_RECENT", "3"))              # плюс последних сохраненных
+MEMORY_MAX_TOKENS = int(os.getenv("MEMORY_MAX_TOKENS", "400"))    # потолок памяти в системном промпте
+MEMORY_INDEX_USERS = int(os.getenv("MEMORY_INDEX_USERS", "500"))  # пользователей с индексом памяти в кэше
+MEMORY_CONSOLIDATE_INTERVAL = int(os.getenv("MEMORY_CONSOLIDATE_INTERVAL", "21600"))  # секунд между слияниями дублей (6 ч)
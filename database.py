@@ -4,13 +4,15 @@ import logging
 import asyncpg
 import json
 from config import DATABASE_URL
+from session_cache import session_cache
+from migrations import migrate
 
 log = logging.getLogger(__name__)
 
 _pool = None
 
 async def init_db():
-    """Инициализация пула подключений и создание таблиц."""
+    """Инициализация пула подключений и миграции схемы (см. migrations.py)."""
     global _pool
     
     if not DATABASE_URL:
@@ -28,131 +30,126 @@ async def init_db():
         log.info("🐘 Пул подключений к БД (Supabase) создан.")
         
         async with _pool.acquire() as conn:
-            # Таблица для хранения контекста (последние сообщения)
-            await conn.execute("""
-                CREATE TABLE IF NOT EXISTS chat_history (
-                    user_id BIGINT PRIMARY KEY,
-                    messages JSONB DEFAULT '[]'::jsonb,
-                    model_name TEXT DEFAULT NULL,
-                    image_model TEXT DEFAULT NULL,
-                    updated_at TIMESTAMP WITH TIME ZONE DEFAULT CURRENT_TIMESTAMP
-                );
-            """)
-            
-            # Попытка добавить колонку если она не существует (Миграция)
-            try:
-                await conn.execute("ALTER TABLE chat_history ADD COLUMN IF NOT EXISTS image_model TEXT DEFAULT NULL")
-                await conn.execute("ALTER TABLE chat_history ADD COLUMN IF NOT EXISTS character TEXT DEFAULT 'default'")
-            except:
-                pass
-            
-            # Таблица для напоминаний (текущая система)
-            await conn.execute("""
-                CREATE TABLE IF NOT EXISTS reminders (
-                    id SERIAL PRIMARY KEY,
-                    user_id BIGINT NOT NULL,
-                    text TEXT NOT NULL,
-                    remind_at TIMESTAMP WITH TIME ZONE NOT NULL,
-                    status TEXT DEFAULT 'pending',
-                    created_at TIMESTAMP WITH TIME ZONE DEFAULT CURRENT_TIMESTAMP
-                );
-            """)
-
-            # Таблица для Календаря (события с длительностью)
-            await conn.execute("""
-                CREATE TABLE IF NOT EXISTS calendar_events (
-                    id SERIAL PRIMARY KEY,
-                    user_id BIGINT NOT NULL,
-                    summary TEXT NOT NULL,
-                    description TEXT,
-                    start_time TIMESTAMP WITH TIME ZONE NOT NULL,
-                    end_time TIMESTAMP WITH TIME ZONE NOT NULL,
-                    created_at TIMESTAMP WITH TIME ZONE DEFAULT CURRENT_TIMESTAMP
-                );
-            """)
-                
-            # Таблица для "Вечной Памяти" (Eternal Memory)
-            await conn.execute("""
-                CREATE TABLE IF NOT EXISTS user_memories (
-                    id SERIAL PRIMARY KEY,
-                    user_id BIGINT NOT NULL,
-                    content TEXT NOT NULL,
-                    created_at TIMESTAMP WITH TIME ZONE DEFAULT CURRENT_TIMESTAMP
-                );
-            """)
-
-            # Таблица для Экономиста (подсчет токенов и стоимости)
-            await conn.execute("""
-                CREATE TABLE IF NOT EXISTS token_usage (
-                    user_id BIGINT PRIMARY KEY,
-                    prompt_tokens BIGINT DEFAULT 0,
-                    completion_tokens BIGINT DEFAULT 0,
-                    total_cost NUMERIC(10, 6) DEFAULT 0,
-                    last_update TIMESTAMP WITH TIME ZONE DEFAULT CURRENT_TIMESTAMP
-                );
-            """)
-
-            # Таблица для Google OAuth токенов
-            await conn.execute("""
-                CREATE TABLE IF NOT EXISTS google_tokens (
-                    user_id BIGINT PRIMARY KEY,
-                    access_token TEXT NOT NULL,
-                    refresh_token TEXT,
-                    token_uri TEXT,
-                    client_id TEXT,
-                    client_secret TEXT,
-                    scopes TEXT,
-                    expiry TIMESTAMP WITH TIME ZONE
-                );
-            """)
-                
-            log.info("✅ Таблицы БД проверены/созданы.")
+            version = await migrate(conn)
+            log.info(f"✅ Схема БД актуальна (версия {version}).")
             
     except Exception as e:
         log.error(f"❌ Ошибка БД: {e}")
 
 async def get_user_data(user_id: int):
-    """Получает историю и модель пользователя."""
-    if not _pool: return [], None
+    """Получает историю и модель пользователя (через кэш сессий)."""
+    if not _pool: return [], None, None, 'default'
+
+    cached = session_cache.get_user(user_id)
+    if cached is not None:
+        return cached
     
     try:
         async with _pool.acquire() as conn:
-            row = await conn.fetchrow(
-                "SELECT messages, model_name, image_model, character FROM chat_history WHERE user_id = $1",
-                user_id
-            )
+            # Только окно контекста из лога, одним запросом вместе с настройками
+            row = await conn.fetchrow("""
+                SELECT model_name, image_model, character,
+                    COALESCE((
+                        SELECT jsonb_agg(m.message ORDER BY m.seq) FROM chat_messages m
+                        WHERE m.user_id = h.user_id AND m.seq >= h.window_seq
+                    ), '[]'::jsonb) AS messages
+                FROM chat_history h WHERE user_id = $1
+            """, user_id)
             if row:
-                return json.loads(row['messages']), row['model_name'], row['image_model'], row['character']
-            return [], None, None, 'default'
+                data = json.loads(row['messages']), row['model_name'], row['image_model'], row['character']
+            else:
+                data = [], None, None, 'default'
+            session_cache.set_user(user_id, *data)
+            return session_cache.get_user(user_id)
     except Exception as e:
         log.error(f"❌ Ошибка получения данных: {e}")
-        return [], None, None
+        return [], None, None, 'default'
+
+# Колонки chat_history, которые обновляет save_user_data (история — в chat_messages, см. append_messages)
+USER_COLUMNS = ("model_name", "image_model", "character")
+
+def _user_columns(model_name: str = None, image_model: str = None, character: str = None) -> dict:
+    """Только переданные (не None) колонки."""
+    values = {"model_name": model_name, "image_model": image_model, "character": character}
+    return {column: value for column, value in values.items() if value is not None}
+
+def _user_upsert_sql(columns: tuple) -> str:
+    """Один INSERT … ON CONFLICT DO UPDATE, который трогает только переданные колонки."""
+    if not columns:
+        return "INSERT INTO chat_history (user_id) VALUES ($1) ON CONFLICT (user_id) DO NOTHING"
+    names = ", ".join(columns)
+    params = ", ".join(f"${i + 2}" for i in range(len(columns)))
+    updates = ", ".join(f"{column} = EXCLUDED.{column}" for column in columns)
+    return (
+        f"INSERT INTO chat_history (user_id, {names}) VALUES ($1, {params}) "
+        f"ON CONFLICT (user_id) DO UPDATE SET {updates}, updated_at = CURRENT_TIMESTAMP"
+    )
 
-async def save_user_data(user_id: int, messages: list = None, model_name: str = None, image_model: str = None, character: str = None):
-    """Сохраняет историю, чат-модель, image-модель или персонажа."""
+async def save_user_data(user_id: int, model_name: str = None, image_model: str = None, character: str = None):
+    """Сохраняет чат-модель, image-модель или персонажа (один запрос к БД)."""
     if not _pool: return
     
     try:
+        values = _user_columns(model_name, image_model, character)
         async with _pool.acquire() as conn:
-            # Сначала проверяем существование записи
-            exists = await conn.fetchval("SELECT 1 FROM chat_history WHERE user_id = $1", user_id)
-            if not exists:
-                await conn.execute("INSERT INTO chat_history (user_id) VALUES ($1)", user_id)
-
-            if messages is not None:
-                messages_json = json.dumps(messages)
-                await conn.execute("UPDATE chat_history SET messages = $1, updated_at = CURRENT_TIMESTAMP WHERE user_id = $2", messages_json, user_id)
-            
-            if model_name is not None:
-                await conn.execute("UPDATE chat_history SET model_name = $1, updated_at = CURRENT_TIMESTAMP WHERE user_id = $2", model_name, user_id)
+            await conn.execute(_user_upsert_sql(tuple(values)), user_id, *values.values())
 
-            if image_model is not None:
-                await conn.execute("UPDATE chat_history SET image_model = $1, updated_at = CURRENT_TIMESTAMP WHERE user_id = $2", image_model, user_id)
-            
-            if character is not None:
-                await conn.execute("UPDATE chat_history SET character = $1, updated_at = CURRENT_TIMESTAMP WHERE user_id = $2", character, user_id)
+        session_cache.update_user(user_id, model_name=model_name, image_model=image_model, character=character)
     except Exception as e:
         log.error(f"❌ Ошибка сохранения данных: {e}")
+        session_cache.invalidate(user_id, "user")
+
+async def save_users_data(updates: list[dict]):
+    """Пакетный save_user_data: [{"user_id": ..., "model_name": ..., "character": ...}, ...].
+    Изменения с одинаковым набором колонок уходят одним executemany.
+    """
+    if not _pool or not updates: return
+
+    groups = {}
+    for update in updates:
+        values = _user_columns(**{column: update.get(column) for column in USER_COLUMNS})
+        groups.setdefault(tuple(values), []).append((update["user_id"], *values.values()))
+
+    try:
+        async with _pool.acquire() as conn:
+            async with conn.transaction():
+                for columns, rows in groups.items():
+                    await conn.executemany(_user_upsert_sql(columns), rows)
+
+        for update in updates:
+            session_cache.update_user(update["user_id"], **{column: update.get(column) for column in USER_COLUMNS})
+    except Exception as e:
+        log.error(f"❌ Ошибка пакетного сохранения данных: {e}")
+        for update in updates:
+            session_cache.invalidate(update["user_id"], "user")
+
+async def append_messages(user_id: int, messages: list, keep_last: int):
+    """Дописывает сообщения хода в лог chat_messages и сдвигает окно контекста
+    на последние keep_last сообщений. Старые строки не переписываются.
+    """
+    if not _pool or not messages: return
+
+    try:
+        async with _pool.acquire() as conn:
+            async with conn.transaction():
+                # Строка chat_history блокируется до конца транзакции — параллельные ходы не займут одни seq
+                last_seq = await conn.fetchval("""
+                    INSERT INTO chat_history (user_id, last_seq, window_seq) VALUES ($1, $2::bigint, GREATEST($2::bigint - $3::bigint + 1, 1))
+                    ON CONFLICT (user_id) DO UPDATE SET
+                        last_seq = chat_history.last_seq + $2::bigint,
+                        window_seq = GREATEST(chat_history.last_seq + $2::bigint - $3::bigint + 1, chat_history.window_seq),
+                        updated_at = CURRENT_TIMESTAMP
+                    RETURNING last_seq
+                """, user_id, len(messages), keep_last)
+                first_seq = last_seq - len(messages) + 1
+                await conn.executemany(
+                    "INSERT INTO chat_messages (user_id, seq, message) VALUES ($1, $2, $3)",
+                    [(user_id, first_seq + i, json.dumps(message)) for i, message in enumerate(messages)]
+                )
+        session_cache.append_messages(user_id, messages, keep_last)
+    except Exception as e:
+        log.error(f"❌ Ошибка сохранения сообщений: {e}")
+        session_cache.invalidate(user_id, "user")
 
 async def clear_user_history(user_id: int):
     """Очищает только историю сообщений, оставляя модель."""
@@ -160,12 +157,48 @@ async def clear_user_history(user_id: int):
     
     try:
         async with _pool.acquire() as conn:
-            await conn.execute(
-                "UPDATE chat_history SET messages = '[]'::jsonb, updated_at = CURRENT_TIMESTAMP WHERE user_id = $1",
-                user_id
-            )
+            async with conn.transaction():
+                await conn.execute(
+                    "UPDATE chat_history SET window_seq = last_seq + 1, summary = NULL, updated_at = CURRENT_TIMESTAMP WHERE user_id = $1",
+                    user_id
+                )
+                await conn.execute("DELETE FROM chat_messages WHERE user_id = $1", user_id)
+        session_cache.update_user(user_id, messages=[])
+        session_cache.set_summary(user_id, None)
     except Exception as e:
         log.error(f"❌ Ошибка очистки истории: {e}")
+        session_cache.invalidate(user_id, "user")
+
+async def get_summary(user_id: int):
+    """Получает сжатое резюме старой части диалога (через кэш сессий)."""
+    if not _pool: return None
+
+    found, cached = session_cache.get_summary(user_id)
+    if found:
+        return cached
+
+    try:
+        async with _pool.acquire() as conn:
+            summary = await conn.fetchval("SELECT summary FROM chat_history WHERE user_id = $1", user_id)
+        session_cache.set_summary(user_id, summary)
+        return summary
+    except Exception as e:
+        log.error(f"❌ Ошибка получения резюме диалога: {e}")
+        return None
+
+async def save_summary(user_id: int, summary: str):
+    """Сохраняет резюме диалога рядом с chat_history."""
+    if not _pool: return
+    try:
+        async with _pool.acquire() as conn:
+            await conn.execute("""
+                INSERT INTO chat_history (user_id, summary) VALUES ($1, $2)
+                ON CONFLICT (user_id) DO UPDATE SET summary = EXCLUDED.summary, updated_at = CURRENT_TIMESTAMP
+            """, user_id, summary)
+        session_cache.set_summary(user_id, summary)
+    except Exception as e:
+        log.error(f"❌ Ошибка сохранения резюме диалога: {e}")
+        session_cache.invalidate(user_id, "summary")
 
 async def add_reminder(user_id: int, text: str, remind_at):
     """Добавляет напоминание в БД."""
@@ -221,19 +254,28 @@ async def add_memory(user_id: int, content: str):
                 "INSERT INTO user_memories (user_id, content) VALUES ($1, $2)",
                 user_id, content
             )
+        session_cache.add_memory(user_id, content)
     except Exception as e:
         log.error(f"❌ Ошибка добавления памяти: {e}")
+        session_cache.invalidate(user_id, "memories")
 
 async def get_memories(user_id: int):
-    """Получает все факты из вечной памяти пользователя."""
+    """Получает все факты из вечной памяти пользователя (через кэш сессий)."""
     if not _pool: return []
+
+    cached = session_cache.get_memories(user_id)
+    if cached is not None:
+        return cached
+
     try:
         async with _pool.acquire() as conn:
             rows = await conn.fetch(
                 "SELECT content FROM user_memories WHERE user_id = $1 ORDER BY created_at ASC",
                 user_id
             )
-            return [row['content'] for row in rows]
+            memories = [row['content'] for row in rows]
+            session_cache.set_memories(user_id, memories)
+            return memories
     except Exception as e:
         log.error(f"❌ Ошибка получения памяти: {e}")
         return []
@@ -247,8 +289,59 @@ async def clear_memories(user_id: int):
                 "DELETE FROM user_memories WHERE user_id = $1",
                 user_id
             )
+        session_cache.set_memories(user_id, [])
     except Exception as e:
         log.error(f"❌ Ошибка очистки памяти: {e}")
+        session_cache.invalidate(user_id, "memories")
+
+async def get_memory_rows(user_id: int) -> list[tuple[int, str]]:
+    """Факты пользователя с их id (для поиска дублей и слияния), в порядке добавления."""
+    if not _pool: return []
+    try:
+        async with _pool.acquire() as conn:
+            rows = await conn.fetch(
+                "SELECT id, content FROM user_memories WHERE user_id = $1 ORDER BY created_at ASC, id ASC",
+                user_id
+            )
+            return [(row['id'], row['content']) for row in rows]
+    except Exception as e:
+        log.error(f"❌ Ошибка получения памяти: {e}")
+        return []
+
+async def replace_memories(user_id: int, delete_ids: list[int], content: str = None):
+    """Удаляет факты по id и (если задан content) добавляет вместо них новый — в одной транзакции."""
+    if not _pool: return
+    try:
+        async with _pool.acquire() as conn:
+            async with conn.transaction():
+                await conn.execute(
+                    "DELETE FROM user_memories WHERE user_id = $1 AND id = ANY($2::int[])",
+                    user_id, delete_ids
+                )
+                if content:
+                    await conn.execute(
+                        "INSERT INTO user_memories (user_id, content) VALUES ($1, $2)",
+                        user_id, content
+                    )
+    except Exception as e:
+        log.error(f"❌ Ошибка обновления памяти: {e}")
+    finally:
+        # Порядок и состав фактов изменились — перечитаем из БД при следующем обращении
+        session_cache.invalidate(user_id, "memories")
+
+async def get_memory_user_ids(min_count: int = 2) -> list[int]:
+    """Пользователи, у которых в памяти не меньше min_count фактов."""
+    if not _pool: return []
+    try:
+        async with _pool.acquire() as conn:
+            rows = await conn.fetch(
+                "SELECT user_id FROM user_memories GROUP BY user_id HAVING COUNT(*) >= $1",
+                min_count
+            )
+            return [row['user_id'] for row in rows]
+    except Exception as e:
+        log.error(f"❌ Ошибка получения пользователей с памятью: {e}")
+        return []
 
 async def get_stats():
     """Получает общую статистику по базе."""
@@ -0,0 +1,148 @@
+import os
+import json
+import asyncio
+import hashlib
+import logging
+from collections import OrderedDict
+from config import CACHE_DIR
+
+log = logging.getLogger(__name__)
+
+class DiskCache:
+    """Контентно-адресуемый кэш файлов на локальном диске с LRU-вытеснением по размеру.
+    Каждая запись — файл <key>.bin плюс метаданные в общем index.json (например, Telegram file_id,
+    чтобы повторно отправлять файл по id без повторной загрузки). Индекс держится в памяти,
+    файлы читаются и пишутся в потоке, чтобы не блокировать event loop.
+    """
+    def __init__(self, name: str, max_bytes: int, root: str = CACHE_DIR):
+        self.name = name
+        self.max_bytes = max_bytes
+        self.path = os.path.join(root, name)
+        self._index_path = os.path.join(self.path, "index.json")
+        self._index = OrderedDict()  # key -> {"size": int, ...метаданные}
+        self._lock = asyncio.Lock()
+        self.total_bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._load_index()
+
+    @staticmethod
+    def key(*parts) -> str:
+        """Ключ записи: sha256 от частей (модель, промпт, язык...)."""
+        return hashlib.sha256("\x1f".join(str(p) for p in parts).encode("utf-8")).hexdigest()
+
+    def _file(self, key: str) -> str:
+        return os.path.join(self.path, f"{key}.bin")
+
+    def _load_index(self):
+        try:
+            with open(self._index_path, encoding="utf-8") as f:
+                entries = json.load(f)
+        except FileNotFoundError:
+            return
+        except (OSError, ValueError) as e:
+            log.warning(f"⚠️ Индекс кэша {self.name} поврежден, начинаем с пустого: {e}")
+            return
+        for key, meta in entries:
+            if os.path.exists(self._file(key)):
+                self._index[key] = meta
+                self.total_bytes += meta.get("size", 0)
+        log.info(f"💾 Кэш {self.name}: {len(self._index)} файлов, {self.total_bytes // 1024} КБ")
+
+    def _write_index(self, entries: list):
+        tmp_path = f"{self._index_path}.tmp"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            json.dump(entries, f, ensure_ascii=False)
+        os.replace(tmp_path, self._index_path)
+
+    async def _save_index(self):
+        try:
+            await asyncio.to_thread(self._write_index, list(self._index.items()))
+        except OSError as e:
+            log.error(f"❌ Ошибка записи индекса кэша {self.name}: {e}")
+
+    def __contains__(self, key: str) -> bool:
+        return key in self._index
+
+    def meta(self, key: str) -> dict:
+        """Метаданные записи (или None), без чтения файла."""
+        return self._index.get(key)
+
+    async def get(self, key: str) -> bytes:
+        """Содержимое файла или None при промахе."""
+        if key not in self._index:
+            self.misses += 1
+            return None
+        try:
+            data = await asyncio.to_thread(self._read, key)
+        except OSError:
+            # Файл удалили снаружи — забываем запись
+            self.misses += 1
+            self.total_bytes -= self._index.pop(key, {}).get("size", 0)
+            return None
+        self._index.move_to_end(key)
+        self.hits += 1
+        return data
+
+    def _read(self, key: str) -> bytes:
+        with open(self._file(key), "rb") as f:
+            return f.read()
+
+    def _write(self, key: str, data: bytes):
+        os.makedirs(self.path, exist_ok=True)
+        tmp_path = f"{self._file(key)}.tmp"
+        with open(tmp_path, "wb") as f:
+            f.write(data)
+        os.replace(tmp_path, self._file(key))
+
+    def _remove(self, keys: list):
+        for key in keys:
+            try:
+                os.remove(self._file(key))
+            except FileNotFoundError:
+                pass
+
+    async def put(self, key: str, data: bytes, **meta):
+        """Сохраняет файл с метаданными и вытесняет самые старые записи сверх лимита."""
+        if len(data) > self.max_bytes:
+            return
+        async with self._lock:
+            try:
+                await asyncio.to_thread(self._write, key, data)
+            except OSError as e:
+                log.error(f"❌ Ошибка записи в кэш {self.name}: {e}")
+                return
+            self.total_bytes -= self._index.pop(key, {}).get("size", 0)
+            self._index[key] = {"size": len(data), **meta}
+            self.total_bytes += len(data)
+
+            evicted = []
+            while self.total_bytes > self.max_bytes and len(self._index) > 1:
+                old_key, old_meta = self._index.popitem(last=False)
+                self.total_bytes -= old_meta.get("size", 0)
+                evicted.append(old_key)
+            if evicted:
+                self.evictions += len(evicted)
+                await asyncio.to_thread(self._remove, evicted)
+            await self._save_index()
+
+    async def update(self, key: str, **meta):
+        """Дописывает метаданные существующей записи (например, file_id после отправки)."""
+        entry = self._index.get(key)
+        if entry is None:
+            return
+        async with self._lock:
+            entry.update(meta)
+            await self._save_index()
+
+    def stats(self) -> dict:
+        total = self.hits + self.misses
+        return {
+            "files": len(self._index),
+            "bytes": self.total_bytes,
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+            "hit_rate": self.hits / total if total else 0.0
+        }
@@ -0,0 +1,71 @@
+import logging
+from collections import OrderedDict
+from config import DOC_CHUNK_TOKENS, DOC_STORE_PER_USER, DOC_STORE_USERS
+from text_index import BM25Index
+from token_budget import split_text
+
+log = logging.getLogger(__name__)
+
+class IndexedDocument:
+    def __init__(self, file_name: str, chunks: list[str]):
+        self.file_name = file_name
+        self.chunks = chunks
+        self.index = BM25Index(chunks)
+
+    @classmethod
+    def from_text(cls, file_name: str, text: str) -> "IndexedDocument":
+        """Нарезает текст на куски по DOC_CHUNK_TOKENS и индексирует (CPU — можно вызывать в потоке)."""
+        return cls(file_name, split_text(text, DOC_CHUNK_TOKENS))
+
+class DocumentIndex:
+    """Хранилище загруженных документов по пользователям: текст нарезан на куски
+    по DOC_CHUNK_TOKENS и проиндексирован BM25, чтобы в промпт шли только нужные фрагменты.
+    У пользователя хранятся последние DOC_STORE_PER_USER документов, всего — DOC_STORE_USERS пользователей (LRU).
+    """
+    def __init__(self, per_user: int = DOC_STORE_PER_USER, max_users: int = DOC_STORE_USERS):
+        self.per_user = per_user
+        self.max_users = max_users
+        self._users = OrderedDict()  # user_id -> OrderedDict(file_name -> IndexedDocument)
+
+    def add(self, user_id: int, doc: IndexedDocument):
+        """Сохраняет документ пользователя как последний загруженный."""
+        docs = self._users.setdefault(user_id, OrderedDict())
+        docs.pop(doc.file_name, None)
+        docs[doc.file_name] = doc
+        while len(docs) > self.per_user:
+            docs.popitem(last=False)
+        self._users.move_to_end(user_id)
+        while len(self._users) > self.max_users:
+            self._users.popitem(last=False)
+        log.info(f"📚 Документ {doc.file_name} проиндексирован: {len(doc.chunks)} фрагментов")
+
+    def documents(self, user_id: int) -> list[str]:
+        """Имена документов пользователя, последний загруженный — последним."""
+        return list(self._users.get(user_id, {}))
+
+    def get(self, user_id: int, file_name: str) -> IndexedDocument:
+        """Документ пользователя по точному имени (или None)."""
+        return self._users.get(user_id, {}).get(file_name)
+
+    def _find(self, user_id: int, file_name: str = None) -> list[IndexedDocument]:
+        docs = self._users.get(user_id)
+        if not docs:
+            return []
+        self._users.move_to_end(user_id)
+        if not file_name:
+            return list(docs.values())
+        if file_name in docs:
+            return [docs[file_name]]
+        # Модель часто называет файл неточно — ищем по вхождению имени без учета регистра
+        needle = file_name.lower()
+        return [doc for name, doc in docs.items() if needle in name.lower() or name.lower() in needle]
+
+    def search(self, user_id: int, query: str, file_name: str = None, k: int = 4) -> list[tuple[IndexedDocument, int]]:
+        """Топ-k фрагментов по запросу: (документ, номер фрагмента), по убыванию релевантности."""
+        hits = []
+        for doc in self._find(user_id, file_name):
+            hits.extend((score, doc, i) for i, score in doc.index.search(query, k))
+        hits.sort(key=lambda hit: hit[0], reverse=True)
+        return [(doc, i) for _, doc, i in hits[:k]]
+
+doc_index = DocumentIndex()
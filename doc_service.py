@@ -1,20 +1,106 @@
-import fitz  # PyMuPDF
+import os
+import sys
+import json
+import math
+import asyncio
+import hashlib
 import logging
-import io
+from typing import AsyncIterator
+from config import (
+    DOC_WORKERS, DOC_WORKER_TIMEOUT, DOC_PAGES_PER_TASK, DOC_MAX_PAGES, DOC_MAX_BYTES, DOC_TOP_K, DOC_CHUNK_TOKENS, DOC_CACHE_MAX_BYTES,
+    DOC_STORE_PER_USER
+)
+from doc_index import doc_index, IndexedDocument
+from disk_cache import DiskCache
 
 log = logging.getLogger(__name__)
 
+# Легкий модуль-воркер: дочерний процесс импортирует только PyMuPDF, а не bot.py и сервисы
+PDF_WORKER = os.path.join(os.path.dirname(os.path.abspath(__file__)), "pdf_worker.py")
+
 class DocumentService:
-    @staticmethod
-    async def extract_text_from_pdf(pdf_bytes: bytes) -> str:
+    def __init__(self):
+        # PyMuPDF держит GIL — парсим в отдельных процессах (pdf_worker.py), чтобы не замораживать event loop
+        self._workers = asyncio.Semaphore(DOC_WORKERS)
+        # Извлеченный текст (по хэшу содержимого), ссылки file_unique_id -> хэш, нарезка на фрагменты
+        # и списки документов пользователей (имя файла -> ключ нарезки), чтобы analyze_doc пережил рестарт
+        self.cache = DiskCache("docs", DOC_CACHE_MAX_BYTES)
+        self._restored = set()  # пользователи, чьи документы уже подняты с диска в doc_index
+
+    async def cached_text(self, file_unique_id: str) -> str:
+        """Текст уже прочитанного файла по Telegram file_unique_id — без скачивания и разбора (или None)."""
+        content_hash = await self.cache.get(self.cache.key("file", file_unique_id))
+        if content_hash is None:
+            return None
+        text = await self.cache.get(self.cache.key("text", content_hash.decode()))
+        return text.decode("utf-8") if text is not None else None
+
+    async def _run_worker(self, pdf_bytes: bytes, start: int, end: int) -> dict:
+        """Текст страниц [start, end) в процессе pdf_worker.py: {"pages": всего страниц, "texts": [...]}.
+        Зависший на битом PDF процесс убивается через DOC_WORKER_TIMEOUT и не держит слот DOC_WORKERS.
+        """
+        async with self._workers:
+            proc = await asyncio.create_subprocess_exec(
+                sys.executable, PDF_WORKER, str(start), str(end),
+                stdin=asyncio.subprocess.PIPE, stdout=asyncio.subprocess.PIPE, stderr=asyncio.subprocess.PIPE,
+            )
+            try:
+                out, err = await asyncio.wait_for(proc.communicate(pdf_bytes), DOC_WORKER_TIMEOUT)
+            except asyncio.TimeoutError:
+                raise RuntimeError(f"страницы {start + 1}–{end} не разобраны за {DOC_WORKER_TIMEOUT:.0f} с")
+            finally:
+                if proc.returncode is None:
+                    proc.kill()
+                    await proc.wait()
+        if proc.returncode != 0:
+            lines = err.decode("utf-8", errors="ignore").strip().splitlines()
+            raise RuntimeError(lines[-1] if lines else f"процесс разбора завершился с кодом {proc.returncode}")
+        return json.loads(out)
+
+    async def iter_pdf_pages(self, pdf_bytes: bytes) -> AsyncIterator[tuple[int, str]]:
+        """Отдает (всего страниц в PDF, текст страницы) по порядку, по мере извлечения.
+        Первые DOC_PAGES_PER_TASK страниц (и число страниц) — одним процессом: небольшой PDF на этом и заканчивается.
+        Остаток делится примерно на DOC_WORKERS диапазонов, которые разбираются параллельно (каждый процесс
+        получает файл один раз); страницы диапазона отдаются, как только он готов и все предыдущие отданы.
+        Страницы сверх DOC_MAX_PAGES пропускаются.
+        """
+        first = await self._run_worker(pdf_bytes, 0, min(DOC_PAGES_PER_TASK, DOC_MAX_PAGES))
+        total = first["pages"]
+        pages = min(total, DOC_MAX_PAGES)
+        if pages < total:
+            log.warning(f"⚠️ PDF: {total} страниц, читаем первые {pages}")
+
+        done = len(first["texts"])
+        tasks = []
+        rest = pages - done
+        if rest > 0:
+            workers = min(DOC_WORKERS, math.ceil(rest / DOC_PAGES_PER_TASK))
+            step = math.ceil(rest / workers)
+            tasks = [
+                asyncio.create_task(self._run_worker(pdf_bytes, start, min(start + step, pages)))
+                for start in range(done, pages, step)
+            ]
+        try:
+            for page_text in first["texts"]:
+                yield total, page_text
+            for task in tasks:
+                for page_text in (await task)["texts"]:
+                    yield total, page_text
+        finally:
+            # Потребитель остановился или разбор упал — остальные процессы не нужны
+            for task in tasks:
+                task.cancel()
+
+    async def extract_text_from_pdf(self, pdf_bytes: bytes) -> str:
         """Извлекает текст из PDF файла."""
         try:
-            doc = fitz.open(stream=pdf_bytes, filetype="pdf")
-            text = ""
-            for page in doc:
-                text += page.get_text()
-            doc.close()
-            return text.strip()
+            pages, total = [], 0
+            async for total, page_text in self.iter_pdf_pages(pdf_bytes):
+                pages.append(page_text)
+            text = "".join(pages).strip()
+            if total > len(pages):
+                text += f"\n\n[Прочитаны первые {len(pages)} из {total} страниц]"
+            return text
         except Exception as e:
             log.error(f"Error parsing PDF: {e}")
             return f"⚠️ Ошибка при чтении PDF: {str(e)}"
@@ -28,13 +114,92 @@ class DocumentService:
             log.error(f"Error parsing TXT: {e}")
             return f"⚠️ Ошибка при чтении TXT: {str(e)}"
 
-    async def get_document_content(self, file_bytes: bytes, file_name: str) -> str:
-        """Определяет тип файла и извлекает контент."""
-        if file_name.lower().endswith('.pdf'):
-            return await self.extract_text_from_pdf(file_bytes)
-        elif file_name.lower().endswith('.txt'):
-            return await self.extract_text_from_txt(file_bytes)
+    async def get_document_content(self, file_bytes: bytes, file_name: str, file_unique_id: str = None) -> str:
+        """Определяет тип файла и извлекает контент.
+        Результат кэшируется по хэшу содержимого (и по file_unique_id, если он передан):
+        тот же файл, присланный повторно или переслан другим пользователем, не разбирается заново.
+        """
+        if len(file_bytes) > DOC_MAX_BYTES:
+            return f"⚠️ Файл слишком большой (больше {DOC_MAX_BYTES // (1024 * 1024)} МБ)."
+
+        content_hash = await asyncio.to_thread(lambda: hashlib.sha256(file_bytes).hexdigest())
+        text_key = self.cache.key("text", content_hash)
+        cached = await self.cache.get(text_key)
+        if cached is not None:
+            log.info(f"📄 Документ {file_name} из кэша")
+            text = cached.decode("utf-8")
+        else:
+            if file_name.lower().endswith('.pdf'):
+                text = await self.extract_text_from_pdf(file_bytes)
+            elif file_name.lower().endswith('.txt'):
+                text = await self.extract_text_from_txt(file_bytes)
+            else:
+                return "❌ Поддерживаются только PDF и TXT файлы."
+            if text.startswith(("⚠️", "❌")):
+                return text
+            await self.cache.put(text_key, text.encode("utf-8"), file_name=file_name)
+
+        if file_unique_id:
+            await self.cache.put(self.cache.key("file", file_unique_id), content_hash.encode())
+        return text
+
+    async def index(self, user_id: int, file_name: str, text: str) -> IndexedDocument:
+        """Нарезает и индексирует документ для analyze_doc (в потоке — большие тексты индексируются заметное время).
+        Нарезка кэшируется на диске по хэшу текста, BM25-индекс по готовым фрагментам строится быстро.
+        """
+        chunks_key = self.cache.key("chunks", DOC_CHUNK_TOKENS, hashlib.sha256(text.encode("utf-8")).hexdigest())
+        cached = await self.cache.get(chunks_key)
+        if cached is not None:
+            doc = await asyncio.to_thread(IndexedDocument, file_name, json.loads(cached))
         else:
-            return "❌ Поддерживаются только PDF и TXT файлы."
+            doc = await asyncio.to_thread(IndexedDocument.from_text, file_name, text)
+            await self.cache.put(chunks_key, json.dumps(doc.chunks, ensure_ascii=False).encode("utf-8"))
+        await self._restore(user_id)
+        doc_index.add(user_id, doc)
+        await self._remember_document(user_id, file_name, chunks_key)
+        return doc
+
+    async def _stored_documents(self, user_id: int) -> list[list[str]]:
+        """Сохраненный на диске список документов пользователя: [[имя файла, ключ нарезки], ...], последний — новейший."""
+        stored = await self.cache.get(self.cache.key("user_docs", user_id))
+        return json.loads(stored) if stored is not None else []
+
+    async def _remember_document(self, user_id: int, file_name: str, chunks_key: str):
+        docs = [d for d in await self._stored_documents(user_id) if d[0] != file_name]
+        docs.append([file_name, chunks_key])
+        data = json.dumps(docs[-DOC_STORE_PER_USER:], ensure_ascii=False).encode("utf-8")
+        await self.cache.put(self.cache.key("user_docs", user_id), data)
+
+    async def _restore(self, user_id: int):
+        """После рестарта doc_index пуст: один раз на процесс поднимаем документы пользователя
+        из дискового кэша (BM25 по готовым фрагментам строится быстро). Вытесненные из кэша пропускаются.
+        """
+        if user_id in self._restored:
+            return
+        self._restored.add(user_id)
+        for file_name, chunks_key in await self._stored_documents(user_id):
+            doc = doc_index.get(user_id, file_name)
+            if doc is None:
+                cached = await self.cache.get(chunks_key)
+                if cached is None:
+                    log.warning(f"⚠️ Документ {file_name} пользователя {user_id} вытеснен из кэша")
+                    continue
+                doc = await asyncio.to_thread(IndexedDocument, file_name, json.loads(cached))
+            # Добавляем по порядку загрузки, чтобы последний загруженный остался последним
+            doc_index.add(user_id, doc)
+
+    async def analyze(self, user_id: int, query: str, file_name: str = None) -> str:
+        """Инструмент analyze_doc: самые релевантные запросу фрагменты загруженных документов."""
+        await self._restore(user_id)
+        names = doc_index.documents(user_id)
+        if not names:
+            if await self._stored_documents(user_id):
+                return "⚠️ Загруженные ранее документы больше недоступны. Попроси прислать файл заново."
+            return "⚠️ Пользователь еще не загружал документы. Попроси прислать файл (PDF или TXT)."
+        hits = doc_index.search(user_id, query, file_name, k=DOC_TOP_K)
+        if not hits:
+            return f"В документах ({', '.join(names)}) не найдено фрагментов по запросу «{query}»."
+        parts = [f"📄 {doc.file_name}, фрагмент {i + 1}/{len(doc.chunks)}:\n{doc.chunks[i]}" for doc, i in hits]
+        return "\n\n---\n\n".join(parts)
 
 doc_tool = DocumentService()
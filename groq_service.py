@@ -1,17 +1,29 @@
-import os
+import asyncio
 import logging
-import httpx
 import json
 import base64
 import re
 import datetime
-from groq import AsyncGroq
-from config import GROQ_API_KEY, DEFAULT_MODEL
+import time
+from collections import deque
+from typing import BinaryIO, Callable, Awaitable
+from groq import AsyncGroq, AsyncStream, RateLimitError
+from config import (
+    GROQ_API_KEY, DEFAULT_MODEL, HEDGE_PATHS, HEDGE_PERCENTILE, HEDGE_MIN_DELAY,
+    HEDGE_DEFAULT_DELAY, HEDGE_MIN_SAMPLES, HEDGE_BACKUP_MODEL, STT_MAX_PARALLEL, STT_SEGMENT_SECONDS,
+    DOC_INLINE_TOKENS, DOC_CHUNK_TOKENS, DOC_MAP_REDUCE, DOC_MAP_CHUNK_TOKENS, DOC_MAP_MAX_TOKENS,
+    DOC_MAP_CONCURRENCY, DOC_MAP_MAX_CHUNKS, DOC_MAP_MAX_WAIT, DOC_MAP_MIN_COVERAGE
+)
 import database as db
 from search_service import search_tool
+from memory_service import memory_service
 from doc_service import doc_tool
-from image_service import image_gen
+from image_queue import image_queue
 from calendar_service import calendar_service
+import audio_split
+from token_budget import fit_context, schema_tokens, truncate_text, message_tokens, count_tokens, split_text
+from model_scheduler import scheduler, parse_duration
+from http_clients import http_clients
 
 log = logging.getLogger(__name__)
 
@@ -26,6 +38,35 @@ PRICING = {
     "meta-llama/llama-4-scout-17b-16e-instruct": (0.15, 0.15),
     "default": (0.10, 0.10)
 }
+# Бюджет токенов на промпт (история + системный промпт + схемы инструментов) по моделям
+CONTEXT_BUDGETS = {
+    "llama-3.3-70b-versatile": 6000,
+    "llama-3.1-8b-instant": 4000,
+    "qwen/qwen3-32b": 6000,
+    "meta-llama/llama-4-maverick-17b-128e-instruct": 8000,
+    "meta-llama/llama-4-scout-17b-16e-instruct": 8000,
+    "default": 6000
+}
+
+# Запасная модель, на которую планировщик переводит запросы при нехватке лимитов
+FALLBACK_MODEL = "llama-3.1-8b-instant"
+# Сколько токенов ответа резервировать в лимитах, если max_tokens не задан
+COMPLETION_ESTIMATE = 512
+
+# Модель и лимиты для фонового сжатия старой истории в резюме
+SUMMARY_MODEL = "llama-3.1-8b-instant"
+SUMMARY_MAX_TOKENS = 600
+
+# Map-reduce для больших документов: части конспектирует быстрая модель, ответ дает 70B
+DOC_MAP_PROMPT = (
+    "Ты конспектируешь часть большого документа. Сожми фрагмент в плотный конспект: "
+    "ключевые факты, цифры, даты, имена, определения и выводы. Без вступлений. Пиши на языке документа."
+)
+DOC_REDUCE_PROMPT = (
+    "Ниже конспекты нескольких последовательных частей одного документа. Объедини их в один связный конспект, "
+    "сохранив все важные факты и цифры и убрав повторы. Без вступлений."
+)
+
 # Определение инструментов (Tools) для агента
 TOOLS = [
     {
@@ -86,14 +127,14 @@ TOOLS = [
         "type": "function",
         "function": {
             "name": "analyze_doc",
-            "description": "Analyze the content of a previously uploaded document.",
+            "description": "Search previously uploaded documents and return the passages most relevant to the query.",
             "parameters": {
                 "type": "object",
                 "properties": {
-                    "path": {"type": "string", "description": "Path to the document file."},
-                    "query": {"type": "string", "description": "What to look for or analyze in the document."}
+                    "query": {"type": "string", "description": "What to look for or analyze in the document."},
+                    "file_name": {"type": "string", "description": "Optional name of the document to search in. Omit to search all uploaded documents."}
                 },
-                "required": ["path", "query"]
+                "required": ["query"]
             }
         }
     },
@@ -171,6 +212,14 @@ TOOLS = [
     }
 ]
 
+# Таймауты инструментов агента (секунды)
+TOOL_TIMEOUTS = {
+    "search_web": 30,
+    "summarize_channel": 15,
+    "analyze_doc": 30,
+    "default": 20
+}
+
 # Пресеты персонажей
 CHARACTERS = {
     "default": "You are GroqPulse, an advanced AI Agent. You are helpful, polite, and efficient.",
@@ -181,36 +230,40 @@ CHARACTERS = {
 
 class GroqService:
     def __init__(self):
-        proxy = os.getenv("PROXY")
-        if proxy:
-            log.info(f"🌐 Используется прокси для Groq: {proxy}")
-            http_client = httpx.AsyncClient(proxies=proxy)
-            self.client = AsyncGroq(api_key=GROQ_API_KEY, http_client=http_client)
-        else:
-            self.client = AsyncGroq(api_key=GROQ_API_KEY)
-            
-        self.max_context = 10
+        # Общий keep-alive пул (и прокси из PROXY, если задан) — см. http_clients
+        self.client = AsyncGroq(api_key=GROQ_API_KEY, http_client=http_clients.groq)
 
-    async def get_response(self, user_id: int, user_text: str) -> tuple[str, list]:
-        """Получает ответ от ИИ-агента с поддержкой инструментов.
-        Возвращает кортеж (текст_ответа, список_медиа).
+        # Схемы инструментов отправляются с каждым запросом агента — учитываем их в бюджете
+        self.tools_tokens = schema_tokens(TOOLS)
+
+        # Задержки ответов по (модель, путь, стриминг) — для дедлайна hedged-запросов — и статистика хеджей
+        self._latencies = {}  # (model, path, stream) -> deque задержек
+        self.hedge_stats = {"fired": 0, "won": 0, "lost": 0}
+
+        # Фоновое сжатие истории: ссылки на задачи (чтобы их не собрал GC) и по замку на пользователя
+        self._compaction_tasks = set()
+        self._compaction_locks = {}
+
+    async def _prepare_chat(self, user_id: int, user_text: str) -> tuple[list, str, list]:
+        """Собирает историю с системным промптом и новым сообщением пользователя.
+        Возвращает кортеж (история, модель, вытесненные_сообщения); сообщение пользователя — последнее в истории.
         """
-        if not GROQ_API_KEY:
-            return "❌ GROQ_API_KEY не задан в настройках.", []
-        
-        media_to_send = []
-        
         # Получаем данные пользователя
         history, user_model, _, character = await db.get_user_data(user_id)
         current_model = user_model or DEFAULT_MODEL
         current_char = character or "default"
 
-        # Получаем Вечную Память
-        memories = await db.get_memories(user_id)
+        # Получаем Вечную Память: только факты, относящиеся к сообщению (и несколько последних)
+        memories = await memory_service.relevant(user_id, user_text)
         memory_context = ""
         if memories:
             memory_context = "\n\n[USER ETERNAL MEMORY]:\n" + "\n".join([f"- {m}" for m in memories])
 
+        # Резюме старой части диалога, вытесненной из окна контекста
+        summary = await db.get_summary(user_id)
+        if summary:
+            memory_context += f"\n\n[CONVERSATION SUMMARY]:\n{summary}"
+
         # Системный промпт для Агента
         char_prompt = CHARACTERS.get(current_char, CHARACTERS["default"])
         system_content = (
@@ -222,6 +275,7 @@ class GroqService:
             "4. To set a reminder, use 'add_reminder'.\n"
             "5. To save a fact about user, use 'save_memory'.\n"
             "6. To generate an image or drawing, use 'generate_image'.\n"
+            "7. To answer questions about a document the user uploaded, use 'analyze_doc'.\n"
             "Always answer in the language the user speaks to you. "
             "If the user asks to draw, visualize, or show something, USE 'generate_image'. "
             "IMPORTANT: When you receive input from voice transcription, be decisive and execute commands (like reminders or searches) immediately if requested."
@@ -229,137 +283,255 @@ class GroqService:
             f"{memory_context}"
         )
 
-        system_prompt = {"role": "system", "content": system_content}
+        # В БД хранится только окно диалога, системный промпт собирается заново на каждый ход
+        history = [{"role": "system", "content": system_content}] + history
+        history.append({"role": "user", "content": user_text})
 
-        if not history:
-            history = [system_prompt]
-        else:
-            history[0] = system_prompt
+        history, evicted = fit_context(history, self._context_budget(current_model), reserved=self.tools_tokens)
+        return history, current_model, evicted
 
-        history.append({"role": "user", "content": user_text})
+    @staticmethod
+    async def _save_turn(user_id: int, history: list, turn_start: int):
+        """Дописывает в лог сообщения хода (history[turn_start:]). Окно истории в БД —
+        все сообщения контекста, кроме системного (history[0]).
+        """
+        await db.append_messages(user_id, history[turn_start:], keep_last=len(history) - 1)
+
+    def _context_budget(self, model: str) -> int:
+        """Бюджет токенов на промпт для модели."""
+        return CONTEXT_BUDGETS.get(model, CONTEXT_BUDGETS["default"])
+
+    async def _create_completion(self, messages: list, model: str, fallback: str = FALLBACK_MODEL,
+                                 path: str = None, user_id: int = None, max_wait: float = None, **kwargs):
+        """Запрос к Groq через планировщик лимитов (model_scheduler).
+        Планировщик заранее резервирует RPM/TPM и при нехватке лимита ставит запрос в очередь
+        или переводит его на fallback, не дожидаясь 429.
+        Для путей из HEDGE_PATHS (chat / vision / doc) запрос хеджируется, см. _hedged_completion.
+        max_wait — предел ожидания в очереди планировщика для фоновых задач (только без хеджирования).
+        Возвращает кортеж (ответ, фактически_использованная_модель).
+        """
+        est_tokens = sum(message_tokens(m) for m in messages) + kwargs.get("max_tokens", COMPLETION_ESTIMATE)
+        if kwargs.get("tools"):
+            est_tokens += self.tools_tokens
 
-        if len(history) > self.max_context + 1:
-            history = [history[0]] + history[-self.max_context:]
+        if path in HEDGE_PATHS:
+            return await self._hedged_completion(messages, model, fallback, est_tokens, user_id, path, **kwargs)
+        return await self._send_completion(messages, model, fallback, est_tokens, path=path, max_wait=max_wait, **kwargs)
 
+    async def _send_completion(self, messages: list, model: str, fallback: str, est_tokens: int,
+                               path: str = None, max_wait: float = None, **kwargs):
+        """Один запрос через планировщик; успешные задержки запоминаются для дедлайна хеджирования."""
+        used_model = await scheduler.acquire(model, est_tokens, fallback, max_wait)
+        started = time.monotonic()
         try:
-            try:
-                response = await self.client.chat.completions.create(
-                    messages=history,
-                    model=current_model,
-                    tools=TOOLS,
-                    tool_choice="auto",
-                    temperature=0.7,
-                )
-            except Exception as e:
-                if "rate_limit_exceeded" in str(e).lower() and current_model != "llama-3.1-8b-instant":
-                    log.warning(f"⚠️ Лимит {current_model} исчерпан. Переключаюсь на 8b-instant...")
-                    response = await self.client.chat.completions.create(
-                        messages=history,
-                        model="llama-3.1-8b-instant",
-                        tools=TOOLS,
-                        tool_choice="auto",
-                        temperature=0.7,
-                    )
-                    current_model = "llama-3.1-8b-instant" # Update model for usage recording
-                else:
-                    raise e
-            
+            raw = await self.client.chat.completions.with_raw_response.create(messages=messages, model=used_model, **kwargs)
+        except RateLimitError as e:
+            # Локальные бакеты разошлись с Groq: фиксируем паузу и делаем одну повторную попытку через планировщик
+            scheduler.penalize(used_model, parse_duration(e.response.headers.get("retry-after")))
+            if not fallback or used_model == fallback:
+                raise e
+            used_model = await scheduler.acquire(model, est_tokens, fallback, max_wait)
+            started = time.monotonic()
+            raw = await self.client.chat.completions.with_raw_response.create(messages=messages, model=used_model, **kwargs)
+
+        # Для стриминга это время до заголовков ответа, т.е. почти время до первого токена, иначе — время
+        # всего ответа: выборки разные, поэтому задержки хранятся отдельно по (модель, путь, стриминг)
+        key = (used_model, path, bool(kwargs.get("stream")))
+        self._latencies.setdefault(key, deque(maxlen=200)).append(time.monotonic() - started)
+        scheduler.update(used_model, raw.headers)
+        return await raw.parse(), used_model
+
+    def _hedge_delay(self, model: str, path: str = None, stream: bool = False) -> float:
+        """Дедлайн хеджирования: перцентиль HEDGE_PERCENTILE недавних задержек модели на этом пути
+        (стриминг и обычные ответы — отдельно)."""
+        samples = self._latencies.get((model, path, stream))
+        if not samples or len(samples) < HEDGE_MIN_SAMPLES:
+            return HEDGE_DEFAULT_DELAY
+        ordered = sorted(samples)
+        return max(ordered[min(int(len(ordered) * HEDGE_PERCENTILE), len(ordered) - 1)], HEDGE_MIN_DELAY)
+
+    async def _hedged_completion(self, messages: list, model: str, fallback: str, est_tokens: int, user_id: int,
+                                 path: str, **kwargs):
+        """Hedged request: если основной запрос не ответил к дедлайну, параллельно шлем запасной
+        (та же модель или fallback, см. HEDGE_BACKUP_MODEL) и берем первый успешный ответ.
+        Проигравший отменяется; если он все же успел завершиться, его расход тоже записывается.
+        """
+        delay = self._hedge_delay(model, path, bool(kwargs.get("stream")))
+        primary = asyncio.create_task(self._send_completion(messages, model, fallback, est_tokens, path=path, **kwargs))
+        done, _ = await asyncio.wait({primary}, timeout=delay)
+        backup_model = fallback if HEDGE_BACKUP_MODEL == "fallback" and fallback else model
+        # Под давлением лимитов хедж только удвоит нагрузку — тогда просто ждем основной запрос
+        if done or not scheduler.has_capacity(backup_model, est_tokens):
+            return await primary
+
+        self.hedge_stats["fired"] += 1
+        log.info(f"🏁 {model} ({path}) не ответила за {delay:.1f}с — отправляю hedge-запрос на {backup_model}")
+        backup = asyncio.create_task(self._send_completion(messages, backup_model, None, est_tokens, path=path, **kwargs))
+
+        pending = {primary, backup}
+        winner = None
+        error = None
+        try:
+            while pending and winner is None:
+                done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                for task in done:
+                    if task.exception():
+                        error = task.exception()
+                    elif winner is None:
+                        winner = task
+                    else:
+                        await self._discard_completion(task.result(), user_id)
+        finally:
+            for task in pending:
+                task.cancel()
+
+        if winner is None:
+            raise error
+        self.hedge_stats["won" if winner is backup else "lost"] += 1
+        return winner.result()
+
+    async def _discard_completion(self, result: tuple, user_id: int):
+        """Закрывает ответ проигравшего hedge-запроса, учитывая уже потраченные токены."""
+        response, used_model = result
+        if isinstance(response, AsyncStream):
+            await response.close()
+        elif user_id:
+            await self._record_usage(user_id, used_model, response.usage)
+
+    async def _dispatch_tool(self, user_id: int, function_name: str, function_args: dict) -> str:
+        """Выполняет один инструмент. Возвращает результат для модели."""
+        tool_content = ""
+
+        if function_name == "search_web":
+            query = function_args.get("query")
+            log.info(f"🔍 Агент ищет в сети: {query}")
+            tool_content = await search_tool.search(query)
+
+        elif function_name == "get_current_time":
+            tool_content = await self.tool_get_current_time()
+            log.info(f"🕒 Агент запрашивает время")
+
+        elif function_name == "calculate_math":
+            tool_content = await self.tool_calculate_math(function_args.get("expression"))
+            log.info(f"🔢 Агент вычисляет математику")
+
+        elif function_name == "add_reminder":
+            tool_content = await self.tool_add_reminder(user_id, **function_args)
+            log.info(f"📅 Агент ставит напоминание")
+
+        elif function_name == "save_memory":
+            tool_content = await self.tool_save_memory(user_id, function_args.get("content"))
+            log.info(f"🧠 Агент сохраняет факт в память")
+
+        elif function_name == "summarize_channel":
+            tool_content = await self.tool_summarize_channel(function_args.get("channel_name"))
+            log.info(f"🔗 Агент читает канал: {function_args.get('channel_name')}")
+
+        elif function_name == "analyze_doc":
+            query = function_args.get("query")
+            file_name = function_args.get("file_name")
+            log.info(f"📄 Агент ищет в документах ({file_name or 'все'}): {query}")
+            tool_content = await doc_tool.analyze(user_id, query, file_name)
+
+        elif function_name == "generate_image":
+            prompt = function_args.get("prompt")
+            log.info(f"🎨 Агент рисует: {prompt}")
+            tool_content = await self.tool_generate_image(user_id, prompt)
+
+        elif function_name == "list_calendar_events":
+            max_res = function_args.get("max_results", 5)
+            log.info(f"📅 Агент читает календарь")
+            tool_content = await calendar_service.list_events(user_id, max_res)
+
+        elif function_name == "create_calendar_event":
+            log.info(f"📅 Агент создает событие в календаре")
+            tool_content = await calendar_service.create_event(user_id, **function_args)
+
+        return tool_content
+
+    async def _run_tool(self, user_id: int, tool_call: dict) -> str:
+        """Запускает инструмент с таймаутом; ошибки превращает в текст для модели."""
+        function_name = tool_call["function"]["name"]
+        timeout = TOOL_TIMEOUTS.get(function_name, TOOL_TIMEOUTS["default"])
+        try:
+            function_args = json.loads(tool_call["function"]["arguments"] or "{}")
+            return await asyncio.wait_for(self._dispatch_tool(user_id, function_name, function_args), timeout)
+        except asyncio.TimeoutError:
+            log.warning(f"⏱ Инструмент {function_name} не уложился в {timeout}с")
+            return f"❌ Инструмент {function_name} не ответил за {timeout} секунд."
+        except Exception as e:
+            log.error(f"Tool {function_name} Error: {e}")
+            return f"❌ Ошибка инструмента {function_name}: {str(e)}"
+
+    async def _run_tool_calls(self, user_id: int, content: str, tool_calls: list, history: list):
+        """Выполняет вызовы инструментов параллельно и добавляет их результаты в историю.
+        tool_calls — список в формате истории: {"id", "type", "function": {"name", "arguments"}}.
+        Результаты добавляются в порядке tool_calls, независимо от того, какой инструмент закончил первым.
+        """
+        history.append({
+            "role": "assistant",
+            "content": content,
+            "tool_calls": tool_calls
+        })
+
+        # gather отменит оставшиеся инструменты, если сам ход агента будет отменен
+        results = await asyncio.gather(*(self._run_tool(user_id, tool_call) for tool_call in tool_calls))
+
+        for tool_call, tool_content in zip(tool_calls, results):
+            history.append({
+                "role": "tool",
+                "tool_call_id": tool_call["id"],
+                "name": tool_call["function"]["name"],
+                "content": tool_content,
+            })
+
+    def _agent_error_text(self, e: Exception) -> str:
+        """Человекочитаемое сообщение об ошибке агента."""
+        err_str = str(e).lower()
+        if "forbidden" in err_str or "access denied" in err_str:
+            return "❌ **Ошибка доступа (403).**\nGroq блокирует запросы из вашего региона."
+        if "rate_limit_exceeded" in err_str:
+            return "🚨 **Лимит запросов исчерпан.**\nВсе доступные модели Groq сейчас перегружены. Пожалуйста, подождите 15-20 минут."
+        return f"⚠️ Ошибка ИИ-агента: {str(e)}"
+
+    async def get_response(self, user_id: int, user_text: str) -> str:
+        """Получает ответ от ИИ-агента с поддержкой инструментов.
+        Картинки инструмент generate_image ставит в image_queue — они приходят отдельным сообщением.
+        """
+        if not GROQ_API_KEY:
+            return "❌ GROQ_API_KEY не задан в настройках."
+        
+        history, current_model, evicted = await self._prepare_chat(user_id, user_text)
+        turn_start = len(history) - 1
+
+        try:
+            response, current_model = await self._create_completion(
+                history, current_model, path="chat", user_id=user_id,
+                tools=TOOLS,
+                tool_choice="auto",
+                temperature=0.7,
+            )
             await self._record_usage(user_id, current_model, response.usage)
 
             response_message = response.choices[0].message
             tool_calls = response_message.tool_calls
 
             if tool_calls:
-                history.append({
-                    "role": "assistant",
-                    "content": response_message.content,
-                    "tool_calls": [
-                        {
-                            "id": tool.id,
-                            "type": "function",
-                            "function": {
-                                "name": tool.function.name,
-                                "arguments": tool.function.arguments
-                            }
-                        } for tool in tool_calls
-                    ]
-                })
-                
-                for tool_call in tool_calls:
-                    function_name = tool_call.function.name
-                    function_args = json.loads(tool_call.function.arguments)
-                    tool_content = ""
-
-                    if function_name == "search_web":
-                        query = function_args.get("query")
-                        log.info(f"🔍 Агент ищет в сети: {query}")
-                        tool_content = await search_tool.search(query)
-                    
-                    elif function_name == "get_current_time":
-                        tool_content = await self.tool_get_current_time()
-                        log.info(f"🕒 Агент запрашивает время")
-
-                    elif function_name == "calculate_math":
-                        tool_content = await self.tool_calculate_math(function_args.get("expression"))
-                        log.info(f"🔢 Агент вычисляет математику")
-                    
-                    elif function_name == "add_reminder":
-                        tool_content = await self.tool_add_reminder(user_id, **function_args)
-                        log.info(f"📅 Агент ставит напоминание")
-                    
-                    elif function_name == "summarize_channel":
-                        tool_content = await self.tool_summarize_channel(function_args.get("channel_name"))
-                        log.info(f"🔗 Агент читает канал: {function_args.get('channel_name')}")
-
-                    elif function_name == "analyze_doc":
-                        path = function_args.get("path")
-                        query = function_args.get("query")
-                        log.info(f"📄 Агент анализирует файл: {path}")
-                        tool_content = await doc_tool.analyze(path, query)
-
-                    elif function_name == "generate_image":
-                        prompt = function_args.get("prompt")
-                        log.info(f"🎨 Агент рисует: {prompt}")
-                        img_bytes, used_model, used_prompt = await self.tool_generate_image(user_id, prompt)
-                        media_to_send.append({
-                            "type": "photo",
-                            "data": img_bytes,
-                            "caption": f"✨ Модель: {used_model}\n🎨 Агент нарисовал: {used_prompt}"
-                        })
-                        tool_content = f"Успешно сгенерировано и отправлено изображение по запросу: {used_prompt}"
-
-                    elif function_name == "list_calendar_events":
-                        max_res = function_args.get("max_results", 5)
-                        log.info(f"📅 Агент читает календарь")
-                        tool_content = await calendar_service.list_events(user_id, max_res)
-
-                    elif function_name == "create_calendar_event":
-                        log.info(f"📅 Агент создает событие в календаре")
-                        tool_content = await calendar_service.create_event(user_id, **function_args)
-
-                    history.append({
-                        "role": "tool",
-                        "tool_call_id": tool_call.id,
-                        "name": function_name,
-                        "content": tool_content,
-                    })
+                await self._run_tool_calls(user_id, response_message.content, [
+                    {
+                        "id": tool.id,
+                        "type": "function",
+                        "function": {
+                            "name": tool.function.name,
+                            "arguments": tool.function.arguments
+                        }
+                    } for tool in tool_calls
+                ], history)
 
                 # Второй запрос тоже с фоллбэком
-                try:
-                    second_response = await self.client.chat.completions.create(
-                        messages=history,
-                        model=current_model,
-                    )
-                except Exception as e:
-                    if "rate_limit_exceeded" in str(e).lower() and current_model != "llama-3.1-8b-instant":
-                        second_response = await self.client.chat.completions.create(
-                            messages=history,
-                            model="llama-3.1-8b-instant",
-                        )
-                        current_model = "llama-3.1-8b-instant" # Update model for usage recording
-                    else:
-                        raise e
-                
+                second_response, current_model = await self._create_completion(
+                    history, current_model, path="chat", user_id=user_id
+                )
                 await self._record_usage(user_id, current_model, second_response.usage)
                 ai_response = second_response.choices[0].message.content
             else:
@@ -369,22 +541,135 @@ class GroqService:
             ai_response = self._clean_response(ai_response)
 
             history.append({"role": "assistant", "content": ai_response})
-            await db.save_user_data(user_id, history)
-            return ai_response, media_to_send
+            await self._save_turn(user_id, history, turn_start)
+            self._schedule_compaction(user_id, evicted)
+            return ai_response
             
         except Exception as e:
             log.error(f"Groq Agent Error: {e}", exc_info=True)
-            err_str = str(e).lower()
-            if "forbidden" in err_str or "access denied" in err_str:
-                return "❌ **Ошибка доступа (403).**\nGroq блокирует запросы из вашего региона.", []
-            if "rate_limit_exceeded" in err_str:
-                return "🚨 **Лимит запросов исчерпан.**\nВсе доступные модели Groq сейчас перегружены. Пожалуйста, подождите 15-20 минут.", []
-            return f"⚠️ Ошибка ИИ-агента: {str(e)}", []
+            return self._agent_error_text(e)
+
+    async def stream_response(self, user_id: int, user_text: str):
+        """Потоковый вариант get_response (stream=True): отдает куски текста по мере генерации."""
+        if not GROQ_API_KEY:
+            yield "❌ GROQ_API_KEY не задан в настройках."
+            return
+
+        history, current_model, evicted = await self._prepare_chat(user_id, user_text)
+        turn_start = len(history) - 1
+        streamed = False
+
+        try:
+            stream, current_model = await self._create_completion(
+                history, current_model, path="chat", user_id=user_id,
+                tools=TOOLS,
+                tool_choice="auto",
+                temperature=0.7,
+                stream=True,
+            )
+            content = ""
+            tool_calls = {}
+            usage = None
+            async for chunk in stream:
+                if chunk.x_groq and chunk.x_groq.usage:
+                    usage = chunk.x_groq.usage
+                if not chunk.choices:
+                    continue
+                delta = chunk.choices[0].delta
+                if delta.content:
+                    content += delta.content
+                    streamed = True
+                    yield delta.content
+                # Вызовы инструментов приходят кусками, собираем их по индексу
+                for tc in delta.tool_calls or []:
+                    call = tool_calls.setdefault(tc.index, {
+                        "id": "", "type": "function", "function": {"name": "", "arguments": ""}
+                    })
+                    if tc.id:
+                        call["id"] = tc.id
+                    if tc.function and tc.function.name:
+                        call["function"]["name"] += tc.function.name
+                    if tc.function and tc.function.arguments:
+                        call["function"]["arguments"] += tc.function.arguments
+            await self._record_usage(user_id, current_model, usage)
+
+            if tool_calls:
+                await self._run_tool_calls(
+                    user_id, content or None, [tool_calls[i] for i in sorted(tool_calls)], history
+                )
+
+                second_stream, current_model = await self._create_completion(
+                    history, current_model, path="chat", user_id=user_id, stream=True
+                )
+                content = ""
+                usage = None
+                async for chunk in second_stream:
+                    if chunk.x_groq and chunk.x_groq.usage:
+                        usage = chunk.x_groq.usage
+                    if chunk.choices and chunk.choices[0].delta.content:
+                        content += chunk.choices[0].delta.content
+                        streamed = True
+                        yield chunk.choices[0].delta.content
+                await self._record_usage(user_id, current_model, usage)
+
+            history.append({"role": "assistant", "content": self._clean_response(content)})
+            await self._save_turn(user_id, history, turn_start)
+            self._schedule_compaction(user_id, evicted)
+
+        except Exception as e:
+            log.error(f"Groq Stream Error: {e}", exc_info=True)
+            yield ("\n\n" if streamed else "") + self._agent_error_text(e)
+
+    def _schedule_compaction(self, user_id: int, evicted: list):
+        """Запускает сжатие вытесненных сообщений в резюме в фоне, вне пути запроса."""
+        if not evicted:
+            return
+        task = asyncio.create_task(self._compact_history(user_id, evicted))
+        self._compaction_tasks.add(task)
+        task.add_done_callback(self._compaction_tasks.discard)
+
+    async def _compact_history(self, user_id: int, evicted: list):
+        """Инкрементально дописывает в резюме только что вытесненные сообщения."""
+        lock = self._compaction_locks.setdefault(user_id, asyncio.Lock())
+        async with lock:
+            try:
+                lines = []
+                for msg in evicted:
+                    if msg.get("tool_calls"):
+                        calls = ", ".join(f"{c['function']['name']}({c['function']['arguments']})" for c in msg["tool_calls"])
+                        lines.append(f"assistant called tools: {calls}")
+                    elif msg.get("role") == "tool":
+                        lines.append(f"tool {msg.get('name', '')} result: {truncate_text(msg.get('content') or '', 300)}")
+                    elif msg.get("content"):
+                        lines.append(f"{msg['role']}: {truncate_text(msg['content'], 800)}")
+                if not lines:
+                    return
+
+                summary = await db.get_summary(user_id)
+                prompt = (
+                    "You maintain a running summary of a conversation between a user and an AI assistant.\n"
+                    "Update the summary with the new messages below. Keep facts, decisions, names, numbers "
+                    "and open questions; drop small talk. Write in the language of the conversation, "
+                    "at most 200 words, plain text.\n\n"
+                    f"Current summary:\n{summary or '(empty)'}\n\n"
+                    "New messages:\n" + "\n".join(lines)
+                )
+                response, used_model = await self._create_completion(
+                    [{"role": "user", "content": prompt}], SUMMARY_MODEL, temperature=0.3,
+                )
+                await self._record_usage(user_id, used_model, response.usage)
+
+                new_summary = self._clean_response(response.choices[0].message.content)
+                if new_summary:
+                    await db.save_summary(user_id, truncate_text(new_summary, SUMMARY_MAX_TOKENS))
+                    log.info(f"🗜 Резюме диалога {user_id} обновлено (+{len(evicted)} сообщений)")
+            except Exception as e:
+                log.warning(f"History Compaction Error: {e}")
 
     async def clear_context(self, user_id: int):
         await db.clear_user_history(user_id)
 
-    async def get_vision_response(self, user_id: int, image_bytes: bytes, caption: str = None) -> tuple[str, list]:
+    async def get_vision_response(self, user_id: int, image_bytes: bytes, caption: str = None) -> str:
         """Анализирует изображение через Llama 3.2 Vision."""
         if not GROQ_API_KEY:
             return "❌ GROQ_API_KEY не задан."
@@ -394,8 +679,7 @@ class GroqService:
         
         # Получаем контекст, чтобы бот помнил, о чем говорили раньше
         history, _, _, _ = await db.get_user_data(user_id)
-        if not history:
-            history = [{"role": "system", "content": "You are GroqPulse, a helpful AI with vision capabilities. Describe images accurately and answer questions about them."}]
+        history = [{"role": "system", "content": "You are GroqPulse, a helpful AI with vision capabilities. Describe images accurately and answer questions about them."}] + history
 
         prompt = caption or "Опиши, что ты видишь на этом изображении?"
         
@@ -414,77 +698,185 @@ class GroqService:
         }
 
         # Добавляем в историю (но не храним саму тяжелую картинку в БД, только текст)
-        temp_history = history + [vision_message]
+        temp_history, evicted = fit_context(history + [vision_message], self._context_budget("meta-llama/llama-4-scout-17b-16e-instruct"))
+        history = temp_history[:-1]
+        turn_start = len(history)
 
         try:
-            response = await self.client.chat.completions.create(
-                messages=temp_history,
-                model="meta-llama/llama-4-scout-17b-16e-instruct",
+            # У vision-модели нет запасной: при нехватке лимита запрос ждет в очереди
+            response, used_model = await self._create_completion(
+                temp_history, "meta-llama/llama-4-scout-17b-16e-instruct", fallback=None,
+                path="vision", user_id=user_id
             )
             
             # Записываем статистику (Economist)
-            await self._record_usage(user_id, "meta-llama/llama-4-scout-17b-16e-instruct", response.usage)
+            await self._record_usage(user_id, used_model, response.usage)
             
             ai_response = response.choices[0].message.content
             
             # Сохраняем в историю только текст (без картинки, чтобы не раздувать БД)
             history.append({"role": "user", "content": f"[Фото]: {prompt}"})
             history.append({"role": "assistant", "content": ai_response})
-            await db.save_user_data(user_id, history)
+            await self._save_turn(user_id, history, turn_start)
+            self._schedule_compaction(user_id, evicted)
             
-            return ai_response, media_to_send
+            return ai_response
         except Exception as e:
             log.error(f"Vision Error: {e}")
-            return f"⚠️ Ошибка при анализе фото: {str(e)}", []
+            return f"⚠️ Ошибка при анализе фото: {str(e)}"
 
-    async def get_doc_response(self, user_id: int, doc_text: str, file_name: str) -> tuple[str, list]:
-        """Обрабатывает контент из документа. Возвращает (текст, медиа)."""
+    async def get_doc_response(self, user_id: int, doc_text: str, file_name: str, caption: str = None,
+                               progress: Callable[[int, int], Awaitable] = None) -> str:
+        """Обрабатывает контент из документа. Возвращает текст ответа.
+        Документ нарезается и индексируется для analyze_doc. Небольшой документ идет в промпт целиком,
+        большой — конспектом, собранным map-reduce по частям (с DOC_MAP_REDUCE=false — фрагментами,
+        релевантными подписи к файлу), а в историю сохраняется короткая отметка вместо всего текста.
+        progress(готово, всего) вызывается по мере конспектирования частей.
+        """
         if not GROQ_API_KEY:
-            return "❌ GROQ_API_KEY не задан.", []
+            return "❌ GROQ_API_KEY не задан."
         
-        media_to_send = []
+        coverage_note = None
         history, _, _, _ = await db.get_user_data(user_id)
+        doc = await doc_tool.index(user_id, file_name, doc_text)
         
-        # Системная вставка про документ
-        doc_info = f"Пользователь прислал документ: {file_name}.\n\nСодержимое документа:\n\"\"\"\n{doc_text}\n\"\"\"\n\nПроанализируй этот текст и приготовься отвечать на вопросы по нему. Если текст слишком длинный, сфокусируйся на главных тезах."
-        
-        if not history:
-            history = [{"role": "system", "content": "You are GroqPulse, a helpful AI. You can analyze documents. Answer in the language of the user."}]
+        history = [{"role": "system", "content": "You are GroqPulse, a helpful AI. You can analyze documents. Answer in the language of the user."}] + history
+        turn_start = len(history)
 
         # Добавляем инфу о документе в ИИ (через системное сообщение или user-вставку)
-        history.append({"role": "user", "content": f"Я загрузил файл '{file_name}'. Прочитай его."})
-        history.append({"role": "system", "content": doc_info})
+        history.append({"role": "user", "content": f"Я загрузил файл '{file_name}'. {caption or 'Прочитай его.'}"})
 
         try:
-            current_model = "llama-3.3-70b-versatile"
-            try:
-                response = await self.client.chat.completions.create(
-                    messages=history,
-                    model=current_model, # Для документов берем самую умную модель
-                )
-            except Exception as e:
-                if "rate_limit_exceeded" in str(e).lower():
-                    # Фоллбэк на более легкую модель
-                    response = await self.client.chat.completions.create(
-                        messages=history,
-                        model="llama-3.1-8b-instant",
+            # Документ может быть на мегабайты — считаем и режем вне event loop
+            if await asyncio.to_thread(count_tokens, doc_text) <= DOC_INLINE_TOKENS:
+                # Системная вставка про документ
+                doc_info = f"Пользователь прислал документ: {file_name}.\n\nСодержимое документа:\n\"\"\"\n{doc_text}\n\"\"\"\n\nПроанализируй этот текст и приготовься отвечать на вопросы по нему. Если текст слишком длинный, сфокусируйся на главных тезах."
+                history.append({"role": "system", "content": doc_info})
+                messages = history
+            else:
+                if DOC_MAP_REDUCE:
+                    notes, coverage_note = await self._map_reduce_doc(user_id, doc_text, caption, progress)
+                    doc_info = (
+                        f"Пользователь прислал документ: {file_name}. Он слишком большой, чтобы прочитать его целиком, "
+                        f"поэтому ниже — его конспект, составленный по частям.\n\nКонспект документа:\n\"\"\"\n{notes}\n\"\"\"\n\n"
+                        "Ответь пользователю по этому конспекту. Для следующих вопросов по документу будет доступен поиск по всему тексту."
+                        + (f" Учти: {coverage_note} Не утверждай, что прочитал документ целиком." if coverage_note else "")
                     )
-                    current_model = "llama-3.1-8b-instant"
                 else:
-                    raise e
+                    doc_info = (
+                        f"Пользователь прислал документ: {file_name}. Он слишком большой, чтобы прочитать его целиком, "
+                        f"ниже — фрагменты.\n\nФрагменты документа:\n\"\"\"\n{self._doc_excerpt(doc, caption)}\n\"\"\"\n\n"
+                        "Проанализируй эти фрагменты и ответь пользователю. Для следующих вопросов по документу будет доступен поиск по всему тексту."
+                    )
+                messages = history + [{"role": "system", "content": doc_info}]
+                history.append({"role": "system", "content": f"[Документ '{file_name}' загружен: {len(doc.chunks)} фрагментов. Для вопросов по нему используй analyze_doc.]"})
+
+            # Для документов берем самую умную модель
+            response, current_model = await self._create_completion(
+                messages, "llama-3.3-70b-versatile", path="doc", user_id=user_id
+            )
             
             await self._record_usage(user_id, current_model, response.usage)
             ai_response = response.choices[0].message.content
             
             # Сохраняем в историю подтверждение прочтения
             history.append({"role": "assistant", "content": ai_response})
-            await db.save_user_data(user_id, history)
-            
+            await self._save_turn(user_id, history, turn_start)
+
+            if coverage_note:
+                ai_response += f"\n\n📄 {coverage_note}"
             return ai_response
         except Exception as e:
             log.error(f"Doc Analysis Error: {e}")
             return f"⚠️ Ошибка при анализе документа: {str(e)}"
 
+    @staticmethod
+    def _doc_excerpt(doc, query: str = None) -> str:
+        """Фрагменты большого документа для первого ответа: релевантные запросу или начало, в пределах DOC_INLINE_TOKENS."""
+        limit = max(DOC_INLINE_TOKENS // DOC_CHUNK_TOKENS, 1)
+        ids = sorted(i for i, _ in doc.index.search(query, limit)) if query else []
+        if not ids:
+            ids = range(min(limit, len(doc.chunks)))
+        return "\n\n[…]\n\n".join(doc.chunks[i] for i in ids)
+
+    async def _summarize_part(self, user_id: int, system_prompt: str, text: str) -> str:
+        """Один map/reduce-шаг на быстрой модели (через планировщик лимитов).
+        Части большого документа упираются в TPM — ждем лимит до DOC_MAP_MAX_WAIT, а не SCHEDULER_MAX_WAIT.
+        """
+        response, used_model = await self._create_completion(
+            [{"role": "system", "content": system_prompt}, {"role": "user", "content": text}],
+            SUMMARY_MODEL, max_tokens=DOC_MAP_MAX_TOKENS, temperature=0.2, max_wait=DOC_MAP_MAX_WAIT,
+        )
+        await self._record_usage(user_id, used_model, response.usage)
+        return self._clean_response(response.choices[0].message.content)
+
+    async def _map_reduce_doc(self, user_id: int, doc_text: str, question: str = None,
+                              progress: Callable[[int, int], Awaitable] = None) -> tuple[str, str]:
+        """Конспект документа, который не помещается в контекст 70B.
+        Map: части по DOC_MAP_CHUNK_TOKENS параллельно (не больше DOC_MAP_CONCURRENCY сразу) конспектирует быстрая модель.
+        Reduce: конспекты объединяются группами, пока итог не уложится в DOC_INLINE_TOKENS.
+        Возвращает (конспект, пояснение о покрытии или None, если прочитаны все части).
+        Если законспектировано меньше DOC_MAP_MIN_COVERAGE частей — ошибка, а не ответ по обрывкам.
+        """
+        parts = await asyncio.to_thread(split_text, doc_text, DOC_MAP_CHUNK_TOKENS)
+        total_parts = len(parts)
+        if total_parts > DOC_MAP_MAX_CHUNKS:
+            # Ограничиваем время: берем равномерно распределенные по документу части
+            step = total_parts / DOC_MAP_MAX_CHUNKS
+            parts = [parts[int(i * step)] for i in range(DOC_MAP_MAX_CHUNKS)]
+        map_prompt = DOC_MAP_PROMPT + (f" Особое внимание — всему, что касается вопроса пользователя: {question}" if question else "")
+
+        semaphore = asyncio.Semaphore(DOC_MAP_CONCURRENCY)
+        async def run_stage(prompt: str, texts: list[str]) -> list[str]:
+            done = 0
+            async def summarize(text: str) -> str:
+                nonlocal done
+                async with semaphore:
+                    try:
+                        return await self._summarize_part(user_id, prompt, text)
+                    except Exception as e:
+                        log.warning(f"Doc Map Error: {e}")
+                        return ""
+                    finally:
+                        done += 1
+                        if progress:
+                            await progress(done, len(texts))
+            return await asyncio.gather(*(summarize(text) for text in texts))
+
+        results = await run_stage(map_prompt, parts)
+        notes = [r for r in results if r]
+        mapped = len(notes)
+        log.info(f"🗂 Документ: законспектировано {mapped} из {len(parts)} частей (всего частей {total_parts})")
+        if mapped < len(parts) * DOC_MAP_MIN_COVERAGE:
+            raise RuntimeError(
+                f"удалось законспектировать только {mapped} из {len(parts)} частей документа (лимиты модели). "
+                "Попробуй позже или задай вопрос по конкретной теме документа."
+            )
+
+        while count_tokens("\n\n".join(notes)) > DOC_INLINE_TOKENS and len(notes) > 1:
+            groups = split_text("\n\n".join(notes), DOC_MAP_CHUNK_TOKENS)
+            if len(groups) >= len(notes):
+                # Конспекты уже не сжимаются группировкой — склеиваем попарно
+                groups = ["\n\n".join(notes[i:i + 2]) for i in range(0, len(notes), 2)]
+            # Не сжатую группу оставляем как есть: содержимое не теряется, а групп все равно становится меньше
+            notes = [reduced or group for reduced, group in zip(await run_stage(DOC_REDUCE_PROMPT, groups), groups)]
+
+        coverage_note = None
+        if mapped < total_parts:
+            coverage_note = f"Конспект охватывает {mapped} из {total_parts} частей документа"
+            if total_parts > len(parts):
+                coverage_note += f" (для длинного документа берется равномерная выборка из {len(parts)} частей)"
+            coverage_note += "."
+        return truncate_text("\n\n".join(notes), DOC_INLINE_TOKENS), coverage_note
+
+    async def enhance_image_prompt(self, prompt: str) -> str:
+        """Переводит и улучшает описание картинки для генератора (быстрая модель)."""
+        enhanced_prompt_query = f"Translate and enhance this image description for an AI generator. Be descriptive but keep it under 30 words. Prompt: {prompt}"
+        response, _ = await self._create_completion(
+            [{"role": "user", "content": enhanced_prompt_query}], "llama-3.1-8b-instant", temperature=0.7,
+        )
+        return response.choices[0].message.content.strip()
+
     async def set_model(self, user_id: int, model_name: str):
         await db.save_user_data(user_id, model_name=model_name)
 
@@ -547,68 +939,106 @@ class GroqService:
         """Инструмент для суммаризации Telegram-канала."""
         try:
             url = f"https://t.me/s/{channel_name}"
-            async with httpx.AsyncClient(follow_redirects=True) as client:
-                resp = await client.get(url, timeout=10)
-                if resp.status_code != 200:
-                    return f"❌ Не удалось получить доступ к каналу @{channel_name} (Status: {resp.status_code})"
-                
-                html = resp.text
-                # Извлекаем текст сообщений (упрощенно через регулярки)
-                # Сообщения обычно в дивах с классом tgme_widget_message_text
-                messages = re.findall(r'<div class="tgme_widget_message_text[^>]*>(.*?)</div>', html, re.DOTALL)
-                
-                if not messages:
-                    return f"⚠️ В канале @{channel_name} не найдено текстовых сообщений (или канал приватный)."
-                
-                # Очищаем от HTML-тегов каждое сообщение
-                clean_messages = []
-                for msg in messages[-5:]: # Берем последние 5
-                    # Убираем теги <br/> и другие
-                    clean_text = re.sub(r'<[^>]+>', ' ', msg)
-                    clean_messages.append(clean_text.strip())
-                
-                context = "\n---\n".join(clean_messages)
-                return f"📝 Последние посты из канала @{channel_name}:\n\n{context}\n\nПожалуйста, проанализируй и кратко перескажи суть этих постов."
+            resp = await http_clients.web.get(url)
+            if resp.status_code != 200:
+                return f"❌ Не удалось получить доступ к каналу @{channel_name} (Status: {resp.status_code})"
+            
+            html = resp.text
+            # Извлекаем текст сообщений (упрощенно через регулярки)
+            # Сообщения обычно в дивах с классом tgme_widget_message_text
+            messages = re.findall(r'<div class="tgme_widget_message_text[^>]*>(.*?)</div>', html, re.DOTALL)
+            
+            if not messages:
+                return f"⚠️ В канале @{channel_name} не найдено текстовых сообщений (или канал приватный)."
+            
+            # Очищаем от HTML-тегов каждое сообщение
+            clean_messages = []
+            for msg in messages[-5:]: # Берем последние 5
+                # Убираем теги <br/> и другие
+                clean_text = re.sub(r'<[^>]+>', ' ', msg)
+                clean_messages.append(clean_text.strip())
+            
+            context = "\n---\n".join(clean_messages)
+            return f"📝 Последние посты из канала @{channel_name}:\n\n{context}\n\nПожалуйста, проанализируй и кратко перескажи суть этих постов."
 
         except Exception as e:
             log.error(f"Summarize Channel Tool Error: {e}")
             return f"❌ Ошибка при чтению канала: {str(e)}"
 
-    async def tool_generate_image(self, user_id: int, prompt: str) -> tuple[bytes, str, str]:
-        """Инструмент для генерации изображения."""
-        try:
-            # Получаем настройки модели пользователя
-            _, _, image_model, _ = await db.get_user_data(user_id)
-            
-            img_bytes, used_model = await image_gen.generate_image(prompt, model_id=image_model)
-            return img_bytes, used_model, prompt
-        except Exception as e:
-            log.error(f"Tool Generate Image Error: {e}")
-            raise e
+    async def tool_generate_image(self, user_id: int, prompt: str) -> str:
+        """Инструмент для генерации изображения: ставит задачу в фоновую очередь (image_queue).
+        Готовое фото придет в чат отдельным сообщением, ход агента его не ждет.
+        """
+        # Получаем настройки модели пользователя
+        _, _, image_model, _ = await db.get_user_data(user_id)
+
+        # Бот приватный: чат с пользователем совпадает с его user_id (как у напоминаний)
+        queued = image_queue.submit(
+            chat_id=user_id,
+            user_id=user_id,
+            prompt=prompt,
+            model_id=image_model,
+            caption=lambda used_model: f"✨ Модель: {used_model}\n🎨 Агент нарисовал: {prompt}"
+        )
+        if not queued:
+            return f"❌ У пользователя уже {image_queue.pending(user_id)} картинок в работе. Попроси подождать."
+        return f"Изображение по запросу «{prompt}» поставлено в очередь и будет отправлено отдельным сообщением, как только будет готово."
 
     async def tool_save_memory(self, user_id: int, content: str) -> str:
         """Инструмент для сохранения фактов в вечную память."""
         try:
-            await db.add_memory(user_id, content)
-            return f"✅ Я запомнил: {content}"
+            # Почти-дубликаты уже сохраненных фактов не добавляются повторно
+            return await memory_service.save(user_id, content)
         except Exception as e:
             log.error(f"Save Memory Tool Error: {e}")
             return f"❌ Ошибка сохранения памяти: {str(e)}"
 
-    async def transcribe_audio(self, audio_file_path: str) -> str:
-        """Транскрибирует аудио через Groq Whisper."""
+    async def transcribe_audio(self, audio: bytes | BinaryIO, filename: str = "voice.ogg", duration: float = None) -> str:
+        """Транскрибирует аудио через Groq Whisper.
+        audio — байты или файловый объект (BytesIO/SpooledTemporaryFile), на диск ничего не пишется.
+        Длинные голосовые режутся по паузам на перекрывающиеся куски, которые распознаются параллельно
+        (в рамках лимитов Whisper) и склеиваются без повторов в местах перекрытия.
+        duration — длина в секундах (у голосовых Telegram она известна): короткое аудио уходит в Whisper
+        сразу, без декодирования через ffmpeg.
+        """
         try:
-            with open(audio_file_path, "rb") as file:
-                transcription = await self.client.audio.transcriptions.create(
-                    file=(audio_file_path, file.read()),
-                    model="whisper-large-v3",
-                    response_format="text",
-                )
-            return transcription
+            if not isinstance(audio, (bytes, bytearray)):
+                audio.seek(0)
+                audio = audio.read()
+            fmt = filename.rsplit(".", 1)[-1].lower() if "." in filename else "ogg"
+            long_audio = duration is None or duration > STT_SEGMENT_SECONDS * 1.5
+            if long_audio and audio_split.available():
+                segments = await asyncio.to_thread(audio_split.split_audio, audio, fmt)
+            else:
+                segments = [audio]
+            if len(segments) == 1:
+                return await self._whisper(filename, audio)
+
+            semaphore = asyncio.Semaphore(STT_MAX_PARALLEL)
+            async def transcribe_segment(i: int, segment: bytes) -> str:
+                async with semaphore:
+                    return await self._whisper(f"segment_{i}.ogg", segment)
+
+            parts = await asyncio.gather(*(transcribe_segment(i, seg) for i, seg in enumerate(segments)))
+            return audio_split.merge_transcripts(parts)
+        except RateLimitError as e:
+            scheduler.penalize("whisper-large-v3", parse_duration(e.response.headers.get("retry-after")))
+            log.error(f"Transcription Error: {e}")
+            return f"❌ Ошибка транскрипции: {str(e)}"
         except Exception as e:
             log.error(f"Transcription Error: {e}")
             return f"❌ Ошибка транскрипции: {str(e)}"
 
+    async def _whisper(self, filename: str, audio: bytes) -> str:
+        """Один запрос к Whisper (через очередь лимитов планировщика)."""
+        await scheduler.acquire("whisper-large-v3")
+        transcription = await self.client.audio.transcriptions.create(
+            file=(filename, audio),
+            model="whisper-large-v3",
+            response_format="text",
+        )
+        return transcription.strip()
+
     async def _record_usage(self, user_id: int, model: str, usage):
         """Рассчитывает стоимость и сохраняет статистику в БД."""
         if not usage: return
@@ -630,8 +1060,8 @@ class GroqService:
         """Очищает ответ от служебных тегов типа <think> и лишних переносов."""
         if not text:
             return ""
-        # Убираем содержимое тегов <think>...</think>
-        text = re.sub(r'<think>.*?</think>', '', text, flags=re.DOTALL)
+        # Убираем содержимое тегов <think>...</think> (и незакрытый <think> при стриминге)
+        text = re.sub(r'<think>.*?(</think>|$)', '', text, flags=re.DOTALL)
         # Убираем множественные переносы строк
         text = re.sub(r'\n{3,}', '\n\n', text)
         return text.strip()
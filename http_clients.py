@@ -0,0 +1,86 @@
+import os
+import logging
+import importlib.util
+import aiohttp
+import httpx
+from config import HTTP_POOL_LIMIT, HTTP_KEEPALIVE, HTTP2_ENABLED
+
+log = logging.getLogger(__name__)
+
+# Таймауты (сек) и лимиты соединений для aiohttp-апстримов
+AIOHTTP_UPSTREAMS = {
+    "tavily": {"timeout": 30, "limit": 20},
+    "hf": {"timeout": 90, "limit": 10},
+}
+
+def _http2_available() -> bool:
+    """HTTP/2 в httpx требует пакет h2 (pip install httpx[http2])."""
+    if not HTTP2_ENABLED:
+        return False
+    if importlib.util.find_spec("h2") is None:
+        log.warning("⚠️ HTTP2_ENABLED, но пакет h2 не установлен — используем HTTP/1.1")
+        return False
+    return True
+
+class HttpClients:
+    """Реестр общих HTTP-клиентов с keep-alive пулами по апстримам.
+    aiohttp-сессии создаются в start() (нужен запущенный event loop) и закрываются в close()
+    вместе с пулом БД; httpx-клиенты можно создавать заранее — Groq-клиент нужен уже при импорте.
+    """
+    def __init__(self):
+        http2 = _http2_available()
+        limits = httpx.Limits(
+            max_connections=HTTP_POOL_LIMIT,
+            max_keepalive_connections=HTTP_POOL_LIMIT,
+            keepalive_expiry=HTTP_KEEPALIVE,
+        )
+        proxy = os.getenv("PROXY")
+        if proxy:
+            log.info(f"🌐 Используется прокси для Groq: {proxy}")
+
+        # Groq API (chat, whisper)
+        self.groq = httpx.AsyncClient(
+            http2=http2, limits=limits, proxy=proxy or None,
+            timeout=httpx.Timeout(120.0, connect=10.0),
+        )
+        # Публичные веб-страницы (t.me/s/...)
+        self.web = httpx.AsyncClient(
+            http2=http2, limits=limits, follow_redirects=True,
+            timeout=httpx.Timeout(10.0),
+        )
+        self._sessions = {}
+
+    def _create_session(self, name: str) -> aiohttp.ClientSession:
+        cfg = AIOHTTP_UPSTREAMS[name]
+        connector = aiohttp.TCPConnector(
+            limit=cfg["limit"],
+            ttl_dns_cache=300,
+            keepalive_timeout=HTTP_KEEPALIVE,
+        )
+        return aiohttp.ClientSession(connector=connector, timeout=aiohttp.ClientTimeout(total=cfg["timeout"]))
+
+    async def start(self):
+        """Создает пулы для всех апстримов при старте бота."""
+        for name in AIOHTTP_UPSTREAMS:
+            self.session(name)
+        log.info(f"🔌 HTTP-пулы созданы: {', '.join(AIOHTTP_UPSTREAMS)}, groq, web")
+
+    def session(self, name: str) -> aiohttp.ClientSession:
+        """Общая aiohttp-сессия апстрима (создается лениво, если start() еще не вызывали)."""
+        session = self._sessions.get(name)
+        if session is None or session.closed:
+            session = self._create_session(name)
+            self._sessions[name] = session
+        return session
+
+    async def close(self):
+        """Закрывает все пулы соединений."""
+        for session in self._sessions.values():
+            if not session.closed:
+                await session.close()
+        self._sessions.clear()
+        await self.groq.aclose()
+        await self.web.aclose()
+        log.info("🔌 HTTP-пулы закрыты.")
+
+http_clients = HttpClients()
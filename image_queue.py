@@ -0,0 +1,156 @@
+import asyncio
+import logging
+from typing import Callable
+from aiogram.types import BufferedInputFile
+from aiogram.exceptions import TelegramBadRequest
+from config import IMAGE_MODEL_CONCURRENCY, IMAGE_USER_JOBS, IMAGE_CACHE_MAX_BYTES
+from image_service import image_gen
+from disk_cache import DiskCache
+
+log = logging.getLogger(__name__)
+
+def image_error_text(e: Exception) -> str:
+    """Человекочитаемое сообщение об ошибке генерации картинки."""
+    error_msg = str(e)
+    if "HF_TOKEN" in error_msg:
+        return "❌ <b>Ошибка: Отсутствует токен Hugging Face.</b>\nПожалуйста, добавьте <code>HF_TOKEN</code> в настройки бота."
+    if "wait" in error_msg.lower():
+        return "⏳ <b>Модель прогревается.</b>\nПожалуйста, попробуйте еще раз через несколько секунд."
+    return f"⚠️ <b>Произошла ошибка:</b>\n<code>{error_msg}</code>"
+
+class ImageJobQueue:
+    """Фоновая очередь генерации картинок.
+    Генерация не держит ход агента или хендлер /img: задача ставится в очередь, а готовое фото
+    отправляется в чат отдельным сообщением. Одновременно на одну HF-модель идет не больше
+    IMAGE_MODEL_CONCURRENCY генераций, у пользователя — не больше IMAGE_USER_JOBS задач,
+    одинаковые (модель, промпт) генерируются один раз. Готовые картинки лежат в дисковом кэше
+    вместе с Telegram file_id, поэтому повторный запрос отправляется по id без генерации и загрузки.
+    """
+    def __init__(self, per_model: int = IMAGE_MODEL_CONCURRENCY, per_user: int = IMAGE_USER_JOBS):
+        self.bot = None
+        self.per_model = per_model
+        self.per_user = per_user
+        self._semaphores = {}  # model_id -> Semaphore
+        self._jobs = {}        # (model_id, prompt) -> Task[(image_bytes, used_model)]
+        self._user_jobs = {}   # user_id -> число недоставленных задач
+        self._deliveries = set()
+        self.cache = DiskCache("images", IMAGE_CACHE_MAX_BYTES)
+        self.stats = {"submitted": 0, "deduplicated": 0, "cached": 0, "rejected": 0, "failed": 0}
+
+    def set_bot(self, bot):
+        self.bot = bot
+
+    @staticmethod
+    def job_key(model_id: str, prompt: str) -> tuple:
+        return model_id, " ".join(prompt.lower().split())
+
+    def pending(self, user_id: int) -> int:
+        return self._user_jobs.get(user_id, 0)
+
+    def cache_key(self, model_id: str, prompt: str) -> str:
+        return self.cache.key(*self.job_key(model_id or image_gen.default_model, prompt))
+
+    def is_cached(self, model_id: str, prompt: str) -> bool:
+        """Есть ли готовая картинка для (модель, промпт) — тогда ее не нужно ни генерировать, ни улучшать промпт."""
+        return self.cache_key(model_id, prompt) in self.cache
+
+    def submit(self, chat_id: int, user_id: int, prompt: str, model_id: str = None,
+               caption: Callable[[str], str] = None, source_prompt: str = None) -> bool:
+        """Ставит генерацию в очередь и сразу возвращается.
+        caption(used_model) формирует подпись к фото. source_prompt — исходный текст пользователя,
+        если prompt был переписан (улучшен) перед генерацией: кэш ищется по нему.
+        False — если у пользователя слишком много задач.
+        """
+        if self.pending(user_id) >= self.per_user:
+            self.stats["rejected"] += 1
+            return False
+
+        model_id = model_id or image_gen.default_model
+        cache_key = self.cache_key(model_id, source_prompt or prompt)
+        if cache_key in self.cache:
+            self.stats["cached"] += 1
+        self.stats["submitted"] += 1
+
+        self._user_jobs[user_id] = self.pending(user_id) + 1
+        delivery = asyncio.create_task(self._deliver(chat_id, user_id, model_id, prompt, cache_key, caption))
+        self._deliveries.add(delivery)
+        delivery.add_done_callback(self._deliveries.discard)
+        return True
+
+    def _job(self, model_id: str, prompt: str, cache_key: str) -> asyncio.Task:
+        """Общая задача генерации для (модель, промпт): одинаковые запросы ждут одну генерацию."""
+        job = self._jobs.get(cache_key)
+        if job:
+            self.stats["deduplicated"] += 1
+        else:
+            job = asyncio.create_task(self._generate(model_id, prompt, cache_key))
+            self._jobs[cache_key] = job
+            job.add_done_callback(lambda _: self._jobs.pop(cache_key, None))
+        return job
+
+    async def _generate(self, model_id: str, prompt: str, cache_key: str) -> tuple[bytes, str]:
+        # Лимит — на модель, к которой реально идет запрос (холодную pick_model подменяет теплой)
+        target_model = image_gen.pick_model(model_id)
+        semaphore = self._semaphores.setdefault(target_model, asyncio.Semaphore(self.per_model))
+        async with semaphore:
+            image_bytes, used_model = await image_gen.generate_image(prompt, model_id=model_id, target_model=target_model)
+        # Картинка другой модели (подмена или откат на модель по умолчанию) — не ответ на (model_id, промпт)
+        if used_model == model_id:
+            await self.cache.put(cache_key, image_bytes, used_model=used_model)
+        else:
+            log.info(f"🖼 Картинка от {used_model} вместо {model_id} — в кэш не кладем")
+        return image_bytes, used_model
+
+    async def _send_cached(self, chat_id: int, cache_key: str, caption: Callable[[str], str]) -> bool:
+        """Отправляет картинку из кэша: по file_id, а если его нет или он протух — байтами с диска."""
+        meta = self.cache.meta(cache_key)
+        if not meta:
+            return False
+        used_model = meta.get("used_model", "")
+        text = caption(used_model) if caption else None
+        if meta.get("file_id"):
+            try:
+                await self.bot.send_photo(chat_id=chat_id, photo=meta["file_id"], caption=text)
+                return True
+            except TelegramBadRequest as e:
+                log.warning(f"⚠️ file_id картинки больше не действителен: {e}")
+                await self.cache.update(cache_key, file_id=None)
+        image_bytes = await self.cache.get(cache_key)
+        if image_bytes is None:
+            return False
+        await self._upload(chat_id, cache_key, image_bytes, text)
+        return True
+
+    async def _upload(self, chat_id: int, cache_key: str, image_bytes: bytes, text: str):
+        await self.bot.send_chat_action(chat_id=chat_id, action="upload_photo")
+        sent = await self.bot.send_photo(
+            chat_id=chat_id,
+            photo=BufferedInputFile(image_bytes, filename="art.png"),
+            caption=text
+        )
+        # Запоминаем file_id: следующий такой же запрос уйдет без повторной загрузки
+        if sent.photo:
+            await self.cache.update(cache_key, file_id=sent.photo[-1].file_id)
+
+    async def _deliver(self, chat_id: int, user_id: int, model_id: str, prompt: str,
+                       cache_key: str, caption: Callable[[str], str]):
+        """Отправляет фото из кэша или ждет результат генерации (или ошибку) и отправляет в чат."""
+        try:
+            if await self._send_cached(chat_id, cache_key, caption):
+                return
+            # shield: общая задача нужна и другим пользователям с тем же промптом
+            image_bytes, used_model = await asyncio.shield(self._job(model_id, prompt, cache_key))
+            await self._upload(chat_id, cache_key, image_bytes, caption(used_model) if caption else None)
+        except Exception as e:
+            self.stats["failed"] += 1
+            log.error(f"Image Job Error: {e}")
+            try:
+                await self.bot.send_message(chat_id=chat_id, text=image_error_text(e))
+            except Exception as send_err:
+                log.error(f"Image Job Delivery Error: {send_err}")
+        finally:
+            self._user_jobs[user_id] = self.pending(user_id) - 1
+            if self._user_jobs[user_id] <= 0:
+                del self._user_jobs[user_id]
+
+image_queue = ImageJobQueue()
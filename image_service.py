@@ -1,53 +1,129 @@
-import aiohttp
+import json
+import time
+import asyncio
 import logging
-from config import HF_TOKEN
+from config import HF_TOKEN, IMAGE_WARMUP_INTERVAL, IMAGE_REROUTE_ETA, IMAGE_MAX_COLD_WAIT
+from http_clients import http_clients
+from image_warmth import warmth
 
 log = logging.getLogger(__name__)
 
+# Модели для генерации (id на Hugging Face, подпись для клавиатуры)
+IMAGE_MODELS = [
+    ("black-forest-labs/FLUX.1-schnell", "🎨 FLUX.1 [schnell] (Best)"),
+    ("stabilityai/stable-diffusion-3.5-large", "📸 Stable Diffusion 3.5"),
+    ("Kwai-Kolors/Kolors", "🏮 Kolors (Ultra Phoreal)"),
+    ("stabilityai/sdxl-turbo", "⚡ SDXL Turbo (Instant)"),
+    ("cagliostrolab/animagine-xl-3.1", "🌸 Animagine (Anime Style)"),
+]
+IMAGE_MODEL_IDS = [model_id for model_id, _ in IMAGE_MODELS]
+
 class ImageService:
     def __init__(self):
         # По умолчанию используем FLUX
         from config import DEFAULT_IMAGE_MODEL
         self.default_model = DEFAULT_IMAGE_MODEL
+        self._warmup_task = None
+
+    @staticmethod
+    def _api_url(model_id: str) -> str:
+        # Используем актуальный Router API (предыдущий api-inference выдает 410 Gone)
+        return f"https://router.huggingface.co/hf-inference/models/{model_id}"
 
-    async def generate_image(self, prompt: str, model_id: str = None) -> (bytes, str):
+    @staticmethod
+    def _loading_eta(error_data: str) -> float:
+        """Достает estimated_time из ответа 503 ({"error": "... is currently loading", "estimated_time": 20.0})."""
+        try:
+            return float(json.loads(error_data).get("estimated_time") or 0)
+        except (ValueError, AttributeError):
+            return 0.0
+
+    def pick_model(self, model_id: str = None) -> str:
+        """Если выбранная модель заведомо холодная и грузиться ей долго — берем самую быструю теплую."""
+        target_model = model_id or self.default_model
+        if warmth.eta(target_model) > IMAGE_REROUTE_ETA:
+            alternative = warmth.warm_alternative(IMAGE_MODEL_IDS, exclude=target_model)
+            if alternative:
+                log.info(f"🔥 {target_model} холодная (~{warmth.eta(target_model):.0f}с), беру теплую {alternative}")
+                return alternative
+        return target_model
+
+    async def generate_image(self, prompt: str, model_id: str = None, target_model: str = None) -> (bytes, str):
         """Генерирует изображение через Hugging Face с авто-повтором и фоллбэком.
+        target_model — модель, уже выбранная pick_model(model_id) (иначе выбирается здесь).
         Возвращает кортеж (image_bytes, used_model_id).
         """
         if not HF_TOKEN:
             raise Exception("HF_TOKEN is missing. Please add it to config.")
 
-        target_model = model_id or self.default_model
-        # Используем актуальный Router API (предыдущий api-inference выдает 410 Gone)
-        api_url = f"https://router.huggingface.co/hf-inference/models/{target_model}"
-        
+        warmth.note_selected(model_id or self.default_model)
+        target_model = target_model or self.pick_model(model_id)
+        api_url = self._api_url(target_model)
+
         headers = {"Authorization": f"Bearer {HF_TOKEN}"}
         payload = {"inputs": prompt}
-        
-        import asyncio
+
         max_retries = 3
+        session = http_clients.session("hf")
         for attempt in range(max_retries):
-            async with aiohttp.ClientSession(headers=headers) as session:
-                async with session.post(api_url, json=payload, timeout=90) as response:
-                    if response.status == 200:
-                        img_data = await response.read()
-                        return img_data, target_model
-                    
-                    error_data = await response.text()
-                    log.warning(f"⚠️ HF Error ({target_model}) Status {response.status}: {error_data}")
-
-                    # Fallback
-                    if response.status in [400, 404, 501] and target_model != self.default_model:
-                        log.warning(f"🔄 Модель {target_model} недоступна. Откат на {self.default_model}...")
-                        return await self.generate_image(prompt, model_id=self.default_model)
-                    
-                    if response.status == 503 and attempt < max_retries - 1:
-                        wait_time = (attempt + 1) * 5
-                        log.info(f"⏳ Модель HF {target_model} загружается. Ждем {wait_time}с... (Попытка {attempt+1})")
-                        await asyncio.sleep(wait_time)
-                        continue
-                    
-                    raise Exception(f"Hugging Face Error {response.status}: {error_data}")
+            started = time.monotonic()
+            async with session.post(api_url, json=payload, headers=headers) as response:
+                status = response.status
+                if status == 200:
+                    img_data = await response.read()
+                    warmth.record(target_model, status, time.monotonic() - started)
+                    return img_data, target_model
+                error_data = await response.text()
+
+            # Соединение уже вернулось в пул — ожидание ниже его не занимает
+            eta = self._loading_eta(error_data) if status == 503 else None
+            warmth.record(target_model, status, eta=eta)
+            log.warning(f"⚠️ HF Error ({target_model}) Status {status}: {error_data}")
+
+            # Fallback
+            if status in [400, 404, 501] and target_model != self.default_model:
+                log.warning(f"🔄 Модель {target_model} недоступна. Откат на {self.default_model}...")
+                return await self.generate_image(prompt, model_id=self.default_model)
+
+            if status == 503 and attempt < max_retries - 1:
+                # Ждем столько, сколько HF обещает грузить модель (без оценки — как раньше, 5с, 10с)
+                wait_time = min(eta or (attempt + 1) * 5, IMAGE_MAX_COLD_WAIT)
+                log.info(f"⏳ Модель HF {target_model} загружается. Ждем {wait_time:.0f}с... (Попытка {attempt+1})")
+                await asyncio.sleep(wait_time)
+                continue
+
+            raise Exception(f"Hugging Face Error {status}: {error_data}")
+
+    async def ping(self, model_id: str):
+        """Легкий warm-up запрос: минимальная картинка, чтобы HF загрузил модель."""
+        payload = {"inputs": "warmup", "parameters": {"num_inference_steps": 1, "width": 256, "height": 256}}
+        headers = {"Authorization": f"Bearer {HF_TOKEN}", "x-wait-for-model": "false"}
+        started = time.monotonic()
+        try:
+            async with http_clients.session("hf").post(self._api_url(model_id), json=payload, headers=headers) as response:
+                body = await response.read()
+                eta = self._loading_eta(body.decode(errors="ignore")) if response.status == 503 else None
+                warmth.record(model_id, response.status, time.monotonic() - started, eta=eta)
+                log.info(f"🔥 Warm-up {model_id}: {response.status}")
+        except Exception as e:
+            log.warning(f"Warm-up {model_id} Error: {e}")
+
+    async def _warmup_loop(self):
+        while True:
+            await asyncio.sleep(IMAGE_WARMUP_INTERVAL)
+            for model_id in warmth.models_to_warm(IMAGE_MODEL_IDS):
+                await self.ping(model_id)
+
+    def start_warmup(self):
+        """Запускает фоновый прогрев недавно выбранных моделей."""
+        if HF_TOKEN and not self._warmup_task:
+            self._warmup_task = asyncio.create_task(self._warmup_loop())
+            log.info(f"🔥 Прогрев HF-моделей запущен (интервал {IMAGE_WARMUP_INTERVAL}с).")
+
+    def stop_warmup(self):
+        if self._warmup_task:
+            self._warmup_task.cancel()
+            self._warmup_task = None
 
 # Глобальный экземпляр
 image_gen = ImageService()
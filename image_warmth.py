@@ -0,0 +1,88 @@
+import time
+import logging
+from collections import deque
+from statistics import median
+from config import IMAGE_WARM_TTL, IMAGE_WARMUP_WINDOW
+
+log = logging.getLogger(__name__)
+
+class ModelWarmth:
+    def __init__(self):
+        self.last_status = None
+        self.last_ok = 0.0        # monotonic время последнего 200
+        self.last_cold = 0.0      # monotonic время последнего 503 (модель загружается)
+        self.cold_eta = 0.0       # estimated_time из ответа 503, сек
+        self.last_selected = 0.0  # когда пользователи в последний раз выбирали/использовали модель
+        self.latencies = deque(maxlen=20)
+
+class WarmthTracker:
+    """Трекер «прогретости» HF-моделей.
+    Запоминает последние статусы и задержки по каждой модели, чтобы заранее знать,
+    что модель холодная, сколько ждать ее загрузки и какая модель сейчас теплая.
+    """
+    def __init__(self):
+        self._models = {}
+
+    def _state(self, model_id: str) -> ModelWarmth:
+        if model_id not in self._models:
+            self._models[model_id] = ModelWarmth()
+        return self._models[model_id]
+
+    def record(self, model_id: str, status: int, latency: float = None, eta: float = None):
+        """Фиксирует результат запроса к модели (генерации или warm-up пинга)."""
+        state = self._state(model_id)
+        state.last_status = status
+        now = time.monotonic()
+        if status == 200:
+            state.last_ok = now
+            if latency is not None:
+                state.latencies.append(latency)
+        elif status == 503:
+            state.last_cold = now
+            state.cold_eta = eta or 0.0
+
+    def note_selected(self, model_id: str):
+        """Пользователь выбрал модель или отправил в нее запрос — ее стоит держать теплой."""
+        self._state(model_id).last_selected = time.monotonic()
+
+    def is_warm(self, model_id: str) -> bool:
+        state = self._models.get(model_id)
+        if not state or not state.last_ok:
+            return False
+        return state.last_ok > state.last_cold and time.monotonic() - state.last_ok < IMAGE_WARM_TTL
+
+    def is_cold(self, model_id: str) -> bool:
+        """Модель точно холодная: последний ответ был 503 и с тех пор она не отвечала."""
+        state = self._models.get(model_id)
+        return bool(state and state.last_cold > state.last_ok and time.monotonic() - state.last_cold < IMAGE_WARM_TTL)
+
+    def eta(self, model_id: str) -> float:
+        """Оставшееся время загрузки холодной модели по оценке HF (0 — если неизвестно/теплая)."""
+        if not self.is_cold(model_id):
+            return 0.0
+        state = self._models[model_id]
+        return max(state.cold_eta - (time.monotonic() - state.last_cold), 0.0)
+
+    def typical_latency(self, model_id: str) -> float:
+        state = self._models.get(model_id)
+        return median(state.latencies) if state and state.latencies else 0.0
+
+    def warm_alternative(self, candidates: list, exclude: str = None) -> str:
+        """Самая быстрая из теплых моделей-кандидатов (или None)."""
+        warm = [m for m in candidates if m != exclude and self.is_warm(m)]
+        if not warm:
+            return None
+        return min(warm, key=self.typical_latency)
+
+    def models_to_warm(self, candidates: list) -> list:
+        """Модели, которые недавно выбирали, но которые сейчас не теплые."""
+        now = time.monotonic()
+        return [
+            m for m in candidates
+            if not self.is_warm(m)
+            and m in self._models
+            and self._models[m].last_selected
+            and now - self._models[m].last_selected < IMAGE_WARMUP_WINDOW
+        ]
+
+warmth = WarmthTracker()
@@ -0,0 +1,156 @@
+import re
+import asyncio
+import logging
+from collections import OrderedDict
+import database as db
+from config import (
+    MEMORY_TOP_K, MEMORY_RECENT, MEMORY_MAX_TOKENS, MEMORY_INDEX_USERS, MEMORY_CONSOLIDATE_INTERVAL
+)
+from text_index import BM25Index, TOKEN_RE, tokenize
+from token_budget import count_tokens
+
+log = logging.getLogger(__name__)
+
+# Слова, с которых начинается почти любой факт («Пользователь любит...») — не признак сходства
+FILLER_STEMS = frozenset({"пользо", "user", "юзер"})
+# «Любит кофе» и «не любит кофе» — не дубли, хотя отрицания и выпадают из tokenize как стоп-слова
+NEGATIONS = frozenset({"не", "нет", "ни", "not", "no", "never", "никогда"})
+NUMBER_RE = re.compile(r'\d+(?:[.,]\d+)?')
+
+class MemoryService:
+    """Выбор фактов вечной памяти для системного промпта.
+    Вместо всех фактов пользователя в промпт идут самые релевантные текущему сообщению (BM25)
+    плюс несколько последних, в пределах MEMORY_MAX_TOKENS. Индекс по фактам пользователя
+    кэшируется и перестраивается только при изменении списка фактов.
+    Повторы фактов не дублируются при сохранении, а фоновая задача сливает накопившиеся повторы.
+    Повтор — тот же набор значимых слов и чисел (порядок, словоформы, пунктуация не важны). Факт с лишним
+    словом («сына зовут Алекс» против «зовут Алекс») или другим числом — уже другой факт: память не удаляется.
+    """
+    def __init__(self, max_users: int = MEMORY_INDEX_USERS):
+        self.max_users = max_users
+        self._indexes = OrderedDict()  # user_id -> (отпечаток списка фактов, BM25Index)
+        self._consolidation_task = None
+
+    @staticmethod
+    def _fingerprint(memories: list[str]) -> tuple:
+        return len(memories), hash(tuple(memories))
+
+    def _index(self, user_id: int, memories: list[str]) -> BM25Index:
+        fingerprint = self._fingerprint(memories)
+        cached = self._indexes.get(user_id)
+        if cached and cached[0] == fingerprint:
+            self._indexes.move_to_end(user_id)
+            return cached[1]
+        index = BM25Index(memories)
+        self._indexes[user_id] = (fingerprint, index)
+        self._indexes.move_to_end(user_id)
+        while len(self._indexes) > self.max_users:
+            self._indexes.popitem(last=False)
+        return index
+
+    def select(self, user_id: int, memories: list[str], query: str) -> list[str]:
+        """Факты для промпта: релевантные запросу и последние, в хронологическом порядке."""
+        if sum(count_tokens(m) for m in memories) <= MEMORY_MAX_TOKENS:
+            return memories
+
+        ranked = [i for i, _ in self._index(user_id, memories).search(query or "", MEMORY_TOP_K)]
+        recent = [i for i in range(len(memories) - 1, -1, -1) if i not in ranked][:MEMORY_RECENT]
+
+        picked, used = [], 0
+        for i in ranked + recent:
+            tokens = count_tokens(memories[i])
+            if used + tokens > MEMORY_MAX_TOKENS:
+                continue
+            picked.append(i)
+            used += tokens
+        return [memories[i] for i in sorted(picked)]
+
+    async def relevant(self, user_id: int, query: str) -> list[str]:
+        """Факты пользователя, относящиеся к сообщению query."""
+        memories = await db.get_memories(user_id)
+        selected = self.select(user_id, memories, query)
+        if len(selected) < len(memories):
+            log.debug(f"🧠 Память {user_id}: {len(selected)} из {len(memories)} фактов в промпт")
+        return selected
+
+    @staticmethod
+    def _signature(text: str) -> tuple[bool, frozenset, frozenset]:
+        """(есть ли отрицание, числа, значимые слова без стоп-слов и «Пользователь», с грубым стеммингом)."""
+        negated = any(word in NEGATIONS for word in TOKEN_RE.findall(text.lower()))
+        numbers = frozenset(n.replace(",", ".") for n in NUMBER_RE.findall(text))
+        words = frozenset(t for t in tokenize(text) if t not in FILLER_STEMS and not t.isdigit())
+        return negated, numbers, words
+
+    @staticmethod
+    def _word_count(text: str) -> int:
+        return len(TOKEN_RE.findall(text))
+
+    @staticmethod
+    def _is_duplicate(a: tuple, b: tuple) -> bool:
+        """Повтор: совпадают отрицание, числа и значимые слова; пустой набор слов ни с чем не совпадает."""
+        return bool(a[2]) and a == b
+
+    async def save(self, user_id: int, content: str) -> str:
+        """Сохраняет факт, если его повтора еще нет. Повтор с тем же смыслом, но большим числом слов
+        заменяет старые формулировки. Возвращает текст для ответа инструмента.
+        """
+        content = content.strip()
+        new_signature = self._signature(content)
+        rows = await db.get_memory_rows(user_id)
+        duplicates = [(memory_id, text) for memory_id, text in rows if self._is_duplicate(new_signature, self._signature(text))]
+        if not duplicates:
+            await db.add_memory(user_id, content)
+            return f"✅ Я запомнил: {content}"
+
+        longest = max((text for _, text in duplicates), key=self._word_count)
+        if self._word_count(content) <= self._word_count(longest):
+            log.info(f"🧠 Память {user_id}: дубль пропущен ({content!r} ~ {longest!r})")
+            return f"✅ Я уже это помню: {longest}"
+        await db.replace_memories(user_id, [memory_id for memory_id, _ in duplicates], content)
+        log.info(f"🧠 Память {user_id}: {len(duplicates)} повторов заменены более полной формулировкой")
+        return f"✅ Я обновил память: {content}"
+
+    def _clusters(self, rows: list[tuple[int, str]]) -> list[list[tuple[int, str]]]:
+        """Группы повторов одного факта (из двух и больше)."""
+        groups = {}
+        for row in rows:
+            signature = self._signature(row[1])
+            if signature[2]:
+                groups.setdefault(signature, []).append(row)
+        return [group for group in groups.values() if len(group) > 1]
+
+    async def consolidate(self, user_id: int) -> int:
+        """Сливает повторы в памяти пользователя: в каждой группе остается самая полная формулировка.
+        Возвращает число удаленных фактов.
+        """
+        rows = await db.get_memory_rows(user_id)
+        clusters = await asyncio.to_thread(self._clusters, rows)
+        removed = []
+        for group in clusters:
+            keep = max(group, key=lambda row: self._word_count(row[1]))
+            removed.extend(memory_id for memory_id, _ in group if memory_id != keep[0])
+        if removed:
+            await db.replace_memories(user_id, removed)
+            log.info(f"🧠 Память {user_id}: слито {len(clusters)} групп, удалено {len(removed)} дублей")
+        return len(removed)
+
+    async def _consolidation_loop(self):
+        while True:
+            await asyncio.sleep(MEMORY_CONSOLIDATE_INTERVAL)
+            try:
+                for user_id in await db.get_memory_user_ids(min_count=2):
+                    await self.consolidate(user_id)
+            except Exception as e:
+                log.error(f"Memory Consolidation Error: {e}")
+
+    def start_consolidation(self):
+        """Запускает периодическое слияние дублей в памяти всех пользователей."""
+        if not self._consolidation_task:
+            self._consolidation_task = asyncio.create_task(self._consolidation_loop())
+
+    def stop_consolidation(self):
+        if self._consolidation_task:
+            self._consolidation_task.cancel()
+            self._consolidation_task = None
+
+memory_service = MemoryService()
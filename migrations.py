@@ -0,0 +1,152 @@
+import logging
+
+log = logging.getLogger(__name__)
+
+# Ключ advisory-блокировки: при одновременном старте нескольких экземпляров миграции выполняет один
+MIGRATION_LOCK_ID = 4707_2024
+
+# Версионированные миграции схемы: (версия, описание, SQL-команды). Только дописывать в конец,
+# уже примененные не менять — на существующих базах они не выполнятся повторно.
+MIGRATIONS = [
+    (1, "Базовые таблицы", [
+        # Таблица для хранения контекста и настроек пользователя
+        """
+        CREATE TABLE IF NOT EXISTS chat_history (
+            user_id BIGINT PRIMARY KEY,
+            messages JSONB DEFAULT '[]'::jsonb,
+            model_name TEXT DEFAULT NULL,
+            image_model TEXT DEFAULT NULL,
+            updated_at TIMESTAMP WITH TIME ZONE DEFAULT CURRENT_TIMESTAMP
+        )
+        """,
+        # Колонки, добавленные до появления миграций (на старых базах могут уже быть)
+        "ALTER TABLE chat_history ADD COLUMN IF NOT EXISTS image_model TEXT DEFAULT NULL",
+        "ALTER TABLE chat_history ADD COLUMN IF NOT EXISTS character TEXT DEFAULT 'default'",
+        "ALTER TABLE chat_history ADD COLUMN IF NOT EXISTS summary TEXT DEFAULT NULL",
+        # Таблица для напоминаний (текущая система)
+        """
+        CREATE TABLE IF NOT EXISTS reminders (
+            id SERIAL PRIMARY KEY,
+            user_id BIGINT NOT NULL,
+            text TEXT NOT NULL,
+            remind_at TIMESTAMP WITH TIME ZONE NOT NULL,
+            status TEXT DEFAULT 'pending',
+            created_at TIMESTAMP WITH TIME ZONE DEFAULT CURRENT_TIMESTAMP
+        )
+        """,
+        # Таблица для Календаря (события с длительностью)
+        """
+        CREATE TABLE IF NOT EXISTS calendar_events (
+            id SERIAL PRIMARY KEY,
+            user_id BIGINT NOT NULL,
+            summary TEXT NOT NULL,
+            description TEXT,
+            start_time TIMESTAMP WITH TIME ZONE NOT NULL,
+            end_time TIMESTAMP WITH TIME ZONE NOT NULL,
+            created_at TIMESTAMP WITH TIME ZONE DEFAULT CURRENT_TIMESTAMP
+        )
+        """,
+        # Таблица для "Вечной Памяти" (Eternal Memory)
+        """
+        CREATE TABLE IF NOT EXISTS user_memories (
+            id SERIAL PRIMARY KEY,
+            user_id BIGINT NOT NULL,
+            content TEXT NOT NULL,
+            created_at TIMESTAMP WITH TIME ZONE DEFAULT CURRENT_TIMESTAMP
+        )
+        """,
+        # Таблица для Экономиста (подсчет токенов и стоимости)
+        """
+        CREATE TABLE IF NOT EXISTS token_usage (
+            user_id BIGINT PRIMARY KEY,
+            prompt_tokens BIGINT DEFAULT 0,
+            completion_tokens BIGINT DEFAULT 0,
+            total_cost NUMERIC(10, 6) DEFAULT 0,
+            last_update TIMESTAMP WITH TIME ZONE DEFAULT CURRENT_TIMESTAMP
+        )
+        """,
+        # Таблица для Google OAuth токенов
+        """
+        CREATE TABLE IF NOT EXISTS google_tokens (
+            user_id BIGINT PRIMARY KEY,
+            access_token TEXT NOT NULL,
+            refresh_token TEXT,
+            token_uri TEXT,
+            client_id TEXT,
+            client_secret TEXT,
+            scopes TEXT,
+            expiry TIMESTAMP WITH TIME ZONE
+        )
+        """,
+    ]),
+    (2, "Лог сообщений chat_messages вместо JSONB-истории", [
+        "ALTER TABLE chat_history ADD COLUMN IF NOT EXISTS last_seq BIGINT DEFAULT 0",
+        "ALTER TABLE chat_history ADD COLUMN IF NOT EXISTS window_seq BIGINT DEFAULT 1",
+        # Лог сообщений (append-only): каждый ход дописывает строки, а не переписывает весь JSONB.
+        # Окно контекста — сообщения с seq >= chat_history.window_seq
+        """
+        CREATE TABLE IF NOT EXISTS chat_messages (
+            user_id BIGINT NOT NULL,
+            seq BIGINT NOT NULL,
+            message JSONB NOT NULL,
+            created_at TIMESTAMP WITH TIME ZONE DEFAULT CURRENT_TIMESTAMP,
+            PRIMARY KEY (user_id, seq)
+        )
+        """,
+        # Переносим старую историю из chat_history.messages в лог (системный промпт не храним)
+        """
+        INSERT INTO chat_messages (user_id, seq, message)
+        SELECT h.user_id, m.ord, m.value
+        FROM chat_history h, jsonb_array_elements(h.messages) WITH ORDINALITY AS m(value, ord)
+        WHERE h.messages <> '[]'::jsonb AND NOT (m.ord = 1 AND m.value->>'role' = 'system')
+        ON CONFLICT DO NOTHING
+        """,
+        """
+        UPDATE chat_history SET last_seq = jsonb_array_length(messages), window_seq = 1, messages = '[]'::jsonb
+        WHERE messages <> '[]'::jsonb
+        """,
+    ]),
+    (3, "Индексы для горячих запросов", [
+        # get_pending_reminders: в индексе только ожидающие напоминания
+        "CREATE INDEX IF NOT EXISTS reminders_pending_remind_at_idx ON reminders (remind_at) WHERE status = 'pending'",
+        # get_memories / get_memory_rows: факты пользователя в порядке добавления
+        "CREATE INDEX IF NOT EXISTS user_memories_user_created_idx ON user_memories (user_id, created_at)",
+        # get_calendar_events: ближайшие события пользователя
+        "CREATE INDEX IF NOT EXISTS calendar_events_user_start_idx ON calendar_events (user_id, start_time)",
+    ]),
+]
+
+LATEST_VERSION = MIGRATIONS[-1][0]
+
+async def migrate(conn) -> int:
+    """Применяет недостающие миграции и возвращает текущую версию схемы.
+    Если схема актуальна — один запрос без блокировок. Иначе все недостающие миграции выполняются
+    в одной транзакции под pg_advisory_xact_lock: при ошибке схема остается на прежней версии.
+    """
+    await conn.execute("""
+        CREATE TABLE IF NOT EXISTS schema_version (
+            version INT PRIMARY KEY,
+            description TEXT,
+            applied_at TIMESTAMP WITH TIME ZONE DEFAULT CURRENT_TIMESTAMP
+        )
+    """)
+    current = await conn.fetchval("SELECT COALESCE(MAX(version), 0) FROM schema_version")
+    if current >= LATEST_VERSION:
+        return current
+
+    async with conn.transaction():
+        await conn.execute("SELECT pg_advisory_xact_lock($1)", MIGRATION_LOCK_ID)
+        # Пока ждали блокировку, миграции мог применить другой экземпляр
+        current = await conn.fetchval("SELECT COALESCE(MAX(version), 0) FROM schema_version")
+        for version, description, statements in MIGRATIONS:
+            if version <= current:
+                continue
+            for sql in statements:
+                await conn.execute(sql)
+            await conn.execute(
+                "INSERT INTO schema_version (version, description) VALUES ($1, $2)",
+                version, description
+            )
+            log.info(f"📦 Миграция {version} применена: {description}")
+            current = version
+    return current
@@ -0,0 +1,186 @@
+import re
+import time
+import asyncio
+import logging
+from config import SCHEDULER_MAX_WAIT, SCHEDULER_REROUTE_AFTER
+
+log = logging.getLogger(__name__)
+
+# Лимиты Groq по моделям: (запросов в минуту, токенов в минуту).
+# Это стартовые значения — дальше бакеты подстраиваются по заголовкам x-ratelimit-* из ответов.
+MODEL_LIMITS = {
+    "llama-3.3-70b-versatile": (30, 12000),
+    "llama-3.1-8b-instant": (30, 6000),
+    "qwen/qwen3-32b": (60, 6000),
+    "meta-llama/llama-4-maverick-17b-128e-instruct": (30, 6000),
+    "meta-llama/llama-4-scout-17b-16e-instruct": (30, 30000),
+    "whisper-large-v3": (20, 0),
+    "default": (30, 6000)
+}
+
+class RateLimitQueueTimeout(Exception):
+    """Запрос не дождался свободного лимита ни на одной из моделей."""
+    def __init__(self, model: str, waited: float):
+        # Текст содержит rate_limit_exceeded, чтобы его понимала общая обработка ошибок
+        super().__init__(f"rate_limit_exceeded: {model} busy, waited {waited:.1f}s")
+
+def parse_duration(value: str) -> float:
+    """Разбирает длительность Groq вида '2m59.56s', '7.66s', '1h2m', '120ms' в секунды."""
+    if not value:
+        return 0.0
+    try:
+        return float(value)
+    except ValueError:
+        pass
+    seconds = 0.0
+    for number, unit in re.findall(r'([\d.]+)(ms|h|m|s)', value):
+        seconds += float(number) * {"ms": 0.001, "h": 3600, "m": 60, "s": 1}[unit]
+    return seconds
+
+class TokenBucket:
+    """Классический token bucket с равномерным пополнением."""
+    def __init__(self, capacity: float, per_seconds: float = 60.0):
+        self.capacity = capacity
+        self.rate = capacity / per_seconds if capacity else 0.0
+        self.tokens = capacity
+        self.updated = time.monotonic()
+
+    def _refill(self):
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def wait_time(self, amount: float) -> float:
+        """Сколько секунд ждать, пока в бакете наберется amount (0 — можно сейчас)."""
+        if not self.capacity:
+            return 0.0
+        self._refill()
+        amount = min(amount, self.capacity)
+        if self.tokens >= amount:
+            return 0.0
+        return (amount - self.tokens) / self.rate
+
+    def consume(self, amount: float):
+        if not self.capacity:
+            return
+        self._refill()
+        self.tokens -= min(amount, self.capacity)
+
+    def sync(self, remaining: float, limit: float = None):
+        """Подстраивает бакет под данные сервера: лимит в минуту и текущий остаток."""
+        if limit:
+            self.capacity = limit
+            self.rate = limit / 60.0
+        if not self.capacity:
+            return
+        self._refill()
+        self.tokens = min(self.capacity, remaining)
+
+class ModelState:
+    def __init__(self, model: str):
+        rpm, tpm = MODEL_LIMITS.get(model, MODEL_LIMITS["default"])
+        self.requests = TokenBucket(rpm)
+        self.tokens = TokenBucket(tpm)
+        self.blocked_until = 0.0  # 429 / исчерпан дневной лимит запросов
+        self.rate_limited = 0
+
+    def wait_time(self, est_tokens: int) -> float:
+        blocked = max(self.blocked_until - time.monotonic(), 0.0)
+        return max(blocked, self.requests.wait_time(1), self.tokens.wait_time(est_tokens))
+
+    def consume(self, est_tokens: int):
+        self.requests.consume(1)
+        self.tokens.consume(est_tokens)
+
+class ModelScheduler:
+    """Планировщик запросов к Groq с учетом лимитов.
+    Перед каждым запросом резервирует лимит модели; если основной модели придется ждать
+    дольше SCHEDULER_REROUTE_AFTER, а у запасной лимит есть — направляет запрос туда,
+    иначе ставит в очередь (не дольше SCHEDULER_MAX_WAIT).
+    """
+    def __init__(self, max_wait: float = SCHEDULER_MAX_WAIT, reroute_after: float = SCHEDULER_REROUTE_AFTER):
+        self.max_wait = max_wait
+        self.reroute_after = reroute_after
+        self._models = {}
+        self.queue_depth = 0
+        self.rerouted = 0
+        self.queued = 0
+
+    def _state(self, model: str) -> ModelState:
+        if model not in self._models:
+            self._models[model] = ModelState(model)
+        return self._models[model]
+
+    async def acquire(self, model: str, est_tokens: int = 0, fallback: str = None, max_wait: float = None) -> str:
+        """Резервирует лимит и возвращает модель, на которую стоит отправить запрос.
+        max_wait — свой предел ожидания в очереди (по умолчанию SCHEDULER_MAX_WAIT).
+        """
+        started = time.monotonic()
+        max_wait = self.max_wait if max_wait is None else max_wait
+        primary = self._state(model)
+        backup = self._state(fallback) if fallback and fallback != model else None
+        waiting = False
+        try:
+            while True:
+                wait_primary = primary.wait_time(est_tokens)
+                if wait_primary == 0:
+                    primary.consume(est_tokens)
+                    return model
+
+                wait_backup = backup.wait_time(est_tokens) if backup else None
+                if backup and wait_backup == 0 and wait_primary > self.reroute_after:
+                    backup.consume(est_tokens)
+                    self.rerouted += 1
+                    log.info(f"🔀 {model} занята еще {wait_primary:.1f}с — запрос направлен на {fallback}")
+                    return fallback
+
+                waited = time.monotonic() - started
+                if waited >= max_wait:
+                    raise RateLimitQueueTimeout(model, waited)
+
+                if not waiting:
+                    waiting = True
+                    self.queue_depth += 1
+                    self.queued += 1
+                candidates = [wait_primary] + ([wait_backup] if backup else [])
+                await asyncio.sleep(min(min(candidates), max_wait - waited, 1.0))
+        finally:
+            if waiting:
+                self.queue_depth -= 1
+
+    def has_capacity(self, model: str, est_tokens: int = 0) -> bool:
+        """Можно ли отправить запрос на модель прямо сейчас, без ожидания."""
+        return self._state(model).wait_time(est_tokens) == 0
+
+    def update(self, model: str, headers):
+        """Обновляет состояние модели по заголовкам x-ratelimit-* ответа Groq."""
+        state = self._state(model)
+        try:
+            remaining_tokens = headers.get("x-ratelimit-remaining-tokens")
+            if remaining_tokens is not None:
+                limit_tokens = headers.get("x-ratelimit-limit-tokens")
+                state.tokens.sync(float(remaining_tokens), float(limit_tokens) if limit_tokens else None)
+
+            # remaining-requests у Groq — дневной лимит: при нуле блокируем модель до сброса
+            remaining_requests = headers.get("x-ratelimit-remaining-requests")
+            if remaining_requests is not None and float(remaining_requests) <= 0:
+                state.blocked_until = time.monotonic() + parse_duration(headers.get("x-ratelimit-reset-requests"))
+        except (TypeError, ValueError) as e:
+            log.debug(f"Rate limit headers parse error: {e}")
+
+    def penalize(self, model: str, retry_after: float = None):
+        """Фиксирует 429 от Groq: модель недоступна retry_after секунд."""
+        state = self._state(model)
+        state.rate_limited += 1
+        state.blocked_until = max(state.blocked_until, time.monotonic() + (retry_after or 10.0))
+        log.warning(f"🚦 {model}: 429, пауза {retry_after or 10.0:.1f}с")
+
+    def stats(self) -> dict:
+        return {
+            "queue_depth": self.queue_depth,
+            "queued": self.queued,
+            "rerouted": self.rerouted,
+            "rate_limited": sum(s.rate_limited for s in self._models.values())
+        }
+
+scheduler = ModelScheduler()
@@ -0,0 +1,24 @@
+"""Разбор PDF в отдельном процессе: python pdf_worker.py START END < file.pdf
+Импортирует только PyMuPDF — ни бота, ни сервисов, поэтому процесс стартует быстро.
+Пишет в stdout JSON {"pages": всего страниц, "texts": [текст страниц START..END)]} в UTF-8.
+"""
+import os
+import sys
+import json
+
+def extract_pages(pdf_bytes: bytes, start: int, end: int) -> dict:
+    import fitz  # PyMuPDF — импорт после перенаправления stdout, см. main
+    with fitz.open(stream=pdf_bytes, filetype="pdf") as doc:
+        end = min(end, doc.page_count)
+        return {"pages": doc.page_count, "texts": [doc[i].get_text() for i in range(start, end)]}
+
+def main():
+    # PyMuPDF печатает предупреждения в stdout: результат пишем в копию дескриптора, а stdout уводим в stderr
+    result_out = os.fdopen(os.dup(1), "wb")
+    os.dup2(2, 1)
+    result = extract_pages(sys.stdin.buffer.read(), int(sys.argv[1]), int(sys.argv[2]))
+    result_out.write(json.dumps(result, ensure_ascii=False).encode("utf-8", errors="replace"))
+    result_out.close()
+
+if __name__ == "__main__":
+    main()
@@ -1,18 +1,78 @@
-import aiohttp
+import re
+import time
+import asyncio
 import logging
-from config import TAVILY_API_KEY
+from collections import OrderedDict
+from config import TAVILY_API_KEY, SEARCH_CACHE_TTL, SEARCH_CACHE_SIZE
+from http_clients import http_clients
 
 log = logging.getLogger(__name__)
 
 class SearchService:
     def __init__(self):
         self.api_url = "https://api.tavily.com/search"
+        # TTL-кэш результатов: (запрос, глубина) -> (истекает_в, текст), вытеснение по LRU
+        self._cache = OrderedDict()
+        # Запросы, которые сейчас выполняются: одинаковые параллельные запросы ждут один ответ Tavily
+        self._inflight = {}
+        self.hits = 0
+        self.misses = 0
+        self.coalesced = 0
+
+    @staticmethod
+    def _normalize(query: str) -> str:
+        """Нормализует запрос для ключа кэша: регистр, пробелы, финальная пунктуация."""
+        query = re.sub(r'\s+', ' ', (query or "").lower()).strip()
+        return query.strip(" ?!.,;:")
 
     async def search(self, query: str, search_depth: str = "basic") -> str:
-        """Поиск в интернете через Tavily API. Возвращает структурированный текст."""
+        """Поиск в интернете через Tavily API с TTL-кэшем и склейкой одинаковых запросов."""
         if not TAVILY_API_KEY:
             return "⚠️ Ошибка: TAVILY_API_KEY не задан."
 
+        key = (self._normalize(query), search_depth)
+        cached = self._cache.get(key)
+        if cached and cached[0] > time.monotonic():
+            self._cache.move_to_end(key)
+            self.hits += 1
+            log.info(f"🔍 Поиск из кэша: {query}")
+            return cached[1]
+
+        task = self._inflight.get(key)
+        if task:
+            self.coalesced += 1
+        else:
+            self.misses += 1
+            task = asyncio.create_task(self._fetch(query, search_depth))
+            self._inflight[key] = task
+            task.add_done_callback(lambda t: self._finish(key, t))
+        # shield: отмена одного ожидающего (таймаут инструмента) не отменяет запрос для остальных
+        return await asyncio.shield(task)
+
+    def _finish(self, key: tuple, task: asyncio.Task):
+        """Снимает запрос из in-flight и кладет успешный результат в кэш."""
+        self._inflight.pop(key, None)
+        if task.cancelled() or task.exception():
+            return
+        result = task.result()
+        if result.startswith("⚠️"):
+            return
+        self._cache[key] = (time.monotonic() + SEARCH_CACHE_TTL, result)
+        self._cache.move_to_end(key)
+        while len(self._cache) > SEARCH_CACHE_SIZE:
+            self._cache.popitem(last=False)
+
+    def stats(self) -> dict:
+        total = self.hits + self.misses + self.coalesced
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "coalesced": self.coalesced,
+            "hit_rate": (self.hits + self.coalesced) / total if total else 0.0
+        }
+
+    async def _fetch(self, query: str, search_depth: str) -> str:
+        """Запрос к Tavily API. Возвращает структурированный текст."""
         payload = {
             "api_key": TAVILY_API_KEY,
             "query": query,
@@ -22,22 +82,22 @@ class SearchService:
         }
 
         try:
-            async with aiohttp.ClientSession() as session:
-                async with session.post(self.api_url, json=payload, timeout=30) as response:
-                    if response.status == 200:
-                        data = await response.json()
-                        results = data.get("results", [])
-                        
-                        # Формируем сводку для ИИ
-                        context = "Результаты поиска:\n\n"
-                        for res in results:
-                            context += f"🔹 {res['title']}\nURL: {res['url']}\nContent: {res['content']}\n\n"
-                        
-                        return context
-                    else:
-                        error_text = await response.text()
-                        log.error(f"Tavily API Error: {response.status} - {error_text}")
-                        return f"⚠️ Ошибка поиска (Status {response.status})."
+            session = http_clients.session("tavily")
+            async with session.post(self.api_url, json=payload) as response:
+                if response.status == 200:
+                    data = await response.json()
+                    results = data.get("results", [])
+                    
+                    # Формируем сводку для ИИ
+                    context = "Результаты поиска:\n\n"
+                    for res in results:
+                        context += f"🔹 {res['title']}\nURL: {res['url']}\nContent: {res['content']}\n\n"
+                    
+                    return context
+                else:
+                    error_text = await response.text()
+                    log.error(f"Tavily API Error: {response.status} - {error_text}")
+                    return f"⚠️ Ошибка поиска (Status {response.status})."
         except Exception as e:
             log.error(f"Search Exception: {e}")
             return f"⚠️ Ошибка при выполнении поиска: {str(e)}"
@@ -0,0 +1,139 @@
+import json
+import logging
+from collections import OrderedDict
+from config import SESSION_CACHE_SIZE, SESSION_CACHE_MAX_BYTES
+
+log = logging.getLogger(__name__)
+
+class SessionCache:
+    """In-process LRU-кэш сессий пользователей перед БД.
+    Хранит по user_id историю, chat/image модель, персонажа, резюме диалога и вечную память.
+    Запись сквозная: database.py обновляет кэш только после успешной записи в БД.
+    """
+    def __init__(self, max_users: int = SESSION_CACHE_SIZE, max_bytes: int = SESSION_CACHE_MAX_BYTES):
+        self.max_users = max_users
+        self.max_bytes = max_bytes
+        self._entries = OrderedDict()  # user_id -> {"user": (history, model, image_model, character), "memories": [...]}
+        self._sizes = {}
+        self.total_bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def _lookup(self, user_id: int, field: str):
+        entry = self._entries.get(user_id)
+        if entry is None or field not in entry:
+            self.misses += 1
+            return None
+        self._entries.move_to_end(user_id)
+        self.hits += 1
+        return entry[field]
+
+    def _store(self, user_id: int, field: str, value):
+        entry = self._entries.setdefault(user_id, {})
+        entry[field] = value
+        self._entries.move_to_end(user_id)
+        self._resize(user_id)
+
+    def _resize(self, user_id: int):
+        """Пересчитывает примерный размер записи и вытесняет самые старые при превышении лимитов."""
+        entry = self._entries[user_id]
+        size = 0
+        if "user" in entry:
+            size += len(json.dumps(entry["user"][0], ensure_ascii=False))
+        if "memories" in entry:
+            size += sum(len(m) for m in entry["memories"])
+        if entry.get("summary"):
+            size += len(entry["summary"])
+        self.total_bytes += size - self._sizes.get(user_id, 0)
+        self._sizes[user_id] = size
+
+        while self._entries and (len(self._entries) > self.max_users or self.total_bytes > self.max_bytes):
+            old_id, _ = self._entries.popitem(last=False)
+            self.total_bytes -= self._sizes.pop(old_id, 0)
+            self.evictions += 1
+
+    def get_user(self, user_id: int):
+        """Возвращает (history, model, image_model, character) или None при промахе."""
+        cached = self._lookup(user_id, "user")
+        if cached is None:
+            return None
+        history, model_name, image_model, character = cached
+        # Копия списка: вызывающий код дописывает в историю до сохранения
+        return list(history), model_name, image_model, character
+
+    def set_user(self, user_id: int, history: list, model_name: str, image_model: str, character: str):
+        self._store(user_id, "user", (list(history), model_name, image_model, character))
+
+    def update_user(self, user_id: int, messages: list = None, model_name: str = None, image_model: str = None, character: str = None):
+        """Сквозная запись: обновляет только переданные поля, если сессия уже в кэше."""
+        entry = self._entries.get(user_id)
+        if entry is None or "user" not in entry:
+            return
+        history, cur_model, cur_image, cur_char = entry["user"]
+        self._store(user_id, "user", (
+            list(messages) if messages is not None else history,
+            model_name if model_name is not None else cur_model,
+            image_model if image_model is not None else cur_image,
+            character if character is not None else cur_char,
+        ))
+
+    def append_messages(self, user_id: int, messages: list, keep_last: int):
+        """Сквозная запись хода: дописывает сообщения и оставляет последние keep_last (если сессия в кэше)."""
+        entry = self._entries.get(user_id)
+        if entry is None or "user" not in entry:
+            return
+        history, model_name, image_model, character = entry["user"]
+        history = (history + list(messages))[-keep_last:] if keep_last > 0 else []
+        self._store(user_id, "user", (history, model_name, image_model, character))
+
+    def get_memories(self, user_id: int):
+        cached = self._lookup(user_id, "memories")
+        return list(cached) if cached is not None else None
+
+    def set_memories(self, user_id: int, memories: list):
+        self._store(user_id, "memories", list(memories))
+
+    def add_memory(self, user_id: int, content: str):
+        entry = self._entries.get(user_id)
+        if entry is None or "memories" not in entry:
+            return
+        self._store(user_id, "memories", entry["memories"] + [content])
+
+    def get_summary(self, user_id: int) -> tuple[bool, str]:
+        """Возвращает (найдено, резюме): резюме может законно быть None."""
+        entry = self._entries.get(user_id)
+        if entry is None or "summary" not in entry:
+            self.misses += 1
+            return False, None
+        self._entries.move_to_end(user_id)
+        self.hits += 1
+        return True, entry["summary"]
+
+    def set_summary(self, user_id: int, summary: str):
+        self._store(user_id, "summary", summary)
+
+    def invalidate(self, user_id: int, field: str = None):
+        """Сбрасывает сессию целиком или одно поле (например, после ошибки записи в БД)."""
+        entry = self._entries.get(user_id)
+        if entry is None:
+            return
+        if field:
+            entry.pop(field, None)
+            self._resize(user_id)
+        else:
+            del self._entries[user_id]
+            self.total_bytes -= self._sizes.pop(user_id, 0)
+
+    def stats(self) -> dict:
+        total = self.hits + self.misses
+        return {
+            "users": len(self._entries),
+            "bytes": self.total_bytes,
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+            "hit_rate": self.hits / total if total else 0.0
+        }
+
+session_cache = SessionCache()
@@ -0,0 +1,83 @@
+"""Проверка SQL лога сообщений на настоящем PostgreSQL.
+Запуск: TEST_DATABASE_URL=postgresql://user@host/testdb python -m pytest tests
+База должна быть пустой и одноразовой: тест пересоздает схему public.
+"""
+import os
+import asyncio
+import pytest
+import asyncpg
+import database as db
+from migrations import migrate, LATEST_VERSION
+
+TEST_DATABASE_URL = os.getenv("TEST_DATABASE_URL")
+
+pytestmark = pytest.mark.skipif(not TEST_DATABASE_URL, reason="TEST_DATABASE_URL не задан")
+
+def run(test):
+    """Выполняет тест с чистой схемой и пулом database._pool на тестовую базу."""
+    async def wrapper():
+        db._pool = await asyncpg.create_pool(TEST_DATABASE_URL, min_size=1, max_size=4, statement_cache_size=0)
+        try:
+            async with db._pool.acquire() as conn:
+                await conn.execute("DROP SCHEMA public CASCADE; CREATE SCHEMA public;")
+                assert await migrate(conn) == LATEST_VERSION
+            db.session_cache._entries.clear()
+            await test()
+        finally:
+            await db._pool.close()
+            db._pool = None
+    asyncio.run(wrapper())
+
+def msg(role: str, content: str) -> dict:
+    return {"role": role, "content": content}
+
+async def read_history(user_id: int) -> list:
+    db.session_cache.invalidate(user_id)
+    history, _, _, _ = await db.get_user_data(user_id)
+    return history
+
+def test_append_messages_moves_window():
+    async def test():
+        await db.append_messages(1, [msg("user", "a"), msg("assistant", "b")], keep_last=2)
+        assert await read_history(1) == [msg("user", "a"), msg("assistant", "b")]
+
+        await db.append_messages(1, [msg("user", "c"), msg("assistant", "d")], keep_last=3)
+        assert await read_history(1) == [msg("assistant", "b"), msg("user", "c"), msg("assistant", "d")]
+
+        async with db._pool.acquire() as conn:
+            row = await conn.fetchrow("SELECT last_seq, window_seq FROM chat_history WHERE user_id = 1")
+            seqs = [r["seq"] for r in await conn.fetch("SELECT seq FROM chat_messages WHERE user_id = 1 ORDER BY seq")]
+        assert (row["last_seq"], row["window_seq"]) == (4, 2)
+        assert seqs == [1, 2, 3, 4]
+    run(test)
+
+def test_append_messages_keeps_settings_and_cache():
+    async def test():
+        await db.save_user_data(2, model_name="m", character="c")
+        history, model_name, _, character = await db.get_user_data(2)  # сессия попадает в кэш
+        assert (history, model_name, character) == ([], "m", "c")
+
+        await db.append_messages(2, [msg("user", "a"), msg("assistant", "b")], keep_last=1)
+        assert (await db.get_user_data(2))[0] == [msg("assistant", "b")]
+        assert await read_history(2) == [msg("assistant", "b")]
+        assert (await db.get_user_data(2))[1:] == ("m", None, "c")
+    run(test)
+
+def test_concurrent_appends_get_distinct_seq():
+    async def test():
+        await asyncio.gather(*(db.append_messages(3, [msg("user", str(i))], keep_last=100) for i in range(10)))
+        async with db._pool.acquire() as conn:
+            seqs = [r["seq"] for r in await conn.fetch("SELECT seq FROM chat_messages WHERE user_id = 3 ORDER BY seq")]
+        assert seqs == list(range(1, 11))
+        assert len(await read_history(3)) == 10
+    run(test)
+
+def test_clear_user_history():
+    async def test():
+        await db.append_messages(4, [msg("user", "a"), msg("assistant", "b")], keep_last=2)
+        await db.clear_user_history(4)
+        assert await read_history(4) == []
+
+        await db.append_messages(4, [msg("user", "c")], keep_last=1)
+        assert await read_history(4) == [msg("user", "c")]
+    run(test)
@@ -0,0 +1,73 @@
+import asyncio
+import pytest
+import database as db
+from memory_service import MemoryService
+
+DISTINCT_FACTS = [
+    ("User name is Alex", "User son name is Alex"),
+    ("User works at Google", "User wife works at Google"),
+    ("Пользователя зовут Анна", "Сестру пользователя зовут Анна"),
+    ("User has 2 kids", "User has 3 kids"),
+    ("User is 30 years old", "User is 31 years old"),
+    ("Пользователь любит кофе", "Пользователь не любит кофе"),
+    ("Пользователь любит кофе", "Пользователь любит собак"),
+    ("Пользователь любит кофе", "Пользователь очень любит кофе"),
+]
+
+REPEATED_FACTS = [
+    ("Пользователь любит кофе", "пользователь любит кофе."),
+    ("Пользователь любит кофе", "Кофе пользователь любит"),
+    ("User works at Google", "The user works at Google"),
+]
+
+def is_duplicate(a: str, b: str) -> bool:
+    return MemoryService._is_duplicate(MemoryService._signature(a), MemoryService._signature(b))
+
+@pytest.mark.parametrize("a, b", DISTINCT_FACTS)
+def test_distinct_facts_are_not_duplicates(a, b):
+    assert not is_duplicate(a, b)
+    assert not is_duplicate(b, a)
+
+@pytest.mark.parametrize("a, b", REPEATED_FACTS)
+def test_repeated_facts_are_duplicates(a, b):
+    assert is_duplicate(a, b)
+
+@pytest.fixture
+def memories(monkeypatch):
+    """Вечная память одного пользователя в списке вместо БД."""
+    rows = []
+
+    async def get_memory_rows(user_id):
+        return list(rows)
+
+    async def add_memory(user_id, content):
+        rows.append((len(rows) + 100, content))
+
+    async def replace_memories(user_id, delete_ids, content=None):
+        rows[:] = [row for row in rows if row[0] not in delete_ids]
+        if content:
+            rows.append((len(rows) + 200, content))
+
+    monkeypatch.setattr(db, "get_memory_rows", get_memory_rows)
+    monkeypatch.setattr(db, "add_memory", add_memory)
+    monkeypatch.setattr(db, "replace_memories", replace_memories)
+    return rows
+
+@pytest.mark.parametrize("old, new", DISTINCT_FACTS)
+def test_save_keeps_both_distinct_facts(memories, old, new):
+    service = MemoryService()
+    asyncio.run(service.save(1, old))
+    asyncio.run(service.save(1, new))
+    assert [text for _, text in memories] == [old, new]
+
+def test_save_skips_repeat_and_consolidate_keeps_distinct(memories):
+    service = MemoryService()
+    asyncio.run(service.save(1, "Пользователь любит кофе"))
+    assert asyncio.run(service.save(1, "пользователь любит кофе.")).startswith("✅ Я уже это помню")
+    assert len(memories) == 1
+
+    memories.extend([(1, "User has 2 kids"), (2, "User has 3 kids"), (3, "User has 2 kids!"), (4, "User son name is Alex")])
+    assert asyncio.run(service.consolidate(1)) == 1
+    assert [text for _, text in memories] == [
+        "Пользователь любит кофе", "User has 2 kids", "User has 3 kids", "User son name is Alex"
+    ]
@@ -0,0 +1,64 @@
+import re
+import math
+from collections import Counter
+
+# Частые служебные слова — не несут смысла для поиска
+STOPWORDS = frozenset("""
+и в во не что он на я с со как а то все она так его но да ты к у же вы за бы по только ее мне было вот от меня
+еще нет о из ему теперь когда даже ну вдруг ли если уже или ни быть был него до вас нибудь опять уж вам ведь там
+потом себя ничего ей может они тут где есть надо ней для мы тебя их чем была сам чтоб без будто чего раз тоже себе
+под будет ж тогда кто этот того потому этого какой совсем ним здесь этом один почти мой тем чтобы нее были куда зачем
+всех никогда можно при наконец два об другой хоть после над больше тот через эти нас про всего них какая много разве
+эту моя впрочем хорошо свою этой перед иногда лучше чуть том нельзя такой им более всегда конечно всю между это
+the a an and or of to in on at for with by from is are was were be been it this that these those as not no but if
+then so do does did have has had i you he she we they them his her its our your their what which who how
+""".split())
+
+STEM_LENGTH = 6  # грубый «стемминг» обрезкой: «документа», «документы» -> «докуме»
+TOKEN_RE = re.compile(r'\w+')
+
+def tokenize(text: str) -> list[str]:
+    """Слова текста для поиска: нижний регистр, без стоп-слов, обрезанные до STEM_LENGTH."""
+    tokens = []
+    for word in TOKEN_RE.findall(text.lower()):
+        if len(word) < 2 or word in STOPWORDS:
+            continue
+        tokens.append(word[:STEM_LENGTH])
+    return tokens
+
+class BM25Index:
+    """Локальный BM25-индекс по списку текстов (без внешних сервисов и зависимостей)."""
+    def __init__(self, texts: list[str], k1: float = 1.5, b: float = 0.75):
+        self.k1 = k1
+        self.b = b
+        self.doc_freqs = [Counter(tokenize(text)) for text in texts]
+        self.doc_lens = [sum(freqs.values()) for freqs in self.doc_freqs]
+        self.avg_len = sum(self.doc_lens) / len(self.doc_lens) if self.doc_lens else 0.0
+
+        df = Counter()
+        for freqs in self.doc_freqs:
+            df.update(freqs.keys())
+        n = len(texts)
+        self.idf = {term: math.log(1 + (n - count + 0.5) / (count + 0.5)) for term, count in df.items()}
+
+    def __len__(self) -> int:
+        return len(self.doc_freqs)
+
+    def scores(self, query: str) -> list[float]:
+        """BM25-оценка каждого текста для запроса."""
+        terms = [t for t in set(tokenize(query)) if t in self.idf]
+        result = []
+        for freqs, length in zip(self.doc_freqs, self.doc_lens):
+            score = 0.0
+            norm = self.k1 * (1 - self.b + self.b * length / self.avg_len) if self.avg_len else self.k1
+            for term in terms:
+                tf = freqs.get(term)
+                if tf:
+                    score += self.idf[term] * tf * (self.k1 + 1) / (tf + norm)
+            result.append(score)
+        return result
+
+    def search(self, query: str, k: int) -> list[tuple[int, float]]:
+        """Топ-k (индекс, оценка) с ненулевой оценкой, по убыванию релевантности."""
+        ranked = sorted(enumerate(self.scores(query)), key=lambda item: item[1], reverse=True)
+        return [(i, score) for i, score in ranked[:k] if score > 0]
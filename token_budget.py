@@ -0,0 +1,159 @@
+import re
+import json
+import logging
+from functools import lru_cache
+
+log = logging.getLogger(__name__)
+
+# Калибровка оценщика под токенизатор Llama 3 (128k словарь):
+# латиница и код — ~4 символа на токен, кириллица и прочий не-ASCII — ~2.5
+ASCII_CHARS_PER_TOKEN = 4.0
+OTHER_CHARS_PER_TOKEN = 2.5
+MESSAGE_OVERHEAD = 4  # служебные токены роли/разделителей на каждое сообщение
+IMAGE_TOKENS = 1000   # условная стоимость картинки во vision-запросе
+
+CACHE_MAX_CHARS = 4096  # длинные тексты (документы) не кэшируем: кэш держал бы их целиком в памяти
+
+def _estimate_tokens(text: str) -> int:
+    ascii_chars = len(text.encode("ascii", "ignore"))
+    other_chars = len(text) - ascii_chars
+    return int(ascii_chars / ASCII_CHARS_PER_TOKEN + other_chars / OTHER_CHARS_PER_TOKEN) + 1
+
+_cached_estimate = lru_cache(maxsize=8192)(_estimate_tokens)
+
+def count_tokens(text: str) -> int:
+    """Оценивает число токенов в тексте без сетевых вызовов (короткие тексты — сообщения истории — кэшируются)."""
+    if not text:
+        return 0
+    if len(text) > CACHE_MAX_CHARS:
+        return _estimate_tokens(text)
+    return _cached_estimate(text)
+
+def message_tokens(message: dict) -> int:
+    """Оценивает размер одного сообщения истории в токенах."""
+    tokens = MESSAGE_OVERHEAD
+    content = message.get("content")
+    if isinstance(content, str):
+        tokens += count_tokens(content)
+    elif isinstance(content, list):
+        for part in content:
+            if part.get("type") == "text":
+                tokens += count_tokens(part.get("text", ""))
+            else:
+                tokens += IMAGE_TOKENS
+    for call in message.get("tool_calls") or []:
+        tokens += count_tokens(call["function"]["name"]) + count_tokens(call["function"]["arguments"] or "")
+    return tokens
+
+def schema_tokens(schema) -> int:
+    """Оценивает размер JSON-схемы (например, списка TOOLS), который тоже уходит в промпт."""
+    return count_tokens(json.dumps(schema, ensure_ascii=False))
+
+def truncate_text(text: str, max_tokens: int) -> str:
+    """Обрезает текст до max_tokens, сохраняя начало и конец."""
+    if count_tokens(text) <= max_tokens:
+        return text
+    # Консервативно переводим токены в символы по «дорогому» алфавиту
+    keep = max(int(max_tokens * OTHER_CHARS_PER_TOKEN) // 2, 1)
+    return f"{text[:keep]}\n…[обрезано]…\n{text[-keep:]}"
+
+def _group_turns(messages: list) -> tuple[list, list]:
+    """Делит историю на неделимые блоки: ответ ассистента с tool_calls идет вместе со своими tool-сообщениями.
+    Возвращает (блоки, осиротевшие_tool_сообщения_в_начале).
+    """
+    units = []
+    orphans = []
+    for msg in messages:
+        if msg.get("role") == "tool":
+            if units and units[-1][0].get("tool_calls"):
+                units[-1].append(msg)
+            else:
+                orphans.append(msg)
+        else:
+            units.append([msg])
+    return units, orphans
+
+def fit_context(history: list, budget: int, reserved: int = 0, min_partial: int = 200) -> tuple[list, list]:
+    """Собирает контекст под бюджет токенов.
+    Системный промпт (history[0]) и последний блок сохраняются всегда, старые блоки
+    отбрасываются целиком (tool-сообщения никогда не отрываются от своих tool_calls),
+    а самый старый из поместившихся частично — обрезается.
+    Возвращает кортеж (контекст, вытесненные_сообщения).
+    """
+    if not history:
+        return [], []
+
+    system = history[:1] if history[0].get("role") == "system" else []
+    units, orphans = _group_turns(history[len(system):])
+    available = budget - reserved - sum(message_tokens(m) for m in system)
+
+    kept = []
+    evicted_units = []
+    for i in range(len(units) - 1, -1, -1):
+        unit = units[i]
+        size = sum(message_tokens(m) for m in unit)
+        if size <= available:
+            kept.insert(0, unit)
+            available -= size
+            continue
+
+        single = len(unit) == 1 and isinstance(unit[0].get("content"), str)
+        if not kept:
+            # Даже последний блок не влезает в бюджет: обрезаем его, если это обычное сообщение
+            if single:
+                unit = [{**unit[0], "content": truncate_text(unit[0]["content"], max(available - MESSAGE_OVERHEAD, min_partial))}]
+            kept.insert(0, unit)
+            evicted_units = units[:i]
+        elif single and available >= min_partial:
+            kept.insert(0, [{**unit[0], "content": truncate_text(unit[0]["content"], available - MESSAGE_OVERHEAD)}])
+            evicted_units = units[:i]
+        else:
+            evicted_units = units[:i + 1]
+        break
+
+    evicted = list(orphans) + [m for unit in evicted_units for m in unit]
+    context = system + [m for unit in kept for m in unit]
+    if evicted:
+        log.debug(f"✂️ Контекст: вытеснено {len(evicted)} сообщений, осталось {len(context)}")
+    return context, evicted
+
+def split_text(text: str, max_tokens: int) -> list[str]:
+    """Режет текст на куски до max_tokens: по абзацам, длинные абзацы — по предложениям,
+    а совсем длинные предложения — по символам.
+    """
+    pieces = []  # (текст, начинает_ли_новый_абзац)
+    for paragraph in re.split(r'\n\s*\n', text):
+        paragraph = paragraph.strip()
+        if not paragraph:
+            continue
+        if count_tokens(paragraph) <= max_tokens:
+            pieces.append((paragraph, True))
+            continue
+        first = True
+        for sentence in re.split(r'(?<=[.!?…])\s+', paragraph):
+            if not sentence:
+                continue
+            if count_tokens(sentence) <= max_tokens:
+                pieces.append((sentence, first))
+                first = False
+                continue
+            # Слишком длинное предложение (например, таблица без точек) — режем курсором вперед,
+            # не пересчитывая каждый раз весь остаток
+            chars_per_token = ASCII_CHARS_PER_TOKEN if sentence.isascii() else OTHER_CHARS_PER_TOKEN
+            cut = max(int(max_tokens * chars_per_token) - 1, 1)
+            for start in range(0, len(sentence), cut):
+                pieces.append((sentence[start:start + cut], first))
+                first = False
+
+    chunks, current, current_tokens = [], "", 0
+    for piece, new_paragraph in pieces:
+        tokens = count_tokens(piece)
+        if current and current_tokens + tokens > max_tokens:
+            chunks.append(current)
+            current, current_tokens = "", 0
+        sep = "\n\n" if new_paragraph else " "
+        current = f"{current}{sep}{piece}" if current else piece
+        current_tokens += tokens
+    if current:
+        chunks.append(current)
+    return chunks
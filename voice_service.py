@@ -1,29 +1,123 @@
-import logging
+import re
 import io
+import asyncio
+import logging
+from concurrent.futures import ThreadPoolExecutor
+from typing import AsyncIterator
 from gtts import gTTS
+from config import TTS_CHUNK_CHARS, TTS_WORKERS, TTS_CACHE_MAX_BYTES
+from disk_cache import DiskCache
 
 log = logging.getLogger(__name__)
 
+SENTENCE_END = re.compile(r'(?<=[.!?…;])\s+|\n+')
+
 class VoiceService:
     def __init__(self):
         # Настройка языка по умолчанию
         self.lang = 'ru'
+        # gTTS синхронный (сетевой запрос к Google) — выполняем его в пуле потоков, а не в event loop
+        self._executor = ThreadPoolExecutor(max_workers=TTS_WORKERS, thread_name_prefix="tts")
+        # Готовая озвучка по (язык, текст) и Telegram file_id голосового с ней
+        self.cache = DiskCache("tts", TTS_CACHE_MAX_BYTES)
+
+    def cache_key(self, text: str) -> str:
+        return self.cache.key(self.lang, text.strip())
+
+    def cached_file_id(self, text: str) -> str:
+        """file_id уже отправленного голосового с этим текстом (или None)."""
+        meta = self.cache.meta(self.cache_key(text))
+        return meta.get("file_id") if meta else None
+
+    async def remember_file_id(self, text: str, file_id: str = None):
+        """Запоминает (или забывает при file_id=None) file_id голосового с этим текстом."""
+        await self.cache.update(self.cache_key(text), file_id=file_id)
+
+    @staticmethod
+    def split_text(text: str, max_chars: int = TTS_CHUNK_CHARS) -> list[str]:
+        """Режет текст на куски до max_chars по границам предложений (длинные предложения — по словам)."""
+        chunks, current = [], ""
+        for sentence in SENTENCE_END.split(text.strip()):
+            sentence = sentence.strip()
+            if not sentence:
+                continue
+            while len(sentence) > max_chars:
+                cut = sentence.rfind(" ", 0, max_chars)
+                if cut <= 0:
+                    cut = max_chars
+                if current:
+                    chunks.append(current)
+                    current = ""
+                chunks.append(sentence[:cut].strip())
+                sentence = sentence[cut:].strip()
+            if current and len(current) + 1 + len(sentence) > max_chars:
+                chunks.append(current)
+                current = sentence
+            else:
+                current = f"{current} {sentence}" if current else sentence
+        if current:
+            chunks.append(current)
+        return chunks
+
+    def _synthesize(self, text: str) -> bytes:
+        """Один запрос к gTTS (выполняется в потоке)."""
+        # gTTS выполняет запрос к Google и возвращает аудио
+        tts = gTTS(text=text, lang=self.lang)
+
+        # Сохраняем в байты в памяти
+        fp = io.BytesIO()
+        tts.write_to_fp(fp)
+        return fp.getvalue()
+
+    def _start(self, text: str) -> list[asyncio.Future]:
+        """Запускает синтез всех кусков текста параллельно."""
+        loop = asyncio.get_running_loop()
+        chunks = self.split_text(text) or [text]
+        return [loop.run_in_executor(self._executor, self._synthesize, chunk) for chunk in chunks]
 
     async def text_to_speech(self, text: str) -> bytes:
-        """Преобразует текст в речь через gTTS (Google TTS)."""
+        """Преобразует текст в речь через gTTS (Google TTS).
+        Куски синтезируются параллельно, MP3-сегменты склеиваются по порядку.
+        Повторная озвучка того же текста берется из дискового кэша.
+        """
+        key = self.cache_key(text)
+        audio = await self.cache.get(key)
+        if audio is not None:
+            return audio
+
+        futures = self._start(text)
+        try:
+            audio = b"".join(await asyncio.gather(*futures))
+            await self.cache.put(key, audio)
+            return audio
+        except Exception as e:
+            for future in futures:
+                future.cancel()
+            log.error(f"gTTS Service Error: {e}")
+            raise e
+
+    async def stream_speech(self, text: str) -> AsyncIterator[bytes]:
+        """Как text_to_speech, но отдает MP3-сегменты по порядку, как только каждый готов.
+        Первый сегмент можно отправить, пока синтезируются остальные. Из кэша — одним сегментом.
+        """
+        key = self.cache_key(text)
+        audio = await self.cache.get(key)
+        if audio is not None:
+            yield audio
+            return
+
+        futures = self._start(text)
+        segments = []
         try:
-            # gTTS выполняет запрос к Google и возвращает аудио
-            tts = gTTS(text=text, lang=self.lang)
-            
-            # Сохраняем в байты в памяти
-            fp = io.BytesIO()
-            tts.write_to_fp(fp)
-            fp.seek(0)
-            
-            return fp.read()
-            
+            for future in futures:
+                segments.append(await future)
+                yield segments[-1]
+            await self.cache.put(key, b"".join(segments))
         except Exception as e:
             log.error(f"gTTS Service Error: {e}")
             raise e
+        finally:
+            for future in futures:
+                future.cancel()
 
 voice_service = VoiceService()